@@ -10,26 +10,14 @@ from .models import Appointment
 from notifications.utils import create_notification
 from vitanips.core.utils import send_app_email
 from push_notifications.models import GCMDevice as FCMDevice, APNSDevice
-from twilio.rest import Client
+from vitanips.core.clients import provider_clients, send_sms
 from twilio.base.exceptions import TwilioRestException
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
-twilio_client = None
-TWILIO_ACCOUNT_SID = getattr(settings, 'TWILIO_ACCOUNT_SID', None)
-TWILIO_AUTH_TOKEN = getattr(settings, 'TWILIO_AUTH_TOKEN', None)
 TWILIO_PHONE_NUMBER = getattr(settings, 'TWILIO_PHONE_NUMBER', None)
 
-if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and TWILIO_PHONE_NUMBER:
-    try:
-        twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-        logger.info("Twilio client initialized successfully for appointment reminders.")
-    except Exception as e:
-        logger.error(f"Failed to initialize Twilio client: {e}")
-else:
-    logger.warning("Twilio credentials not fully configured in settings. SMS reminders will be disabled.")
-
 
 @shared_task(name="doctors.tasks.send_appointment_reminders_task")
 def send_appointment_reminders_task():
@@ -55,6 +43,9 @@ def send_appointment_reminders_task():
 
     sent_count = {'email': 0, 'sms': 0, 'push': 0, 'in_app': 0}
     error_count = {'email': 0, 'sms': 0, 'push': 0}
+    sms_enabled = bool(TWILIO_PHONE_NUMBER) and provider_clients.twilio() is not None
+    if not sms_enabled:
+        logger.debug("Twilio credentials not fully configured in settings. SMS reminders are disabled.")
 
     for appt in upcoming_appointments:
         user = appt.user
@@ -99,15 +90,11 @@ def send_appointment_reminders_task():
                 error_count['email'] += 1
                 logger.error(f"send_app_email failed for appt {appt.id}, user {user.id}")
 
-        if twilio_client and user.notify_appointment_reminder_sms and user.phone_number:
+        if sms_enabled and user.notify_appointment_reminder_sms and user.phone_number:
             logger.debug(f"Attempting SMS reminder for appt {appt.id} to {user.phone_number}")
             sms_message_body = f"VitaNips Reminder: Appt with {doctor_name} on {appointment_date_str} at {appointment_time_str}."
             try:
-                message = twilio_client.messages.create(
-                    to=str(user.phone_number),
-                    from_=TWILIO_PHONE_NUMBER,
-                    body=sms_message_body
-                )
+                message = send_sms(str(user.phone_number), sms_message_body, from_=TWILIO_PHONE_NUMBER)
                 logger.info(f"SMS sent for appt {appt.id} to {user.phone_number}. SID: {message.sid}, Status: {message.status}")
                 sent_count['sms'] += 1
             except TwilioRestException as e:
@@ -7,7 +7,7 @@ from django.conf import settings
 from django.utils import timezone
 from twilio.jwt.access_token import AccessToken
 from twilio.jwt.access_token.grants import VideoGrant
-from twilio.rest import Client
+from vitanips.core.clients import twilio_call
 from .models import Appointment, VirtualSession
 from .serializers import VirtualSessionSerializer
 import logging
@@ -222,18 +222,17 @@ def start_virtual_session_enhanced(request, appointment_id):
         # Create Twilio Room if not exists
         if not virtual_session.room_sid:
             try:
-                client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
-                
                 # Create a unique room name
                 room_name = f"vitanips_appointment_{appointment.id}_{int(timezone.now().timestamp())}"
                 
                 # Create room with recording enabled
-                room = client.video.v1.rooms.create(
-                    unique_name=room_name,
-                    type='group',
-                    record_participants_on_connect=True,
-                    max_participants=10
-                )
+                with twilio_call() as client:
+                    room = client.video.v1.rooms.create(
+                        unique_name=room_name,
+                        type='group',
+                        record_participants_on_connect=True,
+                        max_participants=10
+                    )
                 
                 virtual_session.room_name = room.unique_name
                 virtual_session.room_sid = room.sid
@@ -312,8 +311,8 @@ def get_session_recordings(request, appointment_id):
         
         # Fetch recordings from Twilio
         try:
-            client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
-            recordings = client.video.v1.recordings.list(room_sid=virtual_session.room_sid)
+            with twilio_call() as client:
+                recordings = client.video.v1.recordings.list(room_sid=virtual_session.room_sid)
             
             recording_data = []
             for recording in recordings:
@@ -81,20 +81,18 @@ class DoctorApplicationView(generics.CreateAPIView, generics.RetrieveUpdateAPIVi
         doctor = serializer.save()
         
         # Send notification to admins
-        from notifications.utils import create_notification
+        from notifications.utils import create_notifications
         from django.contrib.auth import get_user_model
         User = get_user_model()
-        admins = User.objects.filter(is_staff=True, is_superuser=True)
-        for admin in admins:
-            create_notification(
-                recipient=admin,
-                actor=request.user,
-                verb=f"New doctor application submitted by Dr. {doctor.first_name} {doctor.last_name}",
-                title=f"New Doctor Application",
-                level='info',
-                category='system',
-                action_url=f"/admin/doctors"
-            )
+        create_notifications(
+            User.objects.filter(is_staff=True, is_superuser=True),
+            actor=request.user,
+            verb=f"New doctor application submitted by Dr. {doctor.first_name} {doctor.last_name}",
+            title=f"New Doctor Application",
+            level='info',
+            category='system',
+            action_url=f"/admin/doctors"
+        )
         
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -140,20 +138,18 @@ class DoctorApplicationView(generics.CreateAPIView, generics.RetrieveUpdateAPIVi
         
         # Notify admins if status changed to submitted
         if doctor.application_status == 'submitted':
-            from notifications.utils import create_notification
+            from notifications.utils import create_notifications
             from django.contrib.auth import get_user_model
             User = get_user_model()
-            admins = User.objects.filter(is_staff=True, is_superuser=True)
-            for admin in admins:
-                create_notification(
-                    recipient=admin,
-                    actor=request.user,
-                    verb=f"Doctor application updated and resubmitted by Dr. {doctor.first_name} {doctor.last_name}",
-                    title=f"Doctor Application Updated",
-                    level='info',
-                    category='system',
-                    action_url=f"/admin/doctors"
-                )
+            create_notifications(
+                User.objects.filter(is_staff=True, is_superuser=True),
+                actor=request.user,
+                verb=f"Doctor application updated and resubmitted by Dr. {doctor.first_name} {doctor.last_name}",
+                title=f"Doctor Application Updated",
+                level='info',
+                category='system',
+                action_url=f"/admin/doctors"
+            )
         
         return Response(serializer.data)
 
@@ -823,6 +819,8 @@ class ForwardPrescriptionView(views.APIView):
     def post(self, request, pk, *args, **kwargs):
         # Import here to avoid circular imports
         from pharmacy.models import Pharmacy, MedicationOrder, MedicationOrderItem
+        from pharmacy.services import record_order_created
+        from pharmacy.availability import is_orderable
         from django.db import transaction
         
         # Get the prescription
@@ -845,15 +843,19 @@ class ForwardPrescriptionView(views.APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Validate pharmacy exists and is active
-        try:
-            pharmacy = Pharmacy.objects.get(pk=pharmacy_id, is_active=True)
-        except Pharmacy.DoesNotExist:
+        # Validate pharmacy exists, is active and its registration has not expired
+        if not is_orderable(pharmacy_id):
             return Response(
-                {"error": "Pharmacy not found or is inactive."},
+                {"error": "Pharmacy not found, inactive or its registration has expired."},
                 status=status.HTTP_404_NOT_FOUND
             )
-        
+        pharmacy = Pharmacy.objects.filter(pk=pharmacy_id).first()
+        if pharmacy is None:
+            return Response(
+                {"error": "Pharmacy not found, inactive or its registration has expired."},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
         # Check if appointment is completed
         if prescription.appointment.status != 'completed':
             return Response(
@@ -907,6 +909,7 @@ class ForwardPrescriptionView(views.APIView):
                     order_items.append(order_item)
                 
                 MedicationOrderItem.objects.bulk_create(order_items)
+                record_order_created(order, actor=request.user)
                 
                 # Create notification for user
                 create_notification(
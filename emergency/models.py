@@ -28,6 +28,12 @@ class EmergencyService(models.Model):
     notes = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if not self.location and self.address:
+            from pharmacy.geocoding import schedule_geocoding
+            schedule_geocoding(self)
     
     def __str__(self):
         return f"{self.name} ({self.get_service_type_display()})"
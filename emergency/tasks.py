@@ -1,25 +1,16 @@
 # emergency/tasks.py
-import os
 from celery import shared_task
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from twilio.rest import Client
 from twilio.base.exceptions import TwilioRestException
 from .models import EmergencyContact, EmergencyAlert, EmergencyAlertContact
 from django.contrib.gis.geos import Point
+from vitanips.core.clients import provider_clients, send_sms
 from typing import Optional
 
 User = get_user_model()
 
-TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
-TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
-TWILIO_PHONE_NUMBER = os.environ.get('TWILIO_PHONE_NUMBER')
-
-twilio_client = None
-if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
-    twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-else:
-    print("WARNING: Twilio credentials not found in environment variables. SOS SMS sending will be disabled.")
+TWILIO_PHONE_NUMBER = getattr(settings, 'TWILIO_PHONE_NUMBER', None)
 
 @shared_task(name="send_sos_alerts_task")
 def send_sos_alerts_task(user_id: int, latitude: float, longitude: float, message: Optional[str] = None):
@@ -57,7 +48,7 @@ def send_sos_alerts_task(user_id: int, latitude: float, longitude: float, messag
     if message:
         base_sms_body += f". Message: {message}"
 
-    if not twilio_client or not TWILIO_PHONE_NUMBER:
+    if provider_clients.twilio() is None or not TWILIO_PHONE_NUMBER:
         print(f"SOS Triggered for user {user_id} but Twilio is not configured. Logging only.")
         alert_instance.status = 'resolved'
         alert_instance.resolution_notes = "SMS not sent: Twilio service not configured."
@@ -105,11 +96,8 @@ def send_sos_alerts_task(user_id: int, latitude: float, longitude: float, messag
         )
 
         try:
-            message_instance = twilio_client.messages.create(
-                body=base_sms_body,
-                from_=TWILIO_PHONE_NUMBER,
-                to=formatted_phone
-            )
+            # Always attempt SOS messages, even while the SMS circuit is open.
+            message_instance = send_sms(formatted_phone, base_sms_body, from_=TWILIO_PHONE_NUMBER, fail_fast=False)
             print(f"✓ SMS sent to {contact.name} ({formatted_phone}), SID: {message_instance.sid}, Status: {message_instance.status}")
             alert_contact_log.delivery_status = message_instance.status
             alert_contact_log.save()
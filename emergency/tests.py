@@ -109,9 +109,10 @@ class SOSAlertsTaskTest(TestCase):
         self.latitude = 6.5244
         self.longitude = 3.3792
     
-    @patch('emergency.tasks.twilio_client')
-    def test_sos_task_sends_to_all_contacts(self, mock_twilio):
+    @patch('vitanips.core.clients.provider_clients.twilio')
+    def test_sos_task_sends_to_all_contacts(self, mock_provider):
         """Test that SOS task sends SMS to all emergency contacts"""
+        mock_twilio = mock_provider.return_value
         # Mock Twilio message creation
         mock_message = MagicMock()
         mock_message.sid = 'SM123456789'
@@ -166,9 +167,10 @@ class SOSAlertsTaskTest(TestCase):
         # Verify result message
         self.assertIn('has no contacts', result)
     
-    @patch('emergency.tasks.twilio_client')
-    def test_sos_task_partial_failure(self, mock_twilio):
+    @patch('vitanips.core.clients.provider_clients.twilio')
+    def test_sos_task_partial_failure(self, mock_provider):
         """Test SOS task when some messages fail to send"""
+        mock_twilio = mock_provider.return_value
         # Mock Twilio to succeed for first, fail for second
         def side_effect(*args, **kwargs):
             if kwargs['to'] == self.contact1.phone_number:
@@ -211,8 +213,8 @@ class SOSAlertsTaskTest(TestCase):
         
         self.assertIn('not found', result)
     
-    @patch('emergency.tasks.twilio_client', None)
-    def test_sos_task_twilio_not_configured(self):
+    @patch('vitanips.core.clients.provider_clients.twilio', return_value=None)
+    def test_sos_task_twilio_not_configured(self, mock_provider):
         """Test SOS task when Twilio is not configured"""
         result = send_sos_alerts_task(
             user_id=self.user.id,
@@ -230,9 +232,10 @@ class SOSAlertsTaskTest(TestCase):
         for ac in alert_contacts:
             self.assertEqual(ac.delivery_status, 'failed_config')
     
-    @patch('emergency.tasks.twilio_client')
-    def test_sos_task_with_custom_message(self, mock_twilio):
+    @patch('vitanips.core.clients.provider_clients.twilio')
+    def test_sos_task_with_custom_message(self, mock_provider):
         """Test SOS task includes custom message in SMS"""
+        mock_twilio = mock_provider.return_value
         mock_message = MagicMock()
         mock_message.sid = 'SM123'
         mock_message.status = 'queued'
@@ -1,7 +1,9 @@
 from django.contrib import admin
+from django.utils import timezone
 from .models import (
     NotificationTemplate, Notification, NotificationDelivery,
-    NotificationPreference, NotificationSchedule
+    NotificationPreference, NotificationSchedule, UnreadNotificationCounter,
+    PendingDigestItem, DeferredNotification, ReminderLedger, DeliveryStatusEvent
 )
 
 
@@ -27,28 +29,72 @@ class NotificationAdmin(admin.ModelAdmin):
 
 @admin.register(NotificationDelivery)
 class NotificationDeliveryAdmin(admin.ModelAdmin):
-    list_display = ['notification', 'channel', 'status', 'sent_at', 'delivered_at']
+    list_display = ['notification', 'channel', 'status', 'retry_count', 'next_retry_at', 'sent_at', 'delivered_at']
     list_filter = ['channel', 'status', 'created_at']
     search_fields = ['notification__title', 'external_id']
     readonly_fields = ['created_at', 'updated_at', 'sent_at', 'delivered_at', 'failed_at']
     date_hierarchy = 'created_at'
+    actions = ['requeue']
     
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('notification', 'notification__recipient')
 
+    @admin.action(description="Requeue selected failed / dead-lettered deliveries")
+    def requeue(self, request, queryset):
+        count = queryset.filter(status__in=['failed', 'dead_letter']).update(
+            status='queued', retry_count=0, next_retry_at=None, updated_at=timezone.now()
+        )
+        self.message_user(request, f"Requeued {count} deliveries.")
+
 
 @admin.register(NotificationPreference)
 class NotificationPreferenceAdmin(admin.ModelAdmin):
-    list_display = ['user', 'email_enabled', 'sms_enabled', 'push_enabled', 'updated_at']
-    list_filter = ['email_enabled', 'sms_enabled', 'push_enabled', 'quiet_hours_enabled']
+    list_display = ['user', 'email_enabled', 'sms_enabled', 'push_enabled', 'digest_enabled', 'updated_at']
+    list_filter = ['email_enabled', 'sms_enabled', 'push_enabled', 'quiet_hours_enabled', 'digest_enabled', 'timezone']
     search_fields = ['user__email']
-    readonly_fields = ['updated_at']
+    readonly_fields = ['updated_at', 'last_digest_sent_at']
 
 
 @admin.register(NotificationSchedule)
 class NotificationScheduleAdmin(admin.ModelAdmin):
-    list_display = ['user', 'template', 'frequency', 'is_active', 'last_sent_at', 'total_sent']
+    list_display = ['user', 'template', 'frequency', 'is_active', 'next_send_at', 'last_sent_at', 'total_sent']
     list_filter = ['frequency', 'is_active', 'created_at']
     search_fields = ['user__email', 'template__name']
     readonly_fields = ['created_at', 'updated_at', 'last_sent_at', 'total_sent']
     date_hierarchy = 'created_at'
+
+
+@admin.register(UnreadNotificationCounter)
+class UnreadNotificationCounterAdmin(admin.ModelAdmin):
+    list_display = ['user', 'total', 'updated_at']
+    search_fields = ['user__email']
+    readonly_fields = ['updated_at']
+
+
+@admin.register(PendingDigestItem)
+class PendingDigestItemAdmin(admin.ModelAdmin):
+    list_display = ['user', 'notification', 'created_at']
+    search_fields = ['user__email']
+    raw_id_fields = ['user', 'notification']
+
+
+@admin.register(DeferredNotification)
+class DeferredNotificationAdmin(admin.ModelAdmin):
+    list_display = ['notification', 'release_at', 'created_at']
+    raw_id_fields = ['notification']
+    date_hierarchy = 'release_at'
+
+
+@admin.register(ReminderLedger)
+class ReminderLedgerAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'object_id', 'reminder_type', 'window_key', 'created_at']
+    list_filter = ['kind', 'reminder_type']
+    search_fields = ['object_id']
+
+
+@admin.register(DeliveryStatusEvent)
+class DeliveryStatusEventAdmin(admin.ModelAdmin):
+    list_display = ['channel', 'external_id', 'status', 'received_at', 'process_after']
+    list_filter = ['channel', 'status']
+    search_fields = ['external_id']
+
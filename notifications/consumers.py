@@ -1,13 +1,37 @@
+import asyncio
 import json
+from datetime import timedelta
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from .utils import unread_count, user_notifications_group
+
 
 class NotificationConsumer(AsyncWebsocketConsumer):
+    """
+    Live notifications for the signed-in user.
+
+    Notifications arriving within COALESCE_WINDOW seconds of each other are sent
+    as one ``new_notification`` frame carrying all of them plus the current
+    ``unread_count``. Every frame carries a ``cursor`` (the highest notification
+    id it contains). On reconnect, pass the last cursor seen as ``?cursor=<id>``
+    or send ``{"type": "resume", "cursor": <id>}`` to replay missed
+    notifications. Ids are assigned at insert, not commit, so replay also
+    resends notifications from the last REPLAY_OVERLAP below the cursor. Frames
+    may repeat around a reconnect; ignore ids already shown.
+    """
+    COALESCE_WINDOW = 0.5  # seconds
+    REPLAY_LIMIT = 100
+    REPLAY_OVERLAP = timedelta(seconds=30)
+
     async def connect(self):
         if self.scope["user"].is_anonymous:
             await self.close()
         else:
             self.user_id = self.scope['user'].id
-            self.group_name = f"user_{self.user_id}_notifications"
+            self.group_name = user_notifications_group(self.user_id)
+            self.pending = []
+            self.flush_task = None
 
             # Join room group
             await self.channel_layer.group_add(
@@ -17,21 +41,81 @@ class NotificationConsumer(AsyncWebsocketConsumer):
 
             await self.accept()
 
+            query = parse_qs(self.scope.get('query_string', b'').decode())
+            cursor = query.get('cursor', [None])[0]
+            if cursor is not None:
+                await self.replay(cursor)
+
     async def disconnect(self, close_code):
         if not self.scope["user"].is_anonymous:
+            if self.flush_task is not None:
+                self.flush_task.cancel()
             # Leave room group
             await self.channel_layer.group_discard(
                 self.group_name,
                 self.channel_name
             )
 
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = json.loads(text_data or '{}')
+        except ValueError:
+            return
+        if data.get('type') == 'resume':
+            await self.replay(data.get('cursor'))
+
+    async def replay(self, cursor):
+        try:
+            cursor = int(cursor)
+        except (TypeError, ValueError):
+            await self.send(text_data=json.dumps({'type': 'error', 'message': 'Invalid cursor.'}))
+            return
+
+        notifications, has_more = await self.get_notifications_since(cursor)
+        await self.send_frame('replay', notifications, has_more=has_more)
+
     # Receive message from room group
     async def notification_new(self, event):
-        notification = event['notification']
+        self.pending.extend(event.get('notifications') or [event['notification']])
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_pending())
+
+    async def flush_pending(self):
+        await asyncio.sleep(self.COALESCE_WINDOW)
+        notifications, self.pending = self.pending, []
+        self.flush_task = None
+        await self.send_frame('new_notification', notifications)
+
+    async def send_frame(self, frame_type, notifications, **extra):
+        notifications = sorted(notifications, key=lambda notification: notification['id'])
+        frame = {
+            'type': frame_type,
+            'notifications': notifications,
+            'unread_count': await self.get_unread_count(),
+            'cursor': notifications[-1]['id'] if notifications else None,
+            **extra,
+        }
+        if notifications:
+            # Clients built for one notification per frame read the newest here.
+            frame['notification'] = notifications[-1]
+        await self.send(text_data=json.dumps(frame))
+
+    @database_sync_to_async
+    def get_notifications_since(self, cursor):
+        from django.db.models import Q
+        from django.utils import timezone
+        from .models import Notification
+        from .serializers import NotificationBroadcastSerializer
 
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'new_notification',
-            'notification': notification
-        }))
+        recent = Q(timestamp__gte=timezone.now() - self.REPLAY_OVERLAP)
+        notifications = list(
+            Notification.objects.filter(Q(id__gt=cursor) | recent, recipient_id=self.user_id, dismissed=False)
+            .select_related('actor')
+            .order_by('id')[:self.REPLAY_LIMIT + 1]
+        )
+        frames = NotificationBroadcastSerializer(notifications[:self.REPLAY_LIMIT], many=True).data
+        return frames, len(notifications) > self.REPLAY_LIMIT
 
+    @database_sync_to_async
+    def get_unread_count(self):
+        return unread_count(self.user_id)
@@ -0,0 +1,124 @@
+# notifications/counters.py
+"""
+Unread notification counters.
+
+UnreadNotificationCounter holds one row per user with the number of unread,
+non-dismissed notifications overall and per category, so the unread count
+endpoint is a primary-key lookup instead of a COUNT(*). Every change is a
+single UPDATE with F() expressions. Rows are created from a real count the
+first time a user's counts are read, and reconcile_unread_counters() corrects
+any drift (e.g. rows written by bulk SQL that bypassed these helpers).
+"""
+import logging
+from collections import Counter
+from django.db.models import Count, F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from .models import Notification, UnreadNotificationCounter
+
+logger = logging.getLogger(__name__)
+
+CATEGORIES = tuple(choice for choice, _ in Notification.CATEGORY_CHOICES)
+COUNTER_FIELDS = ('total',) + CATEGORIES
+
+
+def _unread(queryset):
+    return queryset.filter(unread=True, dismissed=False)
+
+
+def _adjust(user_ids, deltas):
+    """Apply the same deltas to every existing counter row in user_ids with one UPDATE."""
+    updates = {field: Greatest(F(field) + Value(delta), Value(0)) for field, delta in deltas.items() if delta}
+    if not updates or not user_ids:
+        return
+    UnreadNotificationCounter.objects.filter(user_id__in=user_ids).update(**updates, updated_at=timezone.now())
+
+
+def _apply(per_user):
+    """per_user: {user_id: Counter(category -> delta)}; users sharing deltas are updated together."""
+    groups = {}
+    for user_id, by_category in per_user.items():
+        deltas = {category: delta for category, delta in by_category.items() if delta}
+        if not deltas:
+            continue
+        deltas['total'] = sum(deltas.values())
+        groups.setdefault(tuple(sorted(deltas.items())), []).append(user_id)
+    for deltas, user_ids in groups.items():
+        _adjust(user_ids, dict(deltas))
+
+
+def record_created(notifications):
+    """Count newly created notifications (a fan-out to N users is one UPDATE)."""
+    per_user = {}
+    for notification in notifications:
+        if notification.unread and not notification.dismissed:
+            per_user.setdefault(notification.recipient_id, Counter())[notification.category] += 1
+    _apply(per_user)
+
+
+def record_read(notification, delta=-1):
+    """Count one notification leaving (delta=-1) or re-entering (delta=1) the unread set."""
+    _apply({notification.recipient_id: Counter({notification.category: delta})})
+
+
+def reset(user_id):
+    """All of the user's notifications were marked read."""
+    UnreadNotificationCounter.objects.filter(user_id=user_id).update(
+        **{field: 0 for field in COUNTER_FIELDS}, updated_at=timezone.now()
+    )
+
+
+def _actual_counts(user_ids):
+    """{user_id: {field: count}} computed from the Notification table in one query."""
+    counts = {user_id: dict.fromkeys(COUNTER_FIELDS, 0) for user_id in user_ids}
+    rows = (
+        _unread(Notification.objects.filter(recipient_id__in=user_ids))
+        .values('recipient_id', 'category')
+        .annotate(n=Count('id'))
+        .order_by()
+    )
+    for row in rows:
+        user_counts = counts[row['recipient_id']]
+        if row['category'] in user_counts:
+            user_counts[row['category']] += row['n']
+        user_counts['total'] += row['n']
+    return counts
+
+
+def get_unread_counts(user_id):
+    """The user's counters as a dict of COUNTER_FIELDS, seeding the row on first read."""
+    counts = UnreadNotificationCounter.objects.filter(user_id=user_id).values(*COUNTER_FIELDS).first()
+    if counts is None:
+        counts = _actual_counts([user_id])[user_id]
+        UnreadNotificationCounter.objects.bulk_create(
+            [UnreadNotificationCounter(user_id=user_id, **counts)], ignore_conflicts=True
+        )
+    return counts
+
+
+def reconcile_unread_counters(batch_size=500):
+    """Recount every counter row in batches and fix the ones that drifted. Returns rows fixed."""
+    fixed = 0
+    last_user_id = 0
+    while True:
+        counters = list(
+            UnreadNotificationCounter.objects.filter(user_id__gt=last_user_id).order_by('user_id')[:batch_size]
+        )
+        if not counters:
+            break
+        last_user_id = counters[-1].user_id
+
+        actual = _actual_counts([counter.user_id for counter in counters])
+        drifted = []
+        for counter in counters:
+            expected = actual[counter.user_id]
+            if any(getattr(counter, field) != expected[field] for field in COUNTER_FIELDS):
+                for field in COUNTER_FIELDS:
+                    setattr(counter, field, expected[field])
+                drifted.append(counter)
+        UnreadNotificationCounter.objects.bulk_update(drifted, COUNTER_FIELDS)
+        fixed += len(drifted)
+
+    if fixed:
+        logger.warning(f"Reconciled {fixed} drifted unread notification counters")
+    return fixed
@@ -0,0 +1,553 @@
+# notifications/delivery.py
+"""
+Batched multi-channel notification delivery.
+
+plan_deliveries() turns a batch of notifications into NotificationDelivery rows
+with one bulk insert: in-app is delivered (and broadcast) immediately, external
+channels are queued. send_queued_deliveries() claims queued rows for a channel
+with SKIP LOCKED and sends them together -- push through FCM batch calls of up
+to FCM_MAX_RECIPIENTS tokens, email and SMS over the worker's long-lived
+provider clients -- then writes every result back with a single bulk_update.
+
+Failed sends are retried by retry_due_deliveries(): each failure schedules
+next_retry_at with capped exponential backoff and jitter from the channel's
+RetryPolicy, and a delivery that runs out of attempts is dead-lettered.
+"""
+import logging
+import random
+from collections import defaultdict, namedtuple
+from datetime import timedelta
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.core.mail.message import make_msgid
+from django.core.mail.utils import DNS_NAME
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+from push_notifications.models import APNSDevice, GCMDevice
+from vitanips.core.clients import provider_clients, send_email_messages, send_sms
+from vitanips.core.push_notifications import FCM_V1_AVAILABLE, initialize_firebase
+from .models import (
+    DeferredNotification, Notification, NotificationDelivery, NotificationPreference, PendingDigestItem
+)
+from .rate_limits import LIMITED_CHANNELS, channel_limit, consume
+from .status_callbacks import normalize_message_id
+from .utils import broadcast_notifications
+
+if FCM_V1_AVAILABLE:
+    from firebase_admin import messaging
+
+logger = logging.getLogger(__name__)
+
+EXTERNAL_CHANNELS = ('email', 'sms', 'push')
+# Delay before retry n is base * 2**(n - 1), capped, then jittered (see retry_delay).
+RetryPolicy = namedtuple('RetryPolicy', 'base cap max_attempts')
+RETRY_POLICIES = {
+    'email': RetryPolicy(timedelta(minutes=1), timedelta(hours=1), 6),
+    'sms': RetryPolicy(timedelta(minutes=2), timedelta(hours=2), 5),
+    'push': RetryPolicy(timedelta(seconds=30), timedelta(minutes=30), 5),
+}
+# Circuit breaker guarding each channel's provider (vitanips.core.clients).
+CHANNEL_PROVIDERS = {'email': 'smtp', 'sms': 'twilio'}
+# Rows left in 'sending' this long belonged to a worker that died mid-batch.
+STALE_SENDING_AFTER = timedelta(minutes=15)
+# Sent straight away, bypassing digests and daily channel limits.
+PRIORITY_LEVELS = ('urgent',)
+PRIORITY_CATEGORIES = ('emergency',)
+RESULT_FIELDS = [
+    'status', 'sent_at', 'failed_at', 'error_message', 'retry_count',
+    'next_retry_at', 'external_id', 'provider_response', 'updated_at',
+]
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _wanted_channels(notification, pref):
+    user = notification.recipient
+    category = notification.category
+    channels = []
+    if pref.email_enabled and pref.get_channel_preference(category, 'email'):
+        channels.append('email')
+    if pref.sms_enabled and pref.get_channel_preference(category, 'sms') and user.phone_number:
+        channels.append('sms')
+    if pref.push_enabled and pref.get_channel_preference(category, 'push'):
+        channels.append('push')
+    return channels
+
+
+def _is_priority(notification):
+    return notification.level in PRIORITY_LEVELS or notification.category in PRIORITY_CATEGORIES
+
+
+def _digested(notification, pref):
+    return pref.digest_enabled and not _is_priority(notification)
+
+
+def plan_deliveries(notifications, channels=None):
+    """
+    Create the delivery rows for notifications (with recipient loaded) honouring
+    each recipient's preferences. Pass channels to restrict planning to some
+    external channels; in-app is only handled when channels is None.
+    For recipients with digest_enabled, external channels are replaced by a
+    PendingDigestItem (see notifications.digests) and quiet hours are left
+    to the digest. Notifications arriving in quiet hours get a
+    DeferredNotification row released when the quiet hours end; urgent and
+    emergency notifications are sent regardless of quiet hours. Email and
+    SMS beyond the user's max_daily_* limits are recorded as 'rate_limited'
+    and the user gets the notification in-app only. Returns (queued
+    deliveries, notifications held back by quiet hours).
+    """
+    now = timezone.now()
+    user_ids = {notification.recipient_id for notification in notifications}
+    prefs = {pref.user_id: pref for pref in NotificationPreference.objects.filter(user_id__in=user_ids)}
+
+    deliveries = []
+    in_app = []
+    held = []
+    digest_items = []
+    deferred = []
+    limited = []  # (delivery, rate limit request)
+    for notification in notifications:
+        pref = prefs.get(notification.recipient_id) or NotificationPreference(user_id=notification.recipient_id)
+        digested = _digested(notification, pref)
+        if not digested and not _is_priority(notification) and not pref.should_send_now(now):
+            held.append(notification)
+            deferred.append(DeferredNotification(
+                notification=notification,
+                release_at=pref.quiet_hours_release_at(now),
+                channels=list(channels) if channels is not None else None,
+            ))
+            continue
+        if digested:
+            digest_items.append(PendingDigestItem(user_id=notification.recipient_id, notification=notification))
+        else:
+            for channel in _wanted_channels(notification, pref):
+                if channels is None or channel in channels:
+                    delivery = NotificationDelivery(notification=notification, channel=channel, status='queued')
+                    deliveries.append(delivery)
+                    if channel in LIMITED_CHANNELS and not _is_priority(notification):
+                        day = pref.local_now(now).date()
+                        limited.append((delivery, (notification.recipient_id, channel, day, channel_limit(pref, channel))))
+        if channels is None:
+            deliveries.append(NotificationDelivery(
+                notification=notification, channel='in_app', status='delivered', delivered_at=now
+            ))
+            in_app.append(notification)
+
+    if limited:
+        allowed = consume([request for _, request in limited])
+        for (delivery, _), ok in zip(limited, allowed):
+            if not ok:
+                delivery.status = 'rate_limited'
+                delivery.error_message = "Daily limit reached; delivered in-app only"
+    NotificationDelivery.objects.bulk_create(deliveries)
+    if digest_items:
+        # A notification can be planned twice (in-app, then push); keep one item.
+        PendingDigestItem.objects.bulk_create(digest_items, ignore_conflicts=True)
+    if deferred:
+        DeferredNotification.objects.bulk_create(deferred, ignore_conflicts=True)
+    if in_app:
+        Notification.objects.filter(pk__in=[notification.pk for notification in in_app]).update(sent_at=now)
+        broadcast_notifications(in_app)
+    return [delivery for delivery in deliveries if delivery.status == 'queued'], held
+
+
+def _claim(rows, batch_size, now):
+    with transaction.atomic():
+        ids = list(rows.select_for_update(skip_locked=True).values_list('id', flat=True)[:batch_size])
+        NotificationDelivery.objects.filter(id__in=ids).update(status='sending', next_retry_at=None, updated_at=now)
+    return list(
+        NotificationDelivery.objects.filter(id__in=ids)
+        .select_related('notification__recipient', 'notification__template')
+        .order_by('id')
+    )
+
+
+def claim_queued(channel, batch_size):
+    """Move up to batch_size queued rows of a channel to 'sending' and return them, SKIP LOCKED."""
+    rows = NotificationDelivery.objects.filter(channel=channel, status='queued').order_by('created_at')
+    return _claim(rows, batch_size, timezone.now())
+
+
+def claim_due_retries(channel, batch_size):
+    """Like claim_queued(), for failed rows of a channel whose next_retry_at has passed."""
+    now = timezone.now()
+    rows = NotificationDelivery.objects.filter(
+        channel=channel, status='failed', next_retry_at__lte=now
+    ).order_by('next_retry_at')
+    return _claim(rows, batch_size, now)
+
+
+def requeue_stale():
+    """Return rows stuck in 'sending' to the queue."""
+    cutoff = timezone.now() - STALE_SENDING_AFTER
+    return NotificationDelivery.objects.filter(status='sending', updated_at__lt=cutoff).update(
+        status='queued', updated_at=timezone.now()
+    )
+
+
+def release_deferred(batch_size=None, max_batches=20):
+    """
+    Plan delivery for deferred notifications whose quiet hours are over.
+    Rows are claimed with SKIP LOCKED so concurrent sweeps split the work;
+    anyone still in quiet hours (preferences changed) is deferred again.
+    Returns {channel: deliveries queued}.
+    """
+    batch_size = batch_size or settings.NOTIFICATION_DELIVERY_BATCH_SIZE
+    queued_channels = defaultdict(int)
+    for _ in range(max_batches):
+        with transaction.atomic():
+            rows = list(
+                DeferredNotification.objects.select_for_update(skip_locked=True)
+                .filter(release_at__lte=timezone.now())
+                .order_by('release_at')[:batch_size]
+            )
+            if not rows:
+                break
+            DeferredNotification.objects.filter(pk__in=[row.pk for row in rows]).delete()
+
+            by_channels = defaultdict(list)
+            for row in rows:
+                by_channels[tuple(row.channels) if row.channels is not None else None].append(row.notification_id)
+            for channels, notification_ids in by_channels.items():
+                notifications = list(Notification.objects.filter(pk__in=notification_ids).select_related('recipient'))
+                queued, _ = plan_deliveries(notifications, channels=channels)
+                for delivery in queued:
+                    queued_channels[delivery.channel] += 1
+        logger.info(f"Released {len(rows)} notifications deferred by quiet hours")
+        if len(rows) < batch_size:
+            break
+    return dict(queued_channels)
+
+
+def _mark_sent(delivery, now, external_id='', response=None):
+    delivery.status = 'sent'
+    delivery.sent_at = now
+    delivery.external_id = external_id or delivery.external_id
+    if response is not None:
+        delivery.provider_response = response
+
+
+def retry_delay(channel, attempt):
+    """
+    Backoff before retrying after the given failed attempt: exponential up to
+    the policy's cap, then drawn from the upper half of that window so rows
+    that failed together (a provider outage) come back spread out.
+    """
+    policy = RETRY_POLICIES[channel]
+    delay = min(policy.cap, policy.base * 2 ** (attempt - 1))
+    return delay / 2 + delay / 2 * random.random()
+
+
+def _mark_failed(delivery, now, error, retry=True):
+    """
+    Record a failed attempt. Retryable failures get a next_retry_at until the
+    channel's max_attempts is used up, then the delivery is dead-lettered;
+    permanent ones (retry=False) stay 'failed' with no retry scheduled.
+    """
+    delivery.status = 'failed'
+    delivery.failed_at = now
+    delivery.error_message = str(error)
+    delivery.retry_count += 1
+    delivery.next_retry_at = None
+    if not retry:
+        return
+    if delivery.retry_count >= RETRY_POLICIES[delivery.channel].max_attempts:
+        delivery.status = 'dead_letter'
+        logger.warning(f"Delivery {delivery.id} dead-lettered after {delivery.retry_count} attempts: {error}")
+    else:
+        delivery.next_retry_at = now + retry_delay(delivery.channel, delivery.retry_count)
+
+
+def _template_context(notification):
+    return {
+        **notification.metadata,
+        'user': notification.recipient,
+        'notification': notification,
+        'action_url': notification.action_url,
+    }
+
+
+def _fallback_content(notification, channel):
+    if channel == 'email':
+        return notification.title, f"<p>{notification.verb}</p>"
+    if channel == 'sms':
+        return f"{notification.title}: {notification.verb}"[:160]
+    return notification.title, notification.verb
+
+
+def render_batch(deliveries, channel):
+    """
+    {delivery id: content} for a batch: (subject, html) for email, text for SMS,
+    (title, body) for push. Deliveries sharing a template are rendered together
+    with NotificationTemplate.render_many.
+    """
+    content = {}
+    by_template = defaultdict(list)
+    for delivery in deliveries:
+        template = delivery.notification.template
+        if template:
+            by_template[template.pk].append(delivery)
+        else:
+            content[delivery.id] = _fallback_content(delivery.notification, channel)
+
+    for group in by_template.values():
+        template = group[0].notification.template
+        rendered = template.render_many(
+            [_template_context(delivery.notification) for delivery in group], channel=channel
+        )
+        for delivery, value in zip(group, rendered):
+            if channel == 'email':
+                value = (value['subject'], value['body'])
+            elif channel == 'push':
+                value = (value['title'], value['body'])
+            content[delivery.id] = value
+    return content
+
+
+def send_email_batch(deliveries, now):
+    content = render_batch(deliveries, 'email')
+    for delivery in deliveries:
+        notification = delivery.notification
+        user = notification.recipient
+        if not user.email:
+            _mark_failed(delivery, now, "User has no email address", retry=False)
+            continue
+        subject, html_content = content[delivery.id]
+        # Our own Message-ID, so provider bounce/delivery events can be matched back.
+        message_id = make_msgid(domain=DNS_NAME)
+        email = EmailMultiAlternatives(
+            subject=subject,
+            body=notification.verb,  # Plain text fallback
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to=[user.email],
+            headers={'Message-ID': message_id},
+        )
+        email.attach_alternative(html_content, "text/html")
+        try:
+            send_email_messages([email])
+            _mark_sent(delivery, now, external_id=normalize_message_id(message_id))
+        except Exception as e:
+            logger.error(f"Error sending email for delivery {delivery.id}: {e}")
+            _mark_failed(delivery, now, e)
+
+
+def send_sms_batch(deliveries, now):
+    content = render_batch(deliveries, 'sms')
+    for delivery in deliveries:
+        user = delivery.notification.recipient
+        if not user.phone_number:
+            _mark_failed(delivery, now, "User has no phone number", retry=False)
+            continue
+        try:
+            sms = send_sms(
+                user.phone_number, content[delivery.id],
+                status_callback=settings.NOTIFICATION_SMS_STATUS_CALLBACK_URL,
+            )
+            _mark_sent(delivery, now, external_id=sms.sid, response={
+                'status': sms.status,
+                'error_code': sms.error_code,
+                'error_message': sms.error_message,
+            })
+        except Exception as e:
+            logger.error(f"Error sending SMS for delivery {delivery.id}: {e}")
+            _mark_failed(delivery, now, e)
+
+
+def _send_fcm(jobs):
+    """
+    jobs: (delivery, device, title, body, data) tuples. Sends up to
+    FCM_MAX_RECIPIENTS messages per FCM call and returns {delivery id: error}.
+    """
+    errors = {}
+    if not jobs:
+        return errors
+
+    if not initialize_firebase():
+        # Legacy API through django-push-notifications, one call per notification.
+        by_delivery = {}
+        for delivery, device, title, body, data in jobs:
+            by_delivery.setdefault(delivery, (title, body, data, []))[3].append(device.pk)
+        for delivery, (title, body, data, device_ids) in by_delivery.items():
+            try:
+                GCMDevice.objects.filter(pk__in=device_ids).send_message(
+                    message={"title": title, "body": body},
+                    extra=data
+                )
+            except Exception as e:
+                errors[delivery.id] = str(e)
+        return errors
+
+    unregistered = []
+    for chunk in _chunks(jobs, settings.FCM_MAX_RECIPIENTS):
+        messages = [
+            messaging.Message(
+                notification=messaging.Notification(title=title, body=body),
+                data=data,
+                token=device.registration_id,
+            )
+            for _, device, title, body, data in chunk
+        ]
+        try:
+            response = messaging.send_each(messages)
+        except Exception as e:
+            for delivery, *_ in chunk:
+                errors[delivery.id] = str(e)
+            continue
+        for (delivery, device, *_), result in zip(chunk, response.responses):
+            if result.success:
+                continue
+            if isinstance(result.exception, messaging.UnregisteredError):
+                unregistered.append(device.pk)
+            else:
+                errors[delivery.id] = str(result.exception)
+
+    if unregistered:
+        GCMDevice.objects.filter(pk__in=unregistered).update(active=False)
+        logger.info(f"Deactivated {len(unregistered)} unregistered FCM devices")
+    return errors
+
+
+def _push_data(notification):
+    return {
+        'notification_id': str(notification.id),
+        'category': notification.category,
+        'action_url': notification.action_url or '',
+    }
+
+
+def send_push_batch(deliveries, now):
+    user_ids = {delivery.notification.recipient_id for delivery in deliveries}
+    fcm_devices = defaultdict(list)
+    apns_devices = defaultdict(list)
+    for device in GCMDevice.objects.filter(user_id__in=user_ids, active=True):
+        fcm_devices[device.user_id].append(device)
+    for device in APNSDevice.objects.filter(user_id__in=user_ids, active=True):
+        apns_devices[device.user_id].append(device)
+
+    content = render_batch(deliveries, 'push')
+    fcm_jobs = []
+    errors = {}
+    for delivery in deliveries:
+        notification = delivery.notification
+        user_id = notification.recipient_id
+        if not fcm_devices[user_id] and not apns_devices[user_id]:
+            _mark_failed(delivery, now, "User has no active devices", retry=False)
+            continue
+        title, body = content[delivery.id]
+        data = _push_data(notification)
+        for device in fcm_devices[user_id]:
+            fcm_jobs.append((delivery, device, title, body, data))
+        if apns_devices[user_id]:
+            # APNS has no multicast; one call per notification to the user's devices.
+            try:
+                APNSDevice.objects.filter(pk__in=[device.pk for device in apns_devices[user_id]]).send_message(
+                    message={"title": title, "body": body},
+                    extra=data
+                )
+            except Exception as e:
+                errors[delivery.id] = str(e)
+
+    errors.update(_send_fcm(fcm_jobs))
+    for delivery in deliveries:
+        if delivery.status == 'failed':
+            continue
+        if delivery.id in errors:
+            _mark_failed(delivery, now, errors[delivery.id])
+        else:
+            _mark_sent(delivery, now)
+
+
+SENDERS = {
+    'email': send_email_batch,
+    'sms': send_sms_batch,
+    'push': send_push_batch,
+}
+
+
+def send_deliveries(channel, deliveries):
+    """Send claimed deliveries of one channel and save every outcome with one bulk_update."""
+    if not deliveries:
+        return 0
+    now = timezone.now()
+    try:
+        SENDERS[channel](deliveries, now)
+    except Exception as e:
+        logger.error(f"{channel} batch of {len(deliveries)} deliveries failed: {e}")
+        for delivery in deliveries:
+            if delivery.status == 'sending':
+                _mark_failed(delivery, now, e)
+    for delivery in deliveries:
+        delivery.updated_at = now
+    NotificationDelivery.objects.bulk_update(deliveries, RESULT_FIELDS)
+    sent = sum(1 for delivery in deliveries if delivery.status == 'sent')
+    logger.info(f"Sent {sent} of {len(deliveries)} {channel} deliveries")
+    return sent
+
+
+def send_queued_deliveries(channel, batch_size=None, max_batches=20):
+    """Drain a channel's queue in batches; returns the number of deliveries processed."""
+    batch_size = batch_size or settings.NOTIFICATION_DELIVERY_BATCH_SIZE
+    processed = 0
+    for _ in range(max_batches):
+        deliveries = claim_queued(channel, batch_size)
+        send_deliveries(channel, deliveries)
+        processed += len(deliveries)
+        if len(deliveries) < batch_size:
+            break
+    return processed
+
+
+def provider_available(channel):
+    """False while the circuit breaker of the channel's provider is open."""
+    provider = CHANNEL_PROVIDERS.get(channel)
+    return provider is None or provider_clients.breaker(provider).state != 'open'
+
+
+def retry_due_deliveries(batch_size=None, max_batches=5):
+    """
+    Resend failed deliveries whose next_retry_at has passed, in batches per
+    channel. A channel whose provider circuit is open is skipped this run: its
+    rows stay due and go out once the provider is back, still spread by the
+    jitter they were scheduled with, at most max_batches batches per run.
+    Returns per-channel counts of retried, sent and dead-lettered deliveries.
+    """
+    batch_size = batch_size or settings.NOTIFICATION_DELIVERY_BATCH_SIZE
+    stats = {}
+    for channel in EXTERNAL_CHANNELS:
+        if not provider_available(channel):
+            logger.warning(f"Skipping {channel} retries: {CHANNEL_PROVIDERS[channel]} circuit is open")
+            continue
+        counts = {'retried': 0, 'sent': 0, 'dead_letter': 0}
+        for _ in range(max_batches):
+            deliveries = claim_due_retries(channel, batch_size)
+            counts['sent'] += send_deliveries(channel, deliveries)
+            counts['retried'] += len(deliveries)
+            counts['dead_letter'] += sum(1 for delivery in deliveries if delivery.status == 'dead_letter')
+            if len(deliveries) < batch_size or not provider_available(channel):
+                break
+        if counts['retried']:
+            logger.info(
+                f"Retried {counts['retried']} {channel} deliveries: "
+                f"{counts['sent']} sent, {counts['dead_letter']} dead-lettered"
+            )
+        stats[channel] = counts
+    return stats
+
+
+def retry_backlog():
+    """{channel: {'awaiting_retry': n, 'dead_letter': n}}, from one grouped query."""
+    rows = (
+        NotificationDelivery.objects.filter(channel__in=EXTERNAL_CHANNELS)
+        .filter(Q(status='failed', next_retry_at__isnull=False) | Q(status='dead_letter'))
+        .values('channel')
+        .annotate(
+            awaiting_retry=Count('id', filter=Q(status='failed')),
+            dead_letter=Count('id', filter=Q(status='dead_letter')),
+        )
+        .order_by('channel')
+    )
+    return {row['channel']: {'awaiting_retry': row['awaiting_retry'], 'dead_letter': row['dead_letter']} for row in rows}
@@ -0,0 +1,240 @@
+# notifications/digests.py
+"""
+Notification digests.
+
+plan_deliveries() sends in-app notifications to digest users straight away but
+parks their email/push delivery as PendingDigestItem rows. send_due_digests()
+runs on a schedule, picks the users whose digest_time has come round (daily or
+weekly, outside quiet hours) and sends each of them one email and one push
+covering everything pending, in batches of users. Users who switched digests
+off get whatever was still pending on the next run. Pending items are claimed
+with SKIP LOCKED, and a channel that fails is retried on the following runs
+(without resending the channels that went out) before the items are
+dead-lettered.
+"""
+import logging
+from collections import namedtuple
+from datetime import time, timedelta
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.db import transaction
+from django.db.models import Min
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.html import strip_tags
+from push_notifications.models import APNSDevice, GCMDevice
+from vitanips.core.clients import send_email_messages
+from .delivery import _chunks, _send_fcm
+from .models import NotificationDelivery, NotificationPreference, PendingDigestItem
+
+logger = logging.getLogger(__name__)
+
+DIGEST_PERIODS = {'daily': timedelta(days=1), 'weekly': timedelta(days=7)}
+MAX_DIGEST_ITEMS = 20  # listed in the email; the rest are summarised as a count
+DIGEST_BATCH_SIZE = 200  # users per batch
+DIGEST_MAX_ATTEMPTS = 3  # runs that may fail to send an item before it is dead-lettered
+
+# Stands in for a delivery in _send_fcm(); one job per user device.
+DigestPush = namedtuple('DigestPush', 'id')
+
+
+def latest_digest_slot(pref, now):
+    """The most recent local datetime at or before now matching pref.digest_time."""
+    digest_time = pref.digest_time
+    if isinstance(digest_time, str):
+        digest_time = time.fromisoformat(digest_time)
+    local_now = pref.local_now(now)
+    slot = local_now.replace(hour=digest_time.hour, minute=digest_time.minute, second=0, microsecond=0)
+    if slot > local_now:
+        slot -= timedelta(days=1)
+    return slot
+
+
+def is_digest_due(pref, oldest_item_at, now):
+    """
+    True once the digest slot after the oldest pending item has passed and a
+    full period has elapsed since the previous digest.
+    """
+    if pref is None or not pref.digest_enabled:
+        return True
+    slot = latest_digest_slot(pref, now)
+    if oldest_item_at >= slot:
+        return False
+    if pref.last_digest_sent_at is None:
+        return True
+    # Compare with a day's slack so a weekly digest stays on its weekday.
+    period = DIGEST_PERIODS.get(pref.digest_frequency, DIGEST_PERIODS['daily'])
+    return pref.last_digest_sent_at < slot - (period - timedelta(days=1))
+
+
+def due_digest_users(now):
+    """(user_id, preference or None) for every user with a digest due now."""
+    pending = (
+        PendingDigestItem.objects.values('user_id')
+        .annotate(oldest=Min('created_at'))
+        .order_by('user_id')
+    )
+    oldest = {row['user_id']: row['oldest'] for row in pending}
+    prefs = {pref.user_id: pref for pref in NotificationPreference.objects.filter(user_id__in=oldest)}
+
+    due = []
+    for user_id, oldest_item_at in oldest.items():
+        pref = prefs.get(user_id)
+        if not is_digest_due(pref, oldest_item_at, now):
+            continue
+        if pref is not None and pref.digest_enabled and not pref.should_send_now(now):
+            continue
+        due.append((user_id, pref))
+    return due
+
+
+def _digest_email(user, notifications, frequency):
+    total = len(notifications)
+    context = {
+        'user': user,
+        'notifications': notifications[:MAX_DIGEST_ITEMS],
+        'remaining': max(total - MAX_DIGEST_ITEMS, 0),
+        'total': total,
+        'frequency': frequency,
+    }
+    html_content = render_to_string('emails/notification_digest.html', context)
+    email = EmailMultiAlternatives(
+        subject=f"Your VitaNips digest: {total} new notification{'s' if total != 1 else ''}",
+        body=strip_tags(html_content),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[user.email],
+    )
+    email.attach_alternative(html_content, "text/html")
+    return email
+
+
+def _digest_push(notifications):
+    if len(notifications) == 1:
+        return notifications[0].title, notifications[0].verb
+    return "Your VitaNips digest", f"You have {len(notifications)} new notifications"
+
+
+def _send_batch(batch, now):
+    """Send the digests for one batch of (user_id, pref); returns the number of users reached."""
+    prefs = dict(batch)
+    with transaction.atomic():
+        # Items held by an overlapping run are skipped, so no item is digested twice.
+        items = list(
+            PendingDigestItem.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(user_id__in=prefs)
+            .select_related('user', 'notification')
+            .order_by('user_id', 'notification_id')
+        )
+        return _send_items(items, prefs, now)
+
+
+def _send_items(items, prefs, now):
+    by_user = {}
+    for item in items:
+        by_user.setdefault(item.user_id, (item.user, []))[1].append(item)
+
+    fcm_devices = {}
+    apns_devices = {}
+    for device in GCMDevice.objects.filter(user_id__in=by_user, active=True):
+        fcm_devices.setdefault(device.user_id, []).append(device)
+    for device in APNSDevice.objects.filter(user_id__in=by_user, active=True):
+        apns_devices.setdefault(device.user_id, []).append(device)
+
+    results = {}  # (user_id, channel) -> error message, '' when sent
+    covered = {}  # (user_id, channel) -> items included in that digest
+    fcm_jobs = []
+    for user_id, (user, user_items) in by_user.items():
+        pref = prefs[user_id] or NotificationPreference(user_id=user_id)
+        frequency = pref.get_digest_frequency_display().lower()
+
+        def wanted(channel):
+            # Channels a previous attempt already delivered are not sent again.
+            return [
+                item for item in user_items
+                if channel not in item.sent_channels
+                and pref.get_channel_preference(item.notification.category, channel)
+            ]
+
+        emailed = wanted('email')
+        if pref.email_enabled and user.email and emailed:
+            covered[(user_id, 'email')] = emailed
+            try:
+                send_email_messages([_digest_email(user, [item.notification for item in emailed], frequency)])
+                results[(user_id, 'email')] = ''
+            except Exception as e:
+                logger.error(f"Error sending digest email to user {user_id}: {e}")
+                results[(user_id, 'email')] = str(e)
+
+        pushed = wanted('push')
+        if pref.push_enabled and pushed and (fcm_devices.get(user_id) or apns_devices.get(user_id)):
+            title, body = _digest_push([item.notification for item in pushed])
+            data = {'category': 'digest', 'count': str(len(pushed))}
+            results[(user_id, 'push')] = ''
+            covered[(user_id, 'push')] = pushed
+            for device in fcm_devices.get(user_id, []):
+                fcm_jobs.append((DigestPush(user_id), device, title, body, data))
+            if apns_devices.get(user_id):
+                try:
+                    APNSDevice.objects.filter(pk__in=[device.pk for device in apns_devices[user_id]]).send_message(
+                        message={"title": title, "body": body},
+                        extra=data
+                    )
+                except Exception as e:
+                    results[(user_id, 'push')] = str(e)
+    for user_id, error in _send_fcm(fcm_jobs).items():
+        results[(user_id, 'push')] = error
+
+    failed = {}  # item pk -> {channel: error}
+    for (user_id, channel), channel_items in covered.items():
+        error = results[(user_id, channel)]
+        for item in channel_items:
+            if error:
+                failed.setdefault(item.pk, {})[channel] = error
+            else:
+                item.sent_channels.append(channel)
+
+    # Items whose digest failed are kept for the next run, up to
+    # DIGEST_MAX_ATTEMPTS; delivery rows record each channel's final outcome.
+    deliveries = []
+    done = []
+    retry = []
+    for item in items:
+        errors = failed.get(item.pk, {})
+        if errors:
+            item.attempts += 1
+            if item.attempts < DIGEST_MAX_ATTEMPTS:
+                retry.append(item)
+                continue
+            logger.warning(f"Giving up on digest item {item.pk} after {item.attempts} attempts")
+        done.append(item)
+        for channel in item.sent_channels:
+            deliveries.append(NotificationDelivery(
+                notification=item.notification, channel=channel, status='sent', sent_at=now,
+                provider_response={'digest': True},
+            ))
+        for channel, error in errors.items():
+            deliveries.append(NotificationDelivery(
+                notification=item.notification, channel=channel, status='dead_letter', failed_at=now,
+                error_message=error, retry_count=item.attempts, provider_response={'digest': True},
+            ))
+    NotificationDelivery.objects.bulk_create(deliveries)
+    PendingDigestItem.objects.filter(pk__in=[item.pk for item in done]).delete()
+    if retry:
+        PendingDigestItem.objects.bulk_update(retry, ['sent_channels', 'attempts'])
+
+    # A user's digest period restarts once nothing of theirs is left to retry.
+    retrying = {item.user_id for item in retry}
+    NotificationPreference.objects.filter(user_id__in=set(by_user) - retrying).update(last_digest_sent_at=now)
+    return sum(1 for user_id in by_user if '' in (results.get((user_id, 'email')), results.get((user_id, 'push'))))
+
+
+def send_due_digests(batch_size=DIGEST_BATCH_SIZE):
+    """Send every digest that is due; returns the number of users who got one."""
+    now = timezone.now()
+    due = due_digest_users(now)
+    sent = 0
+    for batch in _chunks(due, batch_size):
+        sent += _send_batch(batch, now)
+    if due:
+        logger.info(f"Sent notification digests to {sent} of {len(due)} users")
+    return sent
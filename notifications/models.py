@@ -1,9 +1,14 @@
 # notifications/models.py
+import calendar
+from datetime import date, datetime, time, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from django.db import models
 from django.conf import settings
 from django.utils import timezone
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.template import Context as DjangoContext
+from .template_cache import CHANNEL_FIELDS, compiled_templates
 
 
 class NotificationTemplate(models.Model):
@@ -44,30 +49,32 @@ class NotificationTemplate(models.Model):
     def __str__(self):
         return f"{self.name} ({self.template_type})"
     
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        compiled_templates.invalidate(self.pk)
+
     def render(self, context, channel='email'):
         """Render template with context variables"""
-        from django.template import Template, Context as DjangoContext
-        
-        if channel == 'email':
-            subject_template = Template(self.email_subject)
-            body_template = Template(self.email_body_html)
-            return {
-                'subject': subject_template.render(DjangoContext(context)),
-                'body': body_template.render(DjangoContext(context))
-            }
-        elif channel == 'sms':
-            sms_template = Template(self.sms_body)
-            return sms_template.render(DjangoContext(context))
-        elif channel == 'push':
-            title_template = Template(self.push_title)
-            body_template = Template(self.push_body)
-            return {
-                'title': title_template.render(DjangoContext(context)),
-                'body': body_template.render(DjangoContext(context))
-            }
-        elif channel == 'in_app':
-            message_template = Template(self.in_app_message)
-            return message_template.render(DjangoContext(context))
+        return self.render_many([context], channel=channel)[0]
+
+    def render_many(self, contexts, channel='email'):
+        """Render the template for each context, fetching the compiled fields once."""
+        fields = CHANNEL_FIELDS.get(channel)
+        if fields is None:
+            return [None for _ in contexts]
+        compiled = [compiled_templates.get(self, channel, field) for field in fields]
+
+        rendered = []
+        for context in contexts:
+            context = DjangoContext(context)
+            values = [template.render(context) for template in compiled]
+            if channel == 'email':
+                rendered.append({'subject': values[0], 'body': values[1]})
+            elif channel == 'push':
+                rendered.append({'title': values[0], 'body': values[1]})
+            else:
+                rendered.append(values[0])
+        return rendered
 
 
 class Notification(models.Model):
@@ -148,29 +155,46 @@ class Notification(models.Model):
         ordering = ['-timestamp']
         indexes = [
             models.Index(fields=['recipient', 'unread', '-timestamp']),
-            models.Index(fields=['recipient', 'category', '-timestamp']),
+            # Inbox cursor pagination: (recipient, dismissed) then (-timestamp, -id).
+            models.Index(fields=['recipient', 'dismissed', '-timestamp', '-id']),
+            models.Index(fields=['recipient', 'dismissed', 'category', '-timestamp', '-id']),
             models.Index(fields=['scheduled_for']),
         ]
 
     def __str__(self):
         return f"{self.recipient.email} - {self.title}"
 
+    # The state changes below are conditional UPDATEs so that concurrent calls
+    # adjust the unread counters exactly once.
+
     def mark_as_read(self):
-        if self.unread:
-            self.unread = False
-            self.read_at = timezone.now()
-            self.save(update_fields=['unread', 'read_at'])
+        from .counters import record_read
+
+        now = timezone.now()
+        if Notification.objects.filter(pk=self.pk, unread=True).update(unread=False, read_at=now):
+            if not self.dismissed:
+                record_read(self)
+        self.unread = False
+        self.read_at = self.read_at or now
     
     def mark_as_unread(self):
-        if not self.unread:
-            self.unread = True
-            self.read_at = None
-            self.save(update_fields=['unread', 'read_at'])
+        from .counters import record_read
+
+        if Notification.objects.filter(pk=self.pk, unread=False).update(unread=True, read_at=None):
+            if not self.dismissed:
+                record_read(self, delta=1)
+        self.unread = True
+        self.read_at = None
     
     def dismiss(self):
+        from .counters import record_read
+
+        now = timezone.now()
+        if Notification.objects.filter(pk=self.pk, dismissed=False).update(dismissed=True, dismissed_at=now):
+            if self.unread:
+                record_read(self)
         self.dismissed = True
-        self.dismissed_at = timezone.now()
-        self.save(update_fields=['dismissed', 'dismissed_at'])
+        self.dismissed_at = self.dismissed_at or now
 
 
 class NotificationDelivery(models.Model):
@@ -185,9 +209,12 @@ class NotificationDelivery(models.Model):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
         ('queued', 'Queued'),
+        ('sending', 'Sending'),
         ('sent', 'Sent'),
         ('delivered', 'Delivered'),
         ('failed', 'Failed'),
+        ('dead_letter', 'Dead Letter'),
+        ('rate_limited', 'Rate Limited'),
         ('bounced', 'Bounced'),
         ('clicked', 'Clicked'),
     ]
@@ -224,6 +251,8 @@ class NotificationDelivery(models.Model):
         indexes = [
             models.Index(fields=['notification', 'channel']),
             models.Index(fields=['status', 'next_retry_at']),
+            models.Index(fields=['channel', 'status', 'created_at']),
+            models.Index(fields=['external_id']),
         ]
     
     def __str__(self):
@@ -243,6 +272,9 @@ class NotificationPreference(models.Model):
     sms_enabled = models.BooleanField(default=False)
     push_enabled = models.BooleanField(default=True)
     
+    # IANA time zone used for quiet hours and digest times
+    timezone = models.CharField(max_length=64, default=settings.TIME_ZONE)
+    
     # Quiet hours
     quiet_hours_enabled = models.BooleanField(default=False)
     quiet_hours_start = models.TimeField(null=True, blank=True)
@@ -264,22 +296,43 @@ class NotificationPreference(models.Model):
         default='daily'
     )
     digest_time = models.TimeField(default='09:00')
+    last_digest_sent_at = models.DateTimeField(null=True, blank=True)
     
     updated_at = models.DateTimeField(auto_now=True)
     
     def __str__(self):
         return f"Preferences for {self.user.email}"
     
-    def should_send_now(self):
+    @property
+    def tzinfo(self):
+        try:
+            return ZoneInfo(self.timezone)
+        except (ZoneInfoNotFoundError, ValueError):
+            return timezone.get_default_timezone()
+
+    def local_now(self, now=None):
+        """The current (or given) time in the user's time zone."""
+        return timezone.localtime(now or timezone.now(), self.tzinfo)
+
+    def should_send_now(self, now=None):
         """Check if notification should be sent based on quiet hours"""
-        if not self.quiet_hours_enabled:
+        if not self.quiet_hours_enabled or self.quiet_hours_start is None or self.quiet_hours_end is None:
             return True
         
-        now = timezone.localtime(timezone.now()).time()
+        now = self.local_now(now).time()
         if self.quiet_hours_start < self.quiet_hours_end:
-            return not (self.quiet_hours_start <= now <= self.quiet_hours_end)
+            return not (self.quiet_hours_start <= now < self.quiet_hours_end)
         else:  # Quiet hours span midnight
-            return not (self.quiet_hours_start <= now or now <= self.quiet_hours_end)
+            return not (self.quiet_hours_start <= now or now < self.quiet_hours_end)
+
+    def quiet_hours_release_at(self, now=None):
+        """The next time quiet hours end, as an aware datetime in the user's time zone."""
+        local_now = self.local_now(now)
+        end = self.quiet_hours_end
+        release_at = local_now.replace(hour=end.hour, minute=end.minute, second=end.second, microsecond=0)
+        if release_at <= local_now:
+            release_at += timedelta(days=1)
+        return release_at
     
     def get_channel_preference(self, category, channel):
         """Get user preference for specific category and channel"""
@@ -323,6 +376,225 @@ class NotificationSchedule(models.Model):
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    # Longest gap between two occurrences (monthly on the 31st) is well under this.
+    MAX_LOOKAHEAD_DAYS = 400
     
     def __str__(self):
-        return f"{self.template.name} for {self.user.email} - {self.frequency}"
\ No newline at end of file
+        return f"{self.template.name} for {self.user.email} - {self.frequency}"
+
+    def save(self, *args, **kwargs):
+        # A new (or re-activated, never sent) schedule gets its first send time.
+        if self.is_active and self.next_send_at is None and self.last_sent_at is None:
+            self.next_send_at = self.next_occurrence(timezone.now(), self.user_tzinfo())
+        super().save(*args, **kwargs)
+
+    def user_tzinfo(self):
+        pref = NotificationPreference.objects.filter(user_id=self.user_id).first()
+        return pref.tzinfo if pref else timezone.get_default_timezone()
+
+    def runs_on(self, day):
+        """
+        Whether the schedule fires on a local date. days_of_week narrows daily
+        schedules and picks the weekdays of weekly ones (default: the start
+        date's weekday); monthly schedules fire on the start date's day of
+        the month, or the last day of shorter months.
+        """
+        start_date = self.start_date
+        if isinstance(start_date, str):
+            start_date = date.fromisoformat(start_date)
+        if day < start_date or (self.end_date and day > self.end_date):
+            return False
+        days_of_week = [int(weekday) for weekday in self.days_of_week or []]
+        if self.frequency == 'once':
+            return day == start_date
+        if self.frequency == 'daily':
+            return not days_of_week or day.weekday() in days_of_week
+        if self.frequency == 'weekly':
+            return day.weekday() in (days_of_week or [start_date.weekday()])
+        if self.frequency == 'monthly':
+            return day.day == min(start_date.day, calendar.monthrange(day.year, day.month)[1])
+        return False
+
+    def next_occurrence(self, after, tzinfo=None):
+        """
+        The first send time strictly after `after`: time_of_day on the next
+        date the schedule runs on, in tzinfo (the user's time zone). None once
+        the schedule is over (a sent one-time schedule, or past end_date).
+        """
+        tzinfo = tzinfo or timezone.get_default_timezone()
+        time_of_day = self.time_of_day
+        if isinstance(time_of_day, str):
+            time_of_day = time.fromisoformat(time_of_day)
+        start_date = self.start_date
+        if isinstance(start_date, str):
+            start_date = date.fromisoformat(start_date)
+        first_day = max(timezone.localtime(after, tzinfo).date(), start_date)
+        for offset in range(self.MAX_LOOKAHEAD_DAYS):
+            day = first_day + timedelta(days=offset)
+            if self.end_date and day > self.end_date:
+                return None
+            if not self.runs_on(day):
+                continue
+            candidate = datetime.combine(day, time_of_day, tzinfo=tzinfo)
+            if candidate > after:
+                return candidate
+        return None
+
+
+class UnreadNotificationCounter(models.Model):
+    """
+    Per-user count of unread, non-dismissed notifications, overall and per
+    category. Maintained incrementally by notifications.counters and
+    reconciled periodically against the Notification table.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='unread_notification_counter'
+    )
+    total = models.IntegerField(default=0)
+    appointment = models.IntegerField(default=0)
+    prescription = models.IntegerField(default=0)
+    medication = models.IntegerField(default=0)
+    order = models.IntegerField(default=0)
+    health = models.IntegerField(default=0)
+    emergency = models.IntegerField(default=0)
+    system = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Unread notifications for user {self.user_id}: {self.total}"
+
+
+class PendingDigestItem(models.Model):
+    """
+    A notification whose email/push delivery is held for the recipient's next
+    digest. Rows are deleted once the digest goes out (or is given up on).
+    """
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    notification = models.OneToOneField(
+        Notification,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    # Channels already delivered by a digest attempt whose other channel failed.
+    sent_channels = models.JSONField(default=list, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"Digest item {self.notification_id} for user {self.user_id}"
+
+
+class DeferredNotification(models.Model):
+    """
+    A notification held back by the recipient's quiet hours, released for
+    delivery at release_at by a scheduled sweep.
+    """
+    notification = models.OneToOneField(
+        Notification,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    release_at = models.DateTimeField(db_index=True)
+    # External channels to plan on release; null means every channel plus in-app.
+    channels = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Notification {self.notification_id} deferred until {self.release_at}"
+
+
+class NotificationRateCounter(models.Model):
+    """
+    Messages sent per user, channel and local day; the database fallback for
+    notifications.rate_limits when Redis is not available.
+    """
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    channel = models.CharField(max_length=20)
+    day = models.DateField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'channel', 'day')
+
+    def __str__(self):
+        return f"{self.channel} for user {self.user_id} on {self.day}: {self.count}"
+
+
+class ReminderLedger(models.Model):
+    """
+    One row per reminder sent, so scheduled checks can dedupe with a unique
+    index instead of searching Notification.metadata.
+    """
+    KIND_CHOICES = [
+        ('appointment', 'Appointment'),
+        ('medication_refill', 'Medication Refill'),
+    ]
+
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES)
+    object_id = models.PositiveIntegerField()
+    reminder_type = models.CharField(max_length=20)
+    # What the reminder is for, e.g. the appointment time, so a rescheduled
+    # appointment gets fresh reminders.
+    window_key = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['kind', 'object_id', 'reminder_type', 'window_key'],
+                name='unique_reminder_ledger_entry'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id} {self.reminder_type} ({self.window_key})"
+
+
+class RetentionCheckpoint(models.Model):
+    """Progress of a chunked retention run, so an interrupted run resumes where it stopped."""
+    name = models.CharField(max_length=50, unique=True)
+    cutoff = models.DateTimeField(null=True, blank=True)
+    last_id = models.BigIntegerField(default=0)
+    deleted = models.BigIntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} retention up to id {self.last_id}"
+
+
+class DeliveryStatusEvent(models.Model):
+    """
+    A provider delivery-status callback (Twilio SMS status, email bounce or
+    delivery event) waiting to be applied to its NotificationDelivery by
+    notifications.status_callbacks. Webhooks only insert these rows.
+    """
+    channel = models.CharField(max_length=20, choices=NotificationDelivery.CHANNEL_CHOICES)
+    external_id = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=NotificationDelivery.STATUS_CHOICES)
+    error_message = models.TextField(blank=True)
+    payload = models.JSONField(default=dict, blank=True)
+    received_at = models.DateTimeField(default=timezone.now)
+    # Events for deliveries not saved yet are retried from this time.
+    process_after = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.channel} {self.external_id}: {self.status}"
@@ -0,0 +1,111 @@
+# notifications/rate_limits.py
+"""
+Per-user daily limits for outbound email and SMS.
+
+NotificationPreference.max_daily_emails / max_daily_sms cap how many messages
+a user receives per channel per local day. consume() reserves slots for a
+whole batch at once: with Redis it is one pipelined INCRBY per (user, channel)
+key, so workers racing on the same user each get a disjoint range of the
+count; without Redis (or when it is unreachable) the same reservation is made
+on NotificationRateCounter rows under SELECT FOR UPDATE. Either way a check is
+O(1) per user and channel.
+"""
+import logging
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import NotificationRateCounter
+
+logger = logging.getLogger(__name__)
+
+LIMITED_CHANNELS = ('email', 'sms')
+KEY_TTL = 60 * 60 * 48  # seconds; outlives a local day in any time zone
+
+_redis = None
+
+
+def channel_limit(pref, channel):
+    return {'email': pref.max_daily_emails, 'sms': pref.max_daily_sms}[channel]
+
+
+def _get_redis():
+    global _redis
+    url = getattr(settings, 'NOTIFICATION_RATE_LIMIT_REDIS_URL', '')
+    if not url:
+        return None
+    if _redis is None:
+        import redis
+
+        _redis = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+    return _redis
+
+
+def _redis_consume(client, wanted):
+    pipe = client.pipeline(transaction=False)
+    for (user_id, channel, day), count in wanted.items():
+        key = f"notifications:rate:{user_id}:{channel}:{day.isoformat()}"
+        pipe.incrby(key, count)
+        pipe.expire(key, KEY_TTL)
+    totals = pipe.execute()[::2]
+    return dict(zip(wanted, totals))
+
+
+def _db_consume(wanted):
+    with transaction.atomic():
+        NotificationRateCounter.objects.bulk_create(
+            [NotificationRateCounter(user_id=user_id, channel=channel, day=day) for user_id, channel, day in wanted],
+            ignore_conflicts=True,
+        )
+        # Lock in primary key order so concurrent batches cannot deadlock.
+        rows = NotificationRateCounter.objects.select_for_update().filter(
+            user_id__in={key[0] for key in wanted}, day__in={key[2] for key in wanted}
+        ).order_by('pk')
+        totals = {}
+        by_delta = {}
+        for row in rows:
+            key = (row.user_id, row.channel, row.day)
+            if key in wanted:
+                totals[key] = row.count + wanted[key]
+                by_delta.setdefault(wanted[key], []).append(row.pk)
+        for delta, pks in by_delta.items():
+            NotificationRateCounter.objects.filter(pk__in=pks).update(count=F('count') + delta)
+    return totals
+
+
+def consume(requests):
+    """
+    requests: list of (user_id, channel, local day, limit), one per message.
+    Reserves a slot for each message in order and returns a parallel list of
+    booleans: False for messages over the user's daily limit.
+    """
+    if not requests:
+        return []
+    wanted = Counter((user_id, channel, day) for user_id, channel, day, _ in requests)
+
+    totals = None
+    client = _get_redis()
+    if client is not None:
+        try:
+            totals = _redis_consume(client, wanted)
+        except Exception as e:
+            logger.warning(f"Redis rate limiter unavailable, using the database: {e}")
+    if totals is None:
+        totals = _db_consume(wanted)
+
+    # Slots reserved by this call are the top `wanted` of each total.
+    used = {key: totals[key] - wanted[key] for key in wanted}
+    allowed = []
+    for user_id, channel, day, limit in requests:
+        key = (user_id, channel, day)
+        used[key] += 1
+        allowed.append(used[key] <= limit)
+    return allowed
+
+
+def prune_counters(now=None):
+    """Delete database counters for days that are over everywhere."""
+    cutoff = (now or timezone.now()).date() - timedelta(days=2)
+    return NotificationRateCounter.objects.filter(day__lt=cutoff).delete()[0]
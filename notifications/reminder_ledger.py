@@ -0,0 +1,56 @@
+# notifications/reminder_ledger.py
+"""
+Dedupe ledger for scheduled reminders.
+
+claim_reminders() inserts every candidate of a tick with a single
+INSERT ... ON CONFLICT DO NOTHING RETURNING against the unique
+(kind, object_id, reminder_type, window_key) constraint, and returns only the
+rows it inserted: those reminders have not been sent before and the caller
+owns sending them. Concurrent ticks can never both claim the same reminder.
+"""
+import logging
+from django.db import connection
+from django.utils import timezone
+from .models import ReminderLedger
+
+logger = logging.getLogger(__name__)
+
+INSERT_BATCH_SIZE = 1000
+
+
+def _insert_sql(rows):
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(column) for column in ('kind', 'object_id', 'reminder_type', 'window_key', 'created_at'))
+    placeholders = ', '.join(['(%s, %s, %s, %s, %s)'] * rows)
+    return (
+        f"INSERT INTO {quote(ReminderLedger._meta.db_table)} ({columns}) VALUES {placeholders} "
+        f"ON CONFLICT DO NOTHING RETURNING {quote('object_id')}, {quote('reminder_type')}, {quote('window_key')}"
+    )
+
+
+def claim_reminders(kind, candidates):
+    """
+    candidates: iterable of (object_id, reminder_type, window_key). Returns the
+    set of those tuples that were not in the ledger and are now claimed.
+    """
+    candidates = list(dict.fromkeys((int(o), str(r), str(w)) for o, r, w in candidates))
+    claimed = set()
+    now = timezone.now()
+    for start in range(0, len(candidates), INSERT_BATCH_SIZE):
+        chunk = candidates[start:start + INSERT_BATCH_SIZE]
+        params = []
+        for object_id, reminder_type, window_key in chunk:
+            params.extend([kind, object_id, reminder_type, window_key, now])
+        with connection.cursor() as cursor:
+            cursor.execute(_insert_sql(len(chunk)), params)
+            claimed.update(tuple(row) for row in cursor.fetchall())
+    if candidates:
+        logger.debug(f"Claimed {len(claimed)} of {len(candidates)} {kind} reminders")
+    return claimed
+
+
+def release_reminder(kind, object_id, reminder_type, window_key):
+    """Forget a claim whose reminder could not be queued, so the next tick retries it."""
+    ReminderLedger.objects.filter(
+        kind=kind, object_id=object_id, reminder_type=reminder_type, window_key=window_key
+    ).delete()
@@ -0,0 +1,83 @@
+# notifications/retention.py
+"""
+Chunked retention for notifications.
+
+Read notifications older than NOTIFICATION_RETENTION_DAYS are deleted in
+primary-key order, NOTIFICATION_RETENTION_CHUNK_SIZE at a time, each chunk in
+its own short transaction: delivery rows first with one DELETE, then the
+notifications. A RetentionCheckpoint records the cutoff and the last id
+handled after every chunk, so a run stopped by max_chunks, a deploy or a
+killed worker resumes from there instead of rescanning. A new run (with a
+fresh cutoff) starts once the previous one has completed.
+"""
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Notification, NotificationDelivery, RetentionCheckpoint
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_NAME = 'notifications'
+
+
+def _expired(cutoff):
+    return Notification.objects.filter(unread=False, timestamp__lt=cutoff)
+
+
+def _start_run(checkpoint, now):
+    checkpoint.cutoff = now - timedelta(days=settings.NOTIFICATION_RETENTION_DAYS)
+    checkpoint.last_id = 0
+    checkpoint.deleted = 0
+    checkpoint.started_at = now
+    checkpoint.completed_at = None
+    checkpoint.save()
+
+
+def delete_chunk(checkpoint, chunk_size):
+    """Delete the next chunk after the checkpoint; returns the number of notifications deleted."""
+    with transaction.atomic():
+        ids = list(
+            _expired(checkpoint.cutoff).filter(pk__gt=checkpoint.last_id)
+            .order_by('pk').values_list('pk', flat=True)[:chunk_size]
+        )
+        if not ids:
+            return 0
+        # Deliveries have no dependants, so this is a single DELETE.
+        NotificationDelivery.objects.filter(notification_id__in=ids).delete()
+        deleted = Notification.objects.filter(pk__in=ids).delete()[1].get(Notification._meta.label, 0)
+        checkpoint.last_id = ids[-1]
+        checkpoint.deleted += deleted
+        checkpoint.save(update_fields=['last_id', 'deleted', 'updated_at'])
+    return deleted
+
+
+def purge_old_notifications(chunk_size=None, max_chunks=None):
+    """
+    Run (or resume) retention for at most max_chunks chunks. Returns the
+    number of notifications deleted by this call.
+    """
+    chunk_size = chunk_size or settings.NOTIFICATION_RETENTION_CHUNK_SIZE
+    max_chunks = max_chunks or settings.NOTIFICATION_RETENTION_MAX_CHUNKS
+    now = timezone.now()
+    checkpoint, _ = RetentionCheckpoint.objects.get_or_create(name=CHECKPOINT_NAME)
+    if checkpoint.cutoff is None or checkpoint.completed_at is not None:
+        _start_run(checkpoint, now)
+    elif checkpoint.last_id:
+        logger.info(f"Resuming notification retention after id {checkpoint.last_id}")
+
+    deleted = 0
+    for _ in range(max_chunks):
+        count = delete_chunk(checkpoint, chunk_size)
+        if not count:
+            checkpoint.completed_at = timezone.now()
+            checkpoint.save(update_fields=['completed_at', 'updated_at'])
+            break
+        deleted += count
+
+    logger.info(
+        f"Notification retention deleted {deleted} rows "
+        f"({checkpoint.deleted} this run, {'complete' if checkpoint.completed_at else f'up to id {checkpoint.last_id}'})"
+    )
+    return deleted
@@ -0,0 +1,79 @@
+# notifications/schedules.py
+"""
+Processing of recurring NotificationSchedules.
+
+process_due_schedules() claims active schedules whose next_send_at has passed
+with SKIP LOCKED, a batch at a time, creates their notifications with one bulk
+insert and moves every schedule on to its next occurrence (see
+NotificationSchedule.next_occurrence) with one bulk_update, all in the same
+transaction. Occurrences missed while the processor was down are not
+backfilled: a schedule sends once and continues from the next occurrence after
+now. Schedules with no further occurrence are deactivated.
+"""
+import logging
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .counters import record_created
+from .models import Notification, NotificationPreference, NotificationSchedule
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_UPDATE_FIELDS = ['last_sent_at', 'total_sent', 'next_send_at', 'is_active', 'updated_at']
+
+
+def build_notification(schedule):
+    template = schedule.template
+    return Notification(
+        recipient=schedule.user,
+        template=template,
+        title=template.push_title,
+        verb=template.in_app_message,
+        category='system',
+        metadata=schedule.context_data,
+    )
+
+
+def advance(schedule, now, tzinfo=None):
+    """Record a send at now and move next_send_at to the following occurrence."""
+    schedule.last_sent_at = now
+    schedule.total_sent += 1
+    schedule.next_send_at = schedule.next_occurrence(now, tzinfo)
+    if schedule.next_send_at is None:
+        schedule.is_active = False
+    schedule.updated_at = now
+
+
+def process_due_schedules(dispatch, batch_size=None, max_batches=20):
+    """
+    Send every due schedule. dispatch(notification_ids) is called after each
+    batch commits to queue delivery. Returns the number of notifications created.
+    """
+    batch_size = batch_size or settings.NOTIFICATION_DELIVERY_BATCH_SIZE
+    created = 0
+    for _ in range(max_batches):
+        now = timezone.now()
+        with transaction.atomic():
+            schedules = list(
+                NotificationSchedule.objects.select_for_update(skip_locked=True, of=('self',))
+                .filter(is_active=True, next_send_at__lte=now)
+                .select_related('user', 'template')
+                .order_by('next_send_at')[:batch_size]
+            )
+            if not schedules:
+                break
+            tzinfos = {
+                pref.user_id: pref.tzinfo
+                for pref in NotificationPreference.objects.filter(user_id__in={s.user_id for s in schedules})
+            }
+            notifications = Notification.objects.bulk_create([build_notification(s) for s in schedules])
+            record_created(notifications)
+            for schedule in schedules:
+                advance(schedule, now, tzinfos.get(schedule.user_id))
+            NotificationSchedule.objects.bulk_update(schedules, SCHEDULE_UPDATE_FIELDS)
+        dispatch([notification.pk for notification in notifications])
+        created += len(notifications)
+        logger.info(f"Sent {len(notifications)} scheduled notifications")
+        if len(schedules) < batch_size:
+            break
+    return created
@@ -1,4 +1,5 @@
 # notifications/serializers.py
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from rest_framework import serializers
 from .models import Notification, NotificationPreference, NotificationDelivery
 
@@ -9,21 +10,28 @@ class NotificationDeliverySerializer(serializers.ModelSerializer):
         fields = ['id', 'channel', 'status', 'sent_at', 'delivered_at', 'error_message']
 
 
-class NotificationSerializer(serializers.ModelSerializer):
-    actor_name = serializers.SerializerMethodField()
+class NotificationListSerializer(serializers.ModelSerializer):
+    """
+    Inbox row: no delivery history (see the deliveries endpoint) and no actor
+    lookup; actor_name is only included with include_actor=True.
+    """
     time_ago = serializers.SerializerMethodField()
-    deliveries = NotificationDeliverySerializer(many=True, read_only=True)
-    
+
     class Meta:
         model = Notification
         fields = [
             'id', 'title', 'verb', 'level', 'category',
             'action_url', 'action_text',
-            'actor_name', 'unread', 'read_at',
-            'timestamp', 'time_ago', 'deliveries', 'metadata'
+            'unread', 'read_at',
+            'timestamp', 'time_ago', 'metadata'
         ]
         read_only_fields = fields
-    
+
+    def __init__(self, *args, include_actor=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        if include_actor:
+            self.fields['actor_name'] = serializers.SerializerMethodField()
+
     def get_actor_name(self, obj):
         if obj.actor:
             return obj.actor.get_full_name() or obj.actor.email
@@ -34,14 +42,45 @@ class NotificationSerializer(serializers.ModelSerializer):
         return timesince(obj.timestamp)
 
 
+class NotificationSerializer(NotificationListSerializer):
+    actor_name = serializers.SerializerMethodField()
+    deliveries = NotificationDeliverySerializer(many=True, read_only=True)
+    
+    class Meta:
+        model = Notification
+        fields = [
+            'id', 'title', 'verb', 'level', 'category',
+            'action_url', 'action_text',
+            'actor_name', 'unread', 'read_at',
+            'timestamp', 'time_ago', 'deliveries', 'metadata'
+        ]
+        read_only_fields = fields
+
+
+class NotificationBroadcastSerializer(NotificationSerializer):
+    """Websocket frame for a newly created notification, which has no deliveries yet."""
+    deliveries = None
+
+    class Meta(NotificationSerializer.Meta):
+        fields = [field for field in NotificationSerializer.Meta.fields if field != 'deliveries']
+        read_only_fields = fields
+
+
 class NotificationPreferenceSerializer(serializers.ModelSerializer):
     class Meta:
         model = NotificationPreference
         fields = [
             'email_enabled', 'sms_enabled', 'push_enabled',
-            'quiet_hours_enabled', 'quiet_hours_start', 'quiet_hours_end',
+            'timezone', 'quiet_hours_enabled', 'quiet_hours_start', 'quiet_hours_end',
             'category_preferences',
             'max_daily_emails', 'max_daily_sms',
             'digest_enabled', 'digest_frequency', 'digest_time',
             'updated_at'
-        ]
\ No newline at end of file
+        ]
+
+    def validate_timezone(self, value):
+        try:
+            ZoneInfo(value)
+        except (ZoneInfoNotFoundError, ValueError):
+            raise serializers.ValidationError("Unknown time zone.")
+        return value
\ No newline at end of file
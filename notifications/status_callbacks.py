@@ -0,0 +1,162 @@
+# notifications/status_callbacks.py
+"""
+Provider delivery-status callbacks.
+
+Webhooks validate a callback, map the provider's status onto
+NotificationDelivery.STATUS_CHOICES and insert a DeliveryStatusEvent -- one
+INSERT per request, however many arrive. apply_status_events() drains the
+events in batches: claim with SKIP LOCKED, load the matching deliveries by
+external_id with one query, apply every event in memory, then one bulk_update
+and one DELETE. A status never moves backwards (a late 'sent' does not undo
+'delivered'), and deliveries that are queued, in flight or dead-lettered are
+left alone. Events that arrive before the sender saved the delivery's
+external_id are retried for UNMATCHED_TTL, then dropped.
+"""
+import hashlib
+import hmac
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import DeliveryStatusEvent, NotificationDelivery
+
+logger = logging.getLogger(__name__)
+
+TWILIO_STATUSES = {
+    'sent': 'sent',
+    'delivered': 'delivered',
+    'undelivered': 'failed',
+    'failed': 'failed',
+}
+EMAIL_EVENTS = {
+    'delivered': 'delivered',
+    'delivery': 'delivered',
+    'bounce': 'bounced',
+    'bounced': 'bounced',
+    'dropped': 'failed',
+    'failed': 'failed',
+    'click': 'clicked',
+    'clicked': 'clicked',
+}
+# Higher ranks win; equal ranks keep the first outcome. Deliveries in any other
+# status (queued, sending, dead_letter, rate_limited, ...) are not a sent
+# message's outcome and are never changed by a callback.
+STATUS_RANK = {'sent': 1, 'delivered': 2, 'clicked': 3, 'failed': 3, 'bounced': 3}
+UNMATCHED_TTL = timedelta(hours=1)
+UNMATCHED_RETRY_AFTER = timedelta(minutes=1)
+DELIVERY_UPDATE_FIELDS = [
+    'status', 'delivered_at', 'failed_at', 'clicked_at', 'error_message', 'provider_response', 'updated_at',
+]
+
+
+def normalize_message_id(message_id):
+    return (message_id or '').strip().strip('<>')
+
+
+def valid_email_signature(body, signature):
+    """HMAC-SHA256 of the raw request body with NOTIFICATION_EMAIL_WEBHOOK_SECRET, hex encoded."""
+    secret = settings.NOTIFICATION_EMAIL_WEBHOOK_SECRET
+    if not secret or not signature:
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def twilio_event(params):
+    """DeliveryStatusEvent for a Twilio message status callback, or None for statuses we don't track."""
+    status = TWILIO_STATUSES.get(params.get('MessageStatus', ''))
+    if status is None or not params.get('MessageSid'):
+        return None
+    error_code = params.get('ErrorCode') or ''
+    return DeliveryStatusEvent(
+        channel='sms',
+        external_id=params['MessageSid'],
+        status=status,
+        error_message=f"Twilio error {error_code}" if error_code else '',
+        payload=params,
+    )
+
+
+def email_events(items):
+    """DeliveryStatusEvents for email provider events ({'message_id', 'event', 'reason'} dicts)."""
+    events = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        status = EMAIL_EVENTS.get(str(item.get('event', '')).lower())
+        message_id = normalize_message_id(item.get('message_id'))
+        if status is None or not message_id:
+            continue
+        events.append(DeliveryStatusEvent(
+            channel='email',
+            external_id=message_id,
+            status=status,
+            error_message=str(item.get('reason') or '')[:1000],
+            payload=item,
+        ))
+    return events
+
+
+def apply_event(delivery, event, now):
+    """Apply one event to a delivery in memory; returns whether it changed."""
+    if delivery.status not in STATUS_RANK or STATUS_RANK[event.status] <= STATUS_RANK[delivery.status]:
+        return False
+    delivery.status = event.status
+    if event.status in ('delivered', 'clicked'):
+        delivery.delivered_at = delivery.delivered_at or event.received_at
+    if event.status == 'clicked':
+        delivery.clicked_at = event.received_at
+    if event.status in ('failed', 'bounced'):
+        delivery.failed_at = event.received_at
+        delivery.error_message = event.error_message or delivery.error_message
+    delivery.provider_response = {**(delivery.provider_response or {}), 'callback': event.payload}
+    delivery.updated_at = now
+    return True
+
+
+def _apply_batch(events, now):
+    deliveries = {
+        (delivery.channel, delivery.external_id): delivery
+        for delivery in NotificationDelivery.objects.filter(external_id__in={event.external_id for event in events})
+    }
+    changed = {}
+    unmatched = []
+    for event in events:
+        delivery = deliveries.get((event.channel, event.external_id))
+        if delivery is None:
+            if event.received_at > now - UNMATCHED_TTL:
+                unmatched.append(event.pk)
+            continue
+        if apply_event(delivery, event, now):
+            changed[delivery.pk] = delivery
+
+    if changed:
+        NotificationDelivery.objects.bulk_update(changed.values(), DELIVERY_UPDATE_FIELDS)
+    if unmatched:
+        DeliveryStatusEvent.objects.filter(pk__in=unmatched).update(process_after=now + UNMATCHED_RETRY_AFTER)
+    unmatched = set(unmatched)
+    DeliveryStatusEvent.objects.filter(pk__in=[event.pk for event in events if event.pk not in unmatched]).delete()
+    return len(changed)
+
+
+def apply_status_events(batch_size=None, max_batches=20):
+    """Apply queued delivery-status events in batches; returns the number of deliveries updated."""
+    batch_size = batch_size or settings.NOTIFICATION_DELIVERY_BATCH_SIZE
+    updated = 0
+    for _ in range(max_batches):
+        now = timezone.now()
+        with transaction.atomic():
+            events = list(
+                DeliveryStatusEvent.objects.select_for_update(skip_locked=True)
+                .filter(process_after__lte=now)
+                .order_by('id')[:batch_size]
+            )
+            if not events:
+                break
+            updated += _apply_batch(events, now)
+        if len(events) < batch_size:
+            break
+    if updated:
+        logger.info(f"Applied provider status callbacks to {updated} deliveries")
+    return updated
@@ -0,0 +1,70 @@
+# notifications/template_cache.py
+"""
+Process-wide LRU of compiled NotificationTemplate fields.
+
+Entries are keyed by (template id, channel, field, updated_at), so an edited
+template is recompiled on its next render even in processes that never saw the
+save; saving also evicts the template's entries in the saving process.
+Workers warm the cache with every active template when they start.
+"""
+import threading
+from collections import OrderedDict
+from django.template import Template
+
+# Template fields rendered for each channel.
+CHANNEL_FIELDS = {
+    'email': ('email_subject', 'email_body_html'),
+    'sms': ('sms_body',),
+    'push': ('push_title', 'push_body'),
+    'in_app': ('in_app_message',),
+}
+MAX_ENTRIES = 512
+
+
+class CompiledTemplateCache:
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, template, channel, field):
+        key = (template.pk, channel, field, template.updated_at)
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self._entries.move_to_end(key)
+                return compiled
+
+        compiled = Template(getattr(template, field))
+        with self._lock:
+            self._entries[key] = compiled
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return compiled
+
+    def invalidate(self, template_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == template_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+compiled_templates = CompiledTemplateCache()
+
+
+def warm_template_cache():
+    """Compile every field of every active template; returns the number of templates warmed."""
+    from .models import NotificationTemplate
+
+    templates = list(NotificationTemplate.objects.filter(is_active=True))
+    for template in templates:
+        for channel, fields in CHANNEL_FIELDS.items():
+            for field in fields:
+                compiled_templates.get(template, channel, field)
+    return len(templates)
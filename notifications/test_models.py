@@ -1,9 +1,14 @@
 # notifications/test_models.py
+from datetime import date, datetime, time, timezone as dt_timezone
+from zoneinfo import ZoneInfo
+from unittest.mock import patch
+from django.template import Template
 from django.test import TestCase
 from django.contrib.auth import get_user_model
 from faker import Faker
 from .models import NotificationTemplate, Notification, NotificationDelivery, NotificationPreference, NotificationSchedule
 from django.utils import timezone
+from .template_cache import compiled_templates, warm_template_cache
 
 User = get_user_model()
 fake = Faker()
@@ -56,6 +61,16 @@ class NotificationModelTests(TestCase):
         self.assertEqual(NotificationPreference.objects.count(), 1)
         self.assertTrue(preference.email_enabled)
 
+    def test_quiet_hours_use_the_users_time_zone(self):
+        preference = NotificationPreference.objects.create(
+            user=self.user, timezone='Africa/Lagos', quiet_hours_enabled=True,
+            quiet_hours_start=time(22, 0), quiet_hours_end=time(7, 0)
+        )
+        now = datetime(2026, 1, 10, 23, 30, tzinfo=dt_timezone.utc)  # 00:30 in Lagos
+        self.assertFalse(preference.should_send_now(now))
+        self.assertEqual(preference.quiet_hours_release_at(now), datetime(2026, 1, 11, 6, 0, tzinfo=dt_timezone.utc))
+        self.assertTrue(preference.should_send_now(datetime(2026, 1, 11, 6, 0, tzinfo=dt_timezone.utc)))
+
     def test_create_notification_schedule(self):
         schedule = NotificationSchedule.objects.create(
             user=self.user,
@@ -65,4 +80,60 @@ class NotificationModelTests(TestCase):
             start_date=timezone.now().date()
         )
         self.assertEqual(NotificationSchedule.objects.count(), 1)
-        self.assertTrue(schedule.is_active)
\ No newline at end of file
+        self.assertTrue(schedule.is_active)
+        self.assertIsNotNone(schedule.next_send_at)
+
+    def test_schedule_recurrence(self):
+        lagos = ZoneInfo('Africa/Lagos')
+        weekly = NotificationSchedule(
+            user=self.user, template=self.template, frequency='weekly', time_of_day=time(9, 0),
+            days_of_week=[0, 4], start_date=date(2026, 1, 1), end_date=date(2026, 1, 12)
+        )
+        # Thursday 1 Jan, 13:00 in Lagos: next is Friday, then Monday, then past end_date.
+        after = datetime(2026, 1, 1, 12, 0, tzinfo=dt_timezone.utc)
+        self.assertEqual(weekly.next_occurrence(after, lagos), datetime(2026, 1, 2, 8, 0, tzinfo=dt_timezone.utc))
+        after = datetime(2026, 1, 2, 8, 0, tzinfo=dt_timezone.utc)
+        self.assertEqual(weekly.next_occurrence(after, lagos), datetime(2026, 1, 5, 8, 0, tzinfo=dt_timezone.utc))
+        self.assertIsNone(weekly.next_occurrence(datetime(2026, 1, 12, 8, 0, tzinfo=dt_timezone.utc), lagos))
+
+        monthly = NotificationSchedule(frequency='monthly', time_of_day=time(9, 0), start_date=date(2026, 1, 31))
+        after = datetime(2026, 1, 31, 10, 0, tzinfo=dt_timezone.utc)
+        self.assertEqual(monthly.next_occurrence(after, dt_timezone.utc).date(), date(2026, 2, 28))
+
+        once = NotificationSchedule(frequency='once', time_of_day=time(9, 0), start_date=date(2026, 1, 1))
+        self.assertIsNone(once.next_occurrence(datetime(2026, 1, 1, 9, 0, tzinfo=dt_timezone.utc), dt_timezone.utc))
+
+
+class NotificationTemplateCacheTests(TestCase):
+
+    def setUp(self):
+        compiled_templates.clear()
+        self.template = NotificationTemplate.objects.create(
+            name='Refill',
+            template_type='refill_reminder',
+            push_title='Refill {{ medication }}',
+            push_body='{{ days }} days left',
+            sms_body='Refill {{ medication }} soon',
+        )
+
+    def test_render_compiles_each_field_once(self):
+        with patch('notifications.template_cache.Template', wraps=Template) as mock_template:
+            first = self.template.render({'medication': 'Aspirin', 'days': 3}, channel='push')
+            second = self.template.render({'medication': 'Ibuprofen', 'days': 1}, channel='push')
+        self.assertEqual(first, {'title': 'Refill Aspirin', 'body': '3 days left'})
+        self.assertEqual(second, {'title': 'Refill Ibuprofen', 'body': '1 days left'})
+        self.assertEqual(mock_template.call_count, 2)
+
+    def test_save_invalidates_compiled_fields(self):
+        self.template.render({'medication': 'Aspirin'}, channel='sms')
+        self.template.sms_body = 'Time to refill {{ medication }}'
+        self.template.save()
+        self.assertEqual(self.template.render({'medication': 'Aspirin'}, channel='sms'), 'Time to refill Aspirin')
+
+    def test_render_many_renders_each_context(self):
+        rendered = self.template.render_many([{'medication': 'A'}, {'medication': 'B'}], channel='sms')
+        self.assertEqual(rendered, ['Refill A soon', 'Refill B soon'])
+
+    def test_warm_up_compiles_active_templates(self):
+        self.assertEqual(warm_template_cache(), 1)
+        self.assertEqual(len(compiled_templates), 6)
@@ -5,7 +5,7 @@ from rest_framework import status
 from rest_framework.test import APITestCase
 from django.contrib.auth import get_user_model
 from faker import Faker
-from .models import Notification, NotificationPreference
+from .models import Notification, NotificationDelivery, NotificationPreference
 from push_notifications.models import GCMDevice
 
 User = get_user_model()
@@ -59,6 +59,35 @@ class NotificationAPITests(APITestCase):
         self.notification.refresh_from_db()
         self.assertTrue(self.notification.dismissed)
 
+    def test_list_is_slim_and_cursor_paged(self):
+        Notification.objects.bulk_create(
+            Notification(recipient=self.user, title=f'Older {i}', verb='Older notification') for i in range(3)
+        )
+        url = reverse('notifications:notification-list')
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'page_size': 2})
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertNotIn('deliveries', response.data['results'][0])
+        self.assertNotIn('actor_name', response.data['results'][0])
+        self.assertNotIn('count', response.data)
+
+        seen = [item['id'] for item in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            seen += [item['id'] for item in response.data['results']]
+        self.assertEqual(len(seen), 4)
+        self.assertEqual(len(set(seen)), 4)
+
+        response = self.client.get(url, {'include': 'actor'})
+        self.assertIn('actor_name', response.data['results'][0])
+
+    def test_delivery_history(self):
+        NotificationDelivery.objects.create(notification=self.notification, channel='email', status='sent')
+        url = reverse('notifications:notification-deliveries', kwargs={'pk': self.notification.pk})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([delivery['channel'] for delivery in response.data], ['email'])
+
 class NotificationPreferenceAPITests(APITestCase):
 
     def setUp(self):
@@ -1,9 +1,31 @@
 # notifications/tests.py
+from datetime import time, timedelta
+from unittest.mock import MagicMock, patch
+from django.core import mail
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
-from .models import Notification
+from push_notifications.models import GCMDevice
+from vitanips.core.clients import provider_clients, send_email_messages
+from .models import (
+    DeferredNotification, DeliveryStatusEvent, Notification, NotificationDelivery, NotificationPreference,
+    NotificationRateCounter, NotificationSchedule, NotificationTemplate, PendingDigestItem, RetentionCheckpoint, UnreadNotificationCounter,
+)
+from .delivery import (
+    RETRY_POLICIES, _mark_failed, plan_deliveries, release_deferred, retry_backlog, retry_delay,
+    retry_due_deliveries, send_queued_deliveries,
+)
+from .digests import is_digest_due, send_due_digests
+from .reminder_ledger import claim_reminders
+from .retention import purge_old_notifications
+from .schedules import process_due_schedules
+from .status_callbacks import apply_event, apply_status_events, twilio_event
+from .tasks import check_medication_refill_reminders
+from . import counters, rate_limits
+from .utils import broadcast_notifications, create_notification, create_notifications, user_notifications_group
 
 
 User = get_user_model()
@@ -76,3 +98,530 @@ class NotificationAPITests(APITestCase):
 from django.test import TestCase
 
 # Create your tests here.
+
+
+class CreateNotificationsTests(TestCase):
+    def setUp(self):
+        self.actor = User.objects.create_user(email="actor@example.com", username="actor", password="password123")
+        self.staff = [
+            User(email=f"staff{i}@example.com", username=f"staff{i}", first_name=f"Staff{i}")
+            for i in range(200)
+        ]
+        User.objects.bulk_create(self.staff)
+
+    def test_fan_out_is_a_single_insert(self):
+        with self.assertNumQueries(2):  # INSERT plus one unread-counter UPDATE
+            notifications = create_notifications(
+                self.staff, "New order received", actor=self.actor, category='order', level='bogus'
+            )
+        self.assertEqual(len(notifications), 200)
+        self.assertEqual(Notification.objects.filter(category='order', level='info', actor=self.actor).count(), 200)
+
+    def test_per_recipient_template_fields(self):
+        ranks = {user.pk: index for index, user in enumerate(self.staff[:2])}
+        create_notifications(
+            self.staff[:2],
+            "Hi {recipient.first_name}, you are #{rank}",
+            title="For {recipient.username}",
+            action_url="/staff/{recipient.pk}",
+            context=lambda user: {'rank': ranks[user.pk]},
+        )
+        first = Notification.objects.get(recipient=self.staff[1])
+        self.assertEqual(first.verb, "Hi Staff1, you are #1")
+        self.assertEqual(first.title, "For staff1")
+        self.assertEqual(first.action_url, f"/staff/{self.staff[1].pk}")
+
+    def test_plain_verb_braces_are_not_formatted_without_context(self):
+        notification = create_notification(self.actor, "Reason: {not a field}")
+        self.assertEqual(notification.verb, "Reason: {not a field}")
+        self.assertEqual(notification.title, "Reason: {not a field}")
+
+    @patch('notifications.tasks.send_push_notifications_batch.delay')
+    @patch('notifications.utils.broadcast_notifications')
+    def test_dispatch_runs_once_after_commit(self, mock_broadcast, mock_push):
+        with self.captureOnCommitCallbacks(execute=True):
+            notifications = create_notifications(self.staff[:3], "Shift starts soon", push=True)
+            mock_broadcast.assert_not_called()
+
+        mock_broadcast.assert_called_once_with(notifications)
+        mock_push.assert_called_once_with([n.pk for n in notifications])
+
+    @patch('notifications.utils.get_channel_layer')
+    def test_broadcast_sends_one_message_per_recipient(self, mock_get_layer):
+        sent = []
+
+        async def group_send(group, message):
+            sent.append((group, message))
+
+        mock_get_layer.return_value.group_send = group_send
+        notifications = create_notifications(self.staff[:2], "First") + create_notifications(self.staff[:1], "Second")
+        broadcast_notifications(notifications)
+
+        self.assertEqual([group for group, _ in sent], [
+            user_notifications_group(self.staff[0].pk), user_notifications_group(self.staff[1].pk)
+        ])
+        first = sent[0][1]
+        self.assertEqual(first['type'], 'notification.new')
+        self.assertEqual([n['verb'] for n in first['notifications']], ["First", "Second"])
+        self.assertNotIn('deliveries', first['notifications'][0])
+
+
+class UnreadCounterTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="counter@example.com", username="counter", password="password123")
+        self.client.force_authenticate(user=self.user)
+        Notification.objects.create(recipient=self.user, verb="Existing", category='order')
+
+    def counts(self):
+        return counters.get_unread_counts(self.user.id)
+
+    def test_first_read_seeds_counter_from_notifications(self):
+        self.assertEqual(self.counts()['total'], 1)
+        self.assertEqual(UnreadNotificationCounter.objects.get(user=self.user).order, 1)
+
+    def test_counter_tracks_create_read_unread_and_dismiss(self):
+        self.counts()
+        created = create_notifications([self.user], "Refill due", category='medication')[0]
+        self.assertEqual((self.counts()['total'], self.counts()['medication']), (2, 1))
+
+        created.mark_as_read()
+        created.mark_as_read()
+        self.assertEqual((self.counts()['total'], self.counts()['medication']), (1, 0))
+
+        created.mark_as_unread()
+        created.dismiss()
+        self.assertEqual(self.counts()['total'], 1)
+
+    def test_endpoint_returns_total_and_categories_with_one_query(self):
+        self.counts()
+        with self.assertNumQueries(1):
+            resp = self.client.get(reverse('notifications:unread-count'))
+        self.assertEqual(resp.data['unread_count'], 1)
+        self.assertEqual(resp.data['by_category']['order'], 1)
+
+    def test_mark_all_as_read_resets_counter(self):
+        self.counts()
+        self.client.post(reverse('notifications:mark-all-read'))
+        self.assertEqual(self.counts()['total'], 0)
+
+    def test_reconcile_fixes_drift(self):
+        self.counts()
+        Notification.objects.create(recipient=self.user, verb="Bypassed counters", category='health')
+        self.assertEqual(counters.reconcile_unread_counters(), 1)
+        self.assertEqual((self.counts()['total'], self.counts()['health']), (2, 1))
+        self.assertEqual(counters.reconcile_unread_counters(), 0)
+
+
+class BatchDeliveryTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(email=f"wave{i}@example.com", username=f"wave{i}", password="password123")
+            for i in range(3)
+        ]
+        NotificationPreference.objects.create(user=self.users[2], push_enabled=False)
+        self.notifications = create_notifications(self.users, "Time to take your medication", category='medication')
+
+    def plan(self):
+        notifications = list(Notification.objects.filter(pk__in=[n.pk for n in self.notifications]).select_related('recipient'))
+        return plan_deliveries(notifications)
+
+    @patch('notifications.delivery.broadcast_notifications')
+    def test_plan_writes_all_rows_in_one_insert(self, mock_broadcast):
+        # preferences; rate counters (savepoint, seed, lock, bump, release); bulk insert; sent_at update
+        with self.assertNumQueries(8):
+            queued, held = self.plan()
+
+        self.assertEqual(held, [])
+        self.assertEqual(sorted(d.channel for d in queued), ['email', 'email', 'email', 'push', 'push'])
+        self.assertEqual(NotificationDelivery.objects.filter(channel='in_app', status='delivered').count(), 3)
+        mock_broadcast.assert_called_once()
+
+    @patch('notifications.delivery.broadcast_notifications')
+    def test_email_batch_reuses_one_connection(self, mock_broadcast):
+        provider_clients.reset()
+        self.addCleanup(provider_clients.reset)
+        self.plan()
+        with patch('vitanips.core.clients.get_connection', wraps=mail.get_connection) as mock_connection:
+            self.assertEqual(send_queued_deliveries('email'), 3)
+            send_email_messages([mail.EmailMessage("Later", "Body", to=["late@example.com"])])
+
+        mock_connection.assert_called_once()
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(NotificationDelivery.objects.filter(channel='email', status='sent').count(), 3)
+
+    @override_settings(FCM_MAX_RECIPIENTS=2)
+    @patch('notifications.delivery.initialize_firebase', return_value=True)
+    @patch('notifications.delivery.messaging', create=True)
+    @patch('notifications.delivery.broadcast_notifications')
+    def test_push_batches_tokens_per_fcm_call(self, mock_broadcast, mock_messaging, mock_firebase):
+        unregistered_error = type('UnregisteredError', (Exception,), {})
+        mock_messaging.UnregisteredError = unregistered_error
+        mock_messaging.send_each.side_effect = lambda messages: MagicMock(responses=[
+            MagicMock(success=index > 0 or len(messages) == 1, exception=unregistered_error())
+            for index, _ in enumerate(messages)
+        ])
+        devices = [
+            GCMDevice.objects.create(user=self.users[0], registration_id="token-a", cloud_message_type='FCM'),
+            GCMDevice.objects.create(user=self.users[0], registration_id="token-b", cloud_message_type='FCM'),
+            GCMDevice.objects.create(user=self.users[1], registration_id="token-c", cloud_message_type='FCM'),
+        ]
+        self.plan()
+
+        self.assertEqual(send_queued_deliveries('push'), 2)
+        self.assertEqual(mock_messaging.send_each.call_count, 2)
+        self.assertEqual(GCMDevice.objects.filter(pk__in=[d.pk for d in devices], active=False).count(), 1)
+        self.assertEqual(NotificationDelivery.objects.filter(channel='push', status='sent').count(), 2)
+
+
+@patch('notifications.delivery.broadcast_notifications')
+class NotificationDigestTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="digest@example.com", username="digest", password="password123")
+        self.pref = NotificationPreference.objects.create(
+            user=self.user, digest_enabled=True, digest_time=time(9, 0), push_enabled=False
+        )
+
+    def plan(self, **kwargs):
+        notifications = create_notifications([self.user], "Your order shipped", category='order', **kwargs)
+        return plan_deliveries(list(Notification.objects.filter(pk__in=[n.pk for n in notifications]).select_related('recipient')))
+
+    def test_digest_users_get_in_app_now_and_email_later(self, mock_broadcast):
+        queued, held = self.plan()
+        self.assertEqual((queued, held), ([], []))
+        self.assertEqual(PendingDigestItem.objects.filter(user=self.user).count(), 1)
+        mock_broadcast.assert_called_once()
+
+        queued, _ = self.plan(level='urgent')
+        self.assertEqual([delivery.channel for delivery in queued], ['email'])
+        self.assertEqual(PendingDigestItem.objects.filter(user=self.user).count(), 1)
+
+    def test_due_digest_sends_one_email_for_everything_pending(self, mock_broadcast):
+        self.plan()
+        self.plan()
+        PendingDigestItem.objects.update(created_at=timezone.now() - timedelta(days=2))
+
+        self.assertEqual(send_due_digests(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("2 new notifications", mail.outbox[0].subject)
+        self.assertFalse(PendingDigestItem.objects.exists())
+        self.assertEqual(NotificationDelivery.objects.filter(channel='email', status='sent').count(), 2)
+        self.pref.refresh_from_db()
+        self.assertIsNotNone(self.pref.last_digest_sent_at)
+        self.assertEqual(send_due_digests(), 0)
+
+    def test_failed_digest_is_kept_for_the_next_run(self, mock_broadcast):
+        self.plan()
+        PendingDigestItem.objects.update(created_at=timezone.now() - timedelta(days=2))
+
+        with patch('notifications.digests.send_email_messages', side_effect=OSError("SMTP down")):
+            self.assertEqual(send_due_digests(), 0)
+        self.assertEqual(PendingDigestItem.objects.get().attempts, 1)
+        self.pref.refresh_from_db()
+        self.assertIsNone(self.pref.last_digest_sent_at)
+        self.assertFalse(NotificationDelivery.objects.filter(channel='email').exists())
+
+        self.assertEqual(send_due_digests(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(PendingDigestItem.objects.exists())
+        self.assertEqual(NotificationDelivery.objects.filter(channel='email', status='sent').count(), 1)
+
+    def test_digest_waits_for_the_next_slot(self, mock_broadcast):
+        self.plan()
+        self.assertEqual(send_due_digests(), 0)
+        self.assertEqual(PendingDigestItem.objects.count(), 1)
+
+    def test_weekly_digest_waits_a_week(self, mock_broadcast):
+        now = timezone.now()
+        self.pref.digest_frequency = 'weekly'
+        self.pref.last_digest_sent_at = now - timedelta(days=3)
+        self.assertFalse(is_digest_due(self.pref, now - timedelta(days=2), now))
+        self.pref.last_digest_sent_at = now - timedelta(days=7, hours=1)
+        self.assertTrue(is_digest_due(self.pref, now - timedelta(days=2), now))
+
+
+@patch('notifications.delivery.broadcast_notifications')
+class DeferredDeliveryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="night@example.com", username="night", password="password123")
+        self.pref = NotificationPreference.objects.create(
+            user=self.user, push_enabled=False, quiet_hours_enabled=True,
+            quiet_hours_start=time(0, 0), quiet_hours_end=time(23, 59, 59)
+        )
+        self.notification = create_notifications([self.user], "Lab results are ready", category='health')[0]
+
+    def plan(self):
+        return plan_deliveries([Notification.objects.select_related('recipient').get(pk=self.notification.pk)])
+
+    def test_quiet_hours_defer_instead_of_dropping(self, mock_broadcast):
+        queued, held = self.plan()
+        self.assertEqual((queued, [n.pk for n in held]), ([], [self.notification.pk]))
+        deferred = DeferredNotification.objects.get(notification=self.notification)
+        self.assertGreater(deferred.release_at, timezone.now())
+        mock_broadcast.assert_not_called()
+
+    def test_emergency_notifications_ignore_quiet_hours(self, mock_broadcast):
+        alert = create_notifications([self.user], "SOS from a contact", category='emergency')[0]
+        queued, held = plan_deliveries([Notification.objects.select_related('recipient').get(pk=alert.pk)])
+        self.assertEqual(held, [])
+        self.assertEqual([delivery.channel for delivery in queued], ['email'])
+        self.assertFalse(DeferredNotification.objects.filter(notification=alert).exists())
+
+    def test_release_plans_due_notifications_in_bulk(self, mock_broadcast):
+        self.plan()
+        self.assertEqual(release_deferred(), {})  # not due yet
+
+        DeferredNotification.objects.update(release_at=timezone.now() - timedelta(minutes=1))
+        NotificationPreference.objects.filter(pk=self.pref.pk).update(quiet_hours_enabled=False)
+        self.assertEqual(release_deferred(), {'email': 1})
+        self.assertFalse(DeferredNotification.objects.exists())
+        self.assertTrue(NotificationDelivery.objects.filter(notification=self.notification, channel='in_app').exists())
+
+    def test_release_defers_again_if_still_quiet(self, mock_broadcast):
+        self.plan()
+        DeferredNotification.objects.update(release_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(release_deferred(), {})
+        self.assertGreater(DeferredNotification.objects.get().release_at, timezone.now())
+
+
+@patch('notifications.delivery.broadcast_notifications')
+class ChannelRateLimitTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="busy@example.com", username="busy", password="password123")
+        NotificationPreference.objects.create(user=self.user, push_enabled=False, max_daily_emails=2)
+
+    def plan(self, count, **kwargs):
+        notifications = [
+            create_notifications([self.user], f"Order update {i}", category='order', **kwargs)[0] for i in range(count)
+        ]
+        return plan_deliveries(list(Notification.objects.filter(pk__in=[n.pk for n in notifications]).select_related('recipient')))
+
+    def test_emails_over_the_daily_limit_stay_in_app(self, mock_broadcast):
+        queued, _ = self.plan(3)
+        self.assertEqual(len(queued), 2)
+        self.assertEqual(NotificationDelivery.objects.filter(channel='email', status='rate_limited').count(), 1)
+        self.assertEqual(NotificationDelivery.objects.filter(channel='in_app').count(), 3)
+
+        queued, _ = self.plan(1)
+        self.assertEqual(queued, [])
+
+    def test_urgent_notifications_are_not_limited(self, mock_broadcast):
+        self.plan(2)
+        queued, _ = self.plan(1, level='urgent')
+        self.assertEqual([delivery.channel for delivery in queued], ['email'])
+
+    def test_redis_reservations_and_database_fallback(self, mock_broadcast):
+        day = timezone.localdate()
+        client = MagicMock()
+        client.pipeline.return_value.execute.return_value = [5, True]  # 3 already used today
+        with patch('notifications.rate_limits._get_redis', return_value=client):
+            self.assertEqual(rate_limits.consume([(self.user.pk, 'sms', day, 4)] * 2), [True, False])
+
+        client.pipeline.return_value.execute.side_effect = ConnectionError("redis down")
+        with patch('notifications.rate_limits._get_redis', return_value=client):
+            self.assertEqual(rate_limits.consume([(self.user.pk, 'sms', day, 1)] * 2), [True, False])
+        self.assertEqual(NotificationRateCounter.objects.get(user=self.user, channel='sms').count, 2)
+
+
+class ReminderLedgerTests(TestCase):
+    def test_claims_each_reminder_once(self):
+        candidates = [(1, '24h', 'a'), (1, '24h', 'a'), (1, '1h', 'a'), (2, '24h', 'b')]
+        self.assertEqual(claim_reminders('appointment', candidates), {(1, '24h', 'a'), (1, '1h', 'a'), (2, '24h', 'b')})
+        self.assertEqual(claim_reminders('appointment', candidates + [(1, '24h', 'c')]), {(1, '24h', 'c')})
+        self.assertEqual(claim_reminders('medication_refill', [(1, '24h', 'a')]), {(1, '24h', 'a')})
+
+    @patch('notifications.tasks.send_refill_reminder')
+    def test_refill_check_queues_each_reminder_once(self, mock_send):
+        from pharmacy.models import Medication, MedicationReminder
+
+        user = User.objects.create_user(email="refill@example.com", username="refill", password="password123")
+        medication = Medication.objects.create(name="Metformin", dosage_form="Tablet", strength="500mg")
+        reminder = MedicationReminder.objects.create(
+            user=user, medication=medication, dosage="1 tablet", frequency='daily', time_of_day=time(8, 0),
+            start_date=timezone.now().date(), end_date=timezone.now().date() + timedelta(days=3)
+        )
+
+        with self.assertNumQueries(2):  # candidates, one ledger insert
+            check_medication_refill_reminders()
+        check_medication_refill_reminders()
+        mock_send.delay.assert_called_once_with(reminder.id, 3)
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(email="old@example.com", username="old", password="password123")
+        old = timezone.now() - timedelta(days=120)
+        self.expired = [
+            Notification.objects.create(recipient=user, verb=f"Old {i}", unread=False) for i in range(5)
+        ]
+        self.kept = [
+            Notification.objects.create(recipient=user, verb="Old but unread"),
+            Notification.objects.create(recipient=user, verb="Recent", unread=False),
+        ]
+        Notification.objects.filter(pk__in=[n.pk for n in self.expired] + [self.kept[0].pk]).update(timestamp=old)
+        NotificationDelivery.objects.bulk_create(
+            NotificationDelivery(notification=n, channel='email', status='sent') for n in self.expired
+        )
+
+    def test_purge_resumes_from_its_checkpoint(self):
+        self.assertEqual(purge_old_notifications(chunk_size=2, max_chunks=1), 2)
+        checkpoint = RetentionCheckpoint.objects.get()
+        self.assertEqual(checkpoint.last_id, self.expired[1].pk)
+        self.assertIsNone(checkpoint.completed_at)
+
+        self.assertEqual(purge_old_notifications(chunk_size=2, max_chunks=10), 3)
+        checkpoint.refresh_from_db()
+        self.assertIsNotNone(checkpoint.completed_at)
+        self.assertEqual(checkpoint.deleted, 5)
+        self.assertEqual(set(Notification.objects.values_list('pk', flat=True)), {n.pk for n in self.kept})
+        self.assertFalse(NotificationDelivery.objects.exists())
+
+
+class RetrySchedulerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="retry@example.com", username="retry", password="password123")
+        self.notification = Notification.objects.create(recipient=self.user, title="Retry", verb="Retry me")
+        provider_clients.reset()
+        self.addCleanup(provider_clients.reset)
+
+    def failed(self, channel='email', retry_count=1, due_in=timedelta(minutes=-1)):
+        return NotificationDelivery.objects.create(
+            notification=self.notification, channel=channel, status='failed',
+            retry_count=retry_count, next_retry_at=timezone.now() + due_in,
+        )
+
+    def test_backoff_is_capped_jittered_and_dead_letters(self):
+        policy = RETRY_POLICIES['email']
+        for attempt in (1, 3, 20):
+            window = min(policy.cap, policy.base * 2 ** (attempt - 1))
+            with patch('notifications.delivery.random.random', return_value=0):
+                self.assertEqual(retry_delay('email', attempt), window / 2)
+            with patch('notifications.delivery.random.random', return_value=0.999):
+                self.assertLessEqual(retry_delay('email', attempt), window)
+
+        now = timezone.now()
+        delivery = NotificationDelivery(notification=self.notification, channel='email', retry_count=1)
+        _mark_failed(delivery, now, "timeout")
+        self.assertEqual(delivery.status, 'failed')
+        self.assertGreater(delivery.next_retry_at, now)
+        delivery.retry_count = policy.max_attempts - 1
+        _mark_failed(delivery, now, "timeout")
+        self.assertEqual(delivery.status, 'dead_letter')
+        self.assertIsNone(delivery.next_retry_at)
+
+    def test_retries_only_due_rows(self):
+        due = self.failed()
+        later = self.failed(due_in=timedelta(hours=1))
+
+        stats = retry_due_deliveries()
+
+        self.assertEqual(stats['email'], {'retried': 1, 'sent': 1, 'dead_letter': 0})
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(NotificationDelivery.objects.get(pk=due.pk).status, 'sent')
+        self.assertEqual(NotificationDelivery.objects.get(pk=later.pk).status, 'failed')
+        self.assertEqual(retry_backlog(), {'email': {'awaiting_retry': 1, 'dead_letter': 0}})
+
+    def test_open_circuit_leaves_rows_due(self):
+        due = self.failed(channel='sms')
+        breaker = provider_clients.breaker('twilio')
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+
+        with patch('notifications.delivery.send_sms') as mock_send:
+            stats = retry_due_deliveries()
+
+        self.assertNotIn('sms', stats)
+        mock_send.assert_not_called()
+        due.refresh_from_db()
+        self.assertEqual((due.status, due.retry_count), ('failed', 1))
+
+
+class ScheduleProcessingTests(TestCase):
+    def setUp(self):
+        self.template = NotificationTemplate.objects.create(
+            name="Daily check-in", template_type='medication_adherence', push_title="Check in", in_app_message="How are you today?"
+        )
+        users = [
+            User.objects.create_user(email=f"sched{i}@example.com", username=f"sched{i}", password="password123")
+            for i in range(3)
+        ]
+        self.schedules = [
+            NotificationSchedule.objects.create(
+                user=user, template=self.template, frequency='daily', time_of_day=time(9, 0),
+                start_date=timezone.now().date() - timedelta(days=7),
+            )
+            for user in users
+        ]
+        NotificationSchedule.objects.update(next_send_at=timezone.now() - timedelta(minutes=5))
+
+    def test_due_schedules_are_sent_in_batches_and_advanced(self):
+        dispatch = MagicMock()
+        self.assertEqual(process_due_schedules(dispatch, batch_size=2), 3)
+
+        self.assertEqual(dispatch.call_count, 2)
+        self.assertEqual(Notification.objects.filter(template=self.template).count(), 3)
+        for schedule in NotificationSchedule.objects.all():
+            self.assertEqual(schedule.total_sent, 1)
+            self.assertGreater(schedule.next_send_at, timezone.now())
+            self.assertLessEqual(schedule.next_send_at, timezone.now() + timedelta(days=1))
+
+        # Nothing is due any more, so a second run sends nothing.
+        self.assertEqual(process_due_schedules(dispatch), 0)
+
+    def test_one_time_schedule_is_deactivated(self):
+        NotificationSchedule.objects.filter(pk=self.schedules[0].pk).update(frequency='once')
+        process_due_schedules(MagicMock())
+
+        schedule = NotificationSchedule.objects.get(pk=self.schedules[0].pk)
+        self.assertFalse(schedule.is_active)
+        self.assertIsNone(schedule.next_send_at)
+
+
+class StatusCallbackTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(email="callback@example.com", username="callback", password="password123")
+        notification = Notification.objects.create(recipient=user, title="Wave", verb="Reminder wave")
+        self.deliveries = NotificationDelivery.objects.bulk_create(
+            NotificationDelivery(notification=notification, channel='sms', status='sent', external_id=f"SM{i}")
+            for i in range(3)
+        )
+
+    def test_callbacks_leave_unsent_statuses_alone(self):
+        now = timezone.now()
+        for current in ('queued', 'sending', 'dead_letter', 'rate_limited'):
+            delivery = NotificationDelivery(channel='sms', status=current, external_id='SM0')
+            self.assertFalse(apply_event(delivery, twilio_event({'MessageSid': 'SM0', 'MessageStatus': 'delivered'}), now))
+            self.assertEqual(delivery.status, current)
+
+    @override_settings(TWILIO_AUTH_TOKEN='token', NOTIFICATION_SMS_STATUS_CALLBACK_URL='')
+    def test_twilio_callback_requires_a_valid_signature(self):
+        from twilio.request_validator import RequestValidator
+
+        url = reverse('notifications:twilio-sms-status-webhook')
+        params = {'MessageSid': 'SM0', 'MessageStatus': 'delivered'}
+        signature = RequestValidator('token').compute_signature(f"http://testserver{url}", params)
+
+        response = self.client.post(url, params, HTTP_X_TWILIO_SIGNATURE='forged')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(DeliveryStatusEvent.objects.exists())
+
+        response = self.client.post(url, params, HTTP_X_TWILIO_SIGNATURE=signature)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(DeliveryStatusEvent.objects.get().external_id, 'SM0')
+
+    def test_events_are_applied_in_one_batch(self):
+        DeliveryStatusEvent.objects.bulk_create([
+            twilio_event({'MessageSid': 'SM0', 'MessageStatus': 'delivered'}),
+            twilio_event({'MessageSid': 'SM0', 'MessageStatus': 'sent'}),  # late; must not undo 'delivered'
+            twilio_event({'MessageSid': 'SM1', 'MessageStatus': 'undelivered', 'ErrorCode': '30003'}),
+            twilio_event({'MessageSid': 'SM2', 'MessageStatus': 'delivered'}),
+            twilio_event({'MessageSid': 'SM9', 'MessageStatus': 'delivered'}),  # not saved yet
+        ])
+
+        # savepoint; claim; deliveries; bulk_update; unmatched update; delete; release
+        with self.assertNumQueries(7):
+            self.assertEqual(apply_status_events(), 3)
+
+        statuses = dict(NotificationDelivery.objects.values_list('external_id', 'status'))
+        self.assertEqual(statuses, {'SM0': 'delivered', 'SM1': 'failed', 'SM2': 'delivered'})
+        self.assertEqual(NotificationDelivery.objects.get(external_id='SM1').error_message, "Twilio error 30003")
+        self.assertEqual(list(DeliveryStatusEvent.objects.values_list('external_id', flat=True)), ['SM9'])
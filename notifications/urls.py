@@ -5,6 +5,8 @@ from .views import (
     NotificationViewSet,
     NotificationPreferenceView,
     DeviceRegistrationView,
+    EmailEventWebhookView,
+    TwilioSMSStatusWebhookView,
 )
 
 app_name = 'notifications'
@@ -15,5 +17,7 @@ router.register(r'', NotificationViewSet, basename='notification')
 urlpatterns = [
     path('preferences/', NotificationPreferenceView.as_view(), name='notification-preferences'),
     path('devices/register/', DeviceRegistrationView.as_view(), name='device-register'),
+    path('webhooks/twilio/sms-status/', TwilioSMSStatusWebhookView.as_view(), name='twilio-sms-status-webhook'),
+    path('webhooks/email-events/', EmailEventWebhookView.as_view(), name='email-events-webhook'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
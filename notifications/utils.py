@@ -1,9 +1,113 @@
 # notifications/utils.py
-from typing import Optional
+import logging
+from typing import Callable, Iterable, List, Optional, Union
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from .counters import get_unread_counts, record_created
 from .models import Notification
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
+
+VALID_LEVELS = {choice for choice, _ in Notification.LEVEL_CHOICES}
+VALID_CATEGORIES = {choice for choice, _ in Notification.CATEGORY_CHOICES}
+TITLE_MAX_LENGTH = Notification._meta.get_field('title').max_length
+
+TemplateContext = Union[dict, Callable[[User], dict]]
+
+
+def user_notifications_group(user_id):
+    return f"user_{user_id}_notifications"
+
+
+def unread_count(user_id):
+    return get_unread_counts(user_id)['total']
+
+
+def _render(value, context):
+    return value.format_map(context) if value else value
+
+
+def create_notifications(
+    recipients: Iterable[User],
+    verb: str,
+    *,
+    actor: Optional[User] = None,
+    level: str = 'info',
+    category: str = 'system',
+    title: Optional[str] = None,
+    target_url: Optional[str] = None,
+    action_url: Optional[str] = None,
+    action_text: Optional[str] = None,
+    metadata: Optional[dict] = None,
+    context: Optional[TemplateContext] = None,
+    push: bool = False,
+) -> List[Notification]:
+    """
+    Create the same in-app notification for many recipients with one INSERT.
+
+    Arguments are validated once for the whole batch. When `context` is given,
+    verb, title, action_url and action_text are str.format templates rendered
+    per recipient with `recipient` plus the context (a dict, or a callable
+    taking the recipient and returning a dict), e.g. "Hello {recipient.first_name}".
+
+    After the surrounding transaction commits the notifications are broadcast to
+    their recipients' websocket groups and, with push=True, handed to a single
+    push delivery task.
+    """
+    recipients = list(recipients)
+    if not recipients:
+        return []
+
+    if level not in VALID_LEVELS:
+        level = 'info'
+    if category not in VALID_CATEGORIES:
+        category = 'system'
+    # Use target_url if action_url not provided (backward compatibility)
+    if not action_url and target_url:
+        action_url = target_url
+
+    notifications = []
+    for recipient in recipients:
+        fields = {'verb': verb, 'title': title, 'action_url': action_url, 'action_text': action_text}
+        if context is not None:
+            extra = context(recipient) if callable(context) else context
+            values = {'recipient': recipient, **extra}
+            fields = {name: _render(value, values) for name, value in fields.items()}
+        notifications.append(Notification(
+            recipient=recipient,
+            title=(fields['title'] or fields['verb'])[:TITLE_MAX_LENGTH],
+            verb=fields['verb'],
+            actor=actor,
+            level=level,
+            category=category,
+            action_url=fields['action_url'],
+            action_text=fields['action_text'],
+            metadata=dict(metadata or {}),
+            unread=True,
+        ))
+
+    notifications = save_notifications(notifications, push=push)
+    logger.info(f"Created {len(notifications)} '{category}' notifications")
+    return notifications
+
+
+def save_notifications(notifications: List[Notification], push: bool = False) -> List[Notification]:
+    """
+    Insert prepared (unsaved) notifications with one INSERT, update the unread
+    counters and dispatch them after the surrounding transaction commits.
+    For batches whose verbs differ per row; create_notifications() builds the
+    rows for you when every recipient gets the same message.
+    """
+    if not notifications:
+        return []
+    notifications = Notification.objects.bulk_create(notifications)
+    record_created(notifications)
+    transaction.on_commit(lambda: dispatch_notifications(notifications, push=push))
+    return notifications
+
 
 def create_notification(
     recipient: User,
@@ -19,7 +123,7 @@ def create_notification(
 ) -> Optional[Notification]:
     """
     Helper function to create an in-app notification.
-    
+
     Args:
         recipient: User who will receive the notification
         verb: The action/description of the notification (e.g., "Your order is ready")
@@ -32,39 +136,58 @@ def create_notification(
         action_text: Text for the action button (optional)
     """
     try:
-        # Validate level
-        valid_levels = ['info', 'success', 'warning', 'error', 'urgent']
-        if level not in valid_levels:
-            level = 'info'
-        
-        # Validate category
-        valid_categories = ['appointment', 'prescription', 'medication', 'order', 'health', 'emergency', 'system']
-        if category not in valid_categories:
-            category = 'system'
-        
-        # Use target_url if action_url not provided (backward compatibility)
-        if not action_url and target_url:
-            action_url = target_url
-        
-        # Generate title from verb if not provided
-        if not title:
-            title = verb[:200]  # Truncate to max length
-        
-        notif = Notification.objects.create(
-            recipient=recipient,
-            title=title,
-            verb=verb,
+        return create_notifications(
+            [recipient],
+            verb,
             actor=actor,
             level=level,
             category=category,
+            title=title,
+            target_url=target_url,
             action_url=action_url,
             action_text=action_text,
-            unread=True
-        )
-        print(f"Notification {notif.id} created for {recipient.username}: {title}")
-        return notif
+        )[0]
+    except Exception:
+        logger.exception(f"Error creating notification for {recipient.username}")
+        return None
+
+
+def broadcast_notifications(notifications):
+    """
+    Push new notifications to their recipients' websocket groups, one message
+    per recipient; the consumer coalesces bursts into a single frame.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None or not notifications:
+        return
+
+    from .serializers import NotificationBroadcastSerializer
+
+    by_recipient = {}
+    for notification in notifications:
+        by_recipient.setdefault(notification.recipient_id, []).append(notification)
+
+    group_send = async_to_sync(channel_layer.group_send)
+    for recipient_id, batch in by_recipient.items():
+        try:
+            group_send(user_notifications_group(recipient_id), {
+                'type': 'notification.new',
+                'notifications': NotificationBroadcastSerializer(batch, many=True).data,
+            })
+        except Exception as e:
+            # Clients replay anything they missed with the resume cursor.
+            logger.warning(f"Could not broadcast {len(batch)} notifications to user {recipient_id}: {e}")
+
+
+def dispatch_notifications(notifications, push=False):
+    """Post-commit delivery for a batch: websocket frames now, push in one background task."""
+    broadcast_notifications(notifications)
+    if not push:
+        return
+
+    from .tasks import send_push_notifications_batch
+
+    try:
+        send_push_notifications_batch.delay([notification.pk for notification in notifications])
     except Exception as e:
-        print(f"ERROR creating notification for {recipient.username}: {e}")
-        import traceback
-        traceback.print_exc()
-        return None
\ No newline at end of file
+        logger.warning(f"Could not queue push delivery for {len(notifications)} notifications: {e}")
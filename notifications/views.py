@@ -1,29 +1,43 @@
 # notifications/views.py
+import json
+import logging
 from rest_framework import generics, viewsets, status, permissions, views
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination
+from django.conf import settings
 from django.utils import timezone
-from .models import Notification, NotificationPreference, NotificationDelivery
+from .models import DeliveryStatusEvent, Notification, NotificationPreference
+from . import counters
+from .status_callbacks import email_events, twilio_event, valid_email_signature
 from .serializers import (
-    NotificationSerializer, NotificationPreferenceSerializer,
+    NotificationSerializer, NotificationListSerializer, NotificationPreferenceSerializer,
     NotificationDeliverySerializer
 )
 from push_notifications.models import APNSDevice, GCMDevice
 
+logger = logging.getLogger(__name__)
 
-class NotificationPagination(PageNumberPagination):
+
+class NotificationPagination(CursorPagination):
+    """
+    Cursor paging over (-timestamp, -id), served by the (recipient, dismissed,
+    timestamp, id) indexes: every page is an index range scan, with no OFFSET
+    and no COUNT(*).
+    """
     page_size = 15
     page_size_query_param = 'page_size'
     max_page_size = 50
+    ordering = ('-timestamp', '-id')
 
 
 class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for user notifications
     
-    list: Get all notifications for the current user
+    list: Get the current user's notifications (slim rows; ?include=actor adds actor_name)
     retrieve: Get specific notification details
+    deliveries: Get the delivery history of a notification
     mark_as_read: Mark notification as read
     mark_all_as_read: Mark all notifications as read
     get_unread_count: Get count of unread notifications
@@ -31,12 +45,44 @@ class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = NotificationSerializer
     permission_classes = [permissions.IsAuthenticated]
     pagination_class = NotificationPagination
+    LIST_ACTIONS = ('list', 'by_category')
+    LIST_FIELDS = (
+        'id', 'title', 'verb', 'level', 'category', 'action_url', 'action_text',
+        'unread', 'read_at', 'timestamp', 'metadata',
+    )
+
+    def include_actor(self):
+        return 'actor' in self.request.query_params.get('include', '').split(',')
 
     def get_queryset(self):
-        return Notification.objects.filter(
+        queryset = Notification.objects.filter(
             recipient=self.request.user,
             dismissed=False
-        ).select_related('actor').prefetch_related('deliveries')
+        )
+        if self.action in self.LIST_ACTIONS:
+            if self.include_actor():
+                return queryset.select_related('actor').only(*self.LIST_FIELDS, 'actor')
+            return queryset.only(*self.LIST_FIELDS)
+        if self.action == 'retrieve':
+            return queryset.select_related('actor').prefetch_related('deliveries')
+        return queryset
+
+    def get_serializer_class(self):
+        if self.action in self.LIST_ACTIONS:
+            return NotificationListSerializer
+        return super().get_serializer_class()
+
+    def get_serializer(self, *args, **kwargs):
+        if self.action in self.LIST_ACTIONS:
+            kwargs.setdefault('include_actor', self.include_actor())
+        return super().get_serializer(*args, **kwargs)
+
+    @action(detail=True, methods=['get'])
+    def deliveries(self, request, pk=None):
+        """Delivery history of a notification, oldest first"""
+        notification = self.get_object()
+        serializer = NotificationDeliverySerializer(notification.deliveries.order_by('created_at', 'id'), many=True)
+        return Response(serializer.data)
     
     @action(detail=True, methods=['post'])
     def mark_as_read(self, request, pk=None):
@@ -52,13 +98,17 @@ class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
             unread=False,
             read_at=timezone.now()
         )
+        counters.reset(request.user.id)
         return Response({'status': f'{updated} notifications marked as read'})
     
     @action(detail=False, methods=['get'])
     def unread_count(self, request):
-        """Get count of unread notifications"""
-        count = self.get_queryset().filter(unread=True).count()
-        return Response({'unread_count': count})
+        """Get count of unread notifications, overall and per category"""
+        counts = counters.get_unread_counts(request.user.id)
+        return Response({
+            'unread_count': counts['total'],
+            'by_category': {category: counts[category] for category in counters.CATEGORIES},
+        })
     
     @action(detail=True, methods=['post'])
     def dismiss(self, request, pk=None):
@@ -146,4 +196,58 @@ class DeviceRegistrationView(views.APIView):
 
         except Exception as e:
             print(f"Error registering device for user {user.id}: {e}")
-            return Response({"error": "Failed to register device."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+            return Response({"error": "Failed to register device."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class TwilioSMSStatusWebhookView(views.APIView):
+    """
+    Twilio message status callback for notification SMS. The request must
+    carry a valid X-Twilio-Signature; the status is queued as a
+    DeliveryStatusEvent and applied in batches by apply_delivery_status_events.
+    """
+    permission_classes = []
+    authentication_classes = []
+
+    def post(self, request, *args, **kwargs):
+        from twilio.request_validator import RequestValidator
+
+        params = request.POST.dict()
+        url = settings.NOTIFICATION_SMS_STATUS_CALLBACK_URL or request.build_absolute_uri()
+        signature = request.META.get('HTTP_X_TWILIO_SIGNATURE', '')
+        if not settings.TWILIO_AUTH_TOKEN or not RequestValidator(settings.TWILIO_AUTH_TOKEN).validate(url, params, signature):
+            return Response({"error": "Invalid signature."}, status=status.HTTP_403_FORBIDDEN)
+
+        event = twilio_event(params)
+        if event is not None:
+            event.save()
+        return Response({'status': 'received'}, status=status.HTTP_200_OK)
+
+
+class EmailEventWebhookView(views.APIView):
+    """
+    Email provider delivery/bounce events. Expects a JSON list (or
+    {"events": [...]}) of {"message_id", "event", "reason"} objects, signed
+    with an X-Webhook-Signature HMAC-SHA256 of the body. Events are queued
+    with one insert and applied in batches by apply_delivery_status_events.
+    """
+    permission_classes = []
+    authentication_classes = []
+
+    def post(self, request, *args, **kwargs):
+        body = request.body
+        if not valid_email_signature(body, request.META.get('HTTP_X_WEBHOOK_SIGNATURE', '')):
+            return Response({"error": "Invalid signature."}, status=status.HTTP_403_FORBIDDEN)
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return Response({"error": "Invalid JSON."}, status=status.HTTP_400_BAD_REQUEST)
+        if isinstance(data, dict):
+            data = data.get('events', [data])
+        if not isinstance(data, list):
+            return Response({"error": "Expected a list of events."}, status=status.HTTP_400_BAD_REQUEST)
+
+        events = email_events(data)
+        DeliveryStatusEvent.objects.bulk_create(events)
+        logger.debug(f"Queued {len(events)} of {len(data)} email events")
+        return Response({'status': 'received', 'queued': len(events)}, status=status.HTTP_200_OK)
+
@@ -1,5 +1,5 @@
 # payments/models.py
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from django.utils import timezone
 from decimal import Decimal
@@ -184,6 +184,14 @@ class PharmacySubscriptionRecord(models.Model):
     
     def __str__(self):
         return f"{self.pharmacy.name} - {self.plan.name} ({self.status})"
+
+    def save(self, *args, **kwargs):
+        from pharmacy.availability import invalidate_orderable_pharmacies
+
+        super().save(*args, **kwargs)
+        # Again after commit, in case a concurrent read re-cached the old state.
+        invalidate_orderable_pharmacies()
+        transaction.on_commit(invalidate_orderable_pharmacies)
     
     @property
     def is_active(self):
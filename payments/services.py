@@ -1,12 +1,14 @@
 # payments/services.py
 """
-Payment service for handling Flutterwave integration
+Payment service for handling Flutterwave integration.
+Requests go through the shared, pooled Flutterwave session in vitanips.core.clients.
 """
 import requests
 import logging
 from decimal import Decimal
 from django.conf import settings
 from typing import Dict, Optional
+from vitanips.core.clients import ProviderUnavailable, flutterwave_request
 
 logger = logging.getLogger(__name__)
 
@@ -84,7 +86,8 @@ class FlutterwaveService:
                 payload['customer']['name'] = customer_name
         
         try:
-            response = requests.post(
+            response = flutterwave_request(
+                'POST',
                 FLUTTERWAVE_INITIALIZE_URL,
                 json=payload,
                 headers=self.headers,
@@ -98,6 +101,9 @@ class FlutterwaveService:
                 return result
             else:
                 raise Exception(result.get('message', 'Failed to initialize payment'))
+        except ProviderUnavailable as e:
+            logger.error(f"Flutterwave initialization skipped: {e}")
+            raise Exception(f"Failed to initialize payment: {e}")
         except requests.exceptions.RequestException as e:
             logger.error(f"Flutterwave initialization error: {e}")
             if hasattr(e, 'response') and e.response is not None:
@@ -154,7 +160,8 @@ class FlutterwaveService:
             
             # Flutterwave verify endpoint accepts transaction ID (numeric) or tx_ref
             # Try to verify with the reference as-is first
-            response = requests.get(
+            response = flutterwave_request(
+                'GET',
                 FLUTTERWAVE_VERIFY_URL.format(reference),
                 headers=self.headers,
                 timeout=30
@@ -167,6 +174,9 @@ class FlutterwaveService:
                 return result
             else:
                 raise Exception(result.get('message', 'Transaction verification failed'))
+        except ProviderUnavailable as e:
+            logger.error(f"Flutterwave verification skipped: {e}")
+            raise Exception(f"Failed to verify payment: {e}")
         except requests.exceptions.RequestException as e:
             logger.error(f"Flutterwave verification error: {e}")
             if hasattr(e, 'response') and e.response is not None:
@@ -238,7 +248,8 @@ class FlutterwaveService:
         }
         
         try:
-            response = requests.post(
+            response = flutterwave_request(
+                'POST',
                 FLUTTERWAVE_INITIALIZE_URL,
                 json=payload,
                 headers=self.headers,
@@ -251,6 +262,9 @@ class FlutterwaveService:
                 return result
             else:
                 raise Exception(result.get('message', 'Failed to charge payment'))
+        except ProviderUnavailable as e:
+            logger.error(f"Flutterwave charge skipped: {e}")
+            raise Exception(f"Failed to charge payment: {e}")
         except requests.exceptions.RequestException as e:
             logger.error(f"Flutterwave charge error: {e}")
             if hasattr(e, 'response') and e.response is not None:
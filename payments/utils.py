@@ -2,7 +2,7 @@
 """
 Utility functions for subscription, premium feature checks, and payment processing
 """
-import requests
+from vitanips.core.clients import flutterwave_request
 from django.conf import settings
 from .models import UserSubscription
 from django.utils import timezone
@@ -48,7 +48,7 @@ def create_flutterwave_subaccount(account_bank, account_number, business_name, b
                 }
             }
             
-        response = requests.post(url, json=payload, headers=get_headers())
+        response = flutterwave_request('POST', url, json=payload, headers=get_headers())
         return response.json()
     except Exception as e:
         print(f"Error creating subaccount: {str(e)}")
@@ -103,7 +103,7 @@ def verify_bank_account(account_number, account_bank):
                 }
             }
         
-        response = requests.post(url, json=payload, headers=get_headers())
+        response = flutterwave_request('POST', url, json=payload, headers=get_headers())
         return response.json()
     except Exception as e:
         print(f"Error verifying bank account: {str(e)}")
@@ -186,7 +186,7 @@ def initiate_split_payment(email, amount, reference, subaccount_id, commission_p
                 }
             }
 
-        response = requests.post(url, json=payload, headers=get_headers())
+        response = flutterwave_request('POST', url, json=payload, headers=get_headers())
         return response.json()
     except Exception as e:
         print(f"Error initiating payment: {str(e)}")
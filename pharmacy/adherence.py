@@ -0,0 +1,144 @@
+# pharmacy/adherence.py
+"""
+Medication adherence rollups.
+
+ReminderAdherenceDaily and UserAdherenceDaily are kept current with F()
+increments when reminders fire and when intake is logged, so adherence
+reports read a handful of daily rows instead of scanning MedicationLog.
+"""
+from collections import Counter
+from datetime import timedelta
+from django.db.models import Sum
+from django.utils import timezone
+from .models import ReminderAdherenceDaily, UserAdherenceDaily
+from .utils import increment_counters
+
+LOG_STATUSES = ('taken', 'missed', 'skipped')
+# stale_skipped counts occurrences too late to send; they are not expected doses.
+COUNT_FIELDS = ('scheduled', 'stale_skipped') + LOG_STATUSES
+
+
+def _apply(counts):
+    """counts: Counter keyed by (reminder_id, user_id, date, field)."""
+    per_reminder = {}
+    per_user = {}
+    for (reminder_id, user_id, day, field), value in counts.items():
+        per_reminder.setdefault((reminder_id, user_id, day), Counter())[field] += value
+        per_user.setdefault((user_id, day), Counter())[field] += value
+
+    for (reminder_id, user_id, day), deltas in per_reminder.items():
+        increment_counters(
+            ReminderAdherenceDaily,
+            {'reminder_id': reminder_id, 'date': day},
+            dict(deltas),
+            defaults={'user_id': user_id},
+        )
+    for (user_id, day), deltas in per_user.items():
+        increment_counters(UserAdherenceDaily, {'user_id': user_id, 'date': day}, dict(deltas))
+
+
+def record_scheduled(due, stale_before=None):
+    """
+    Count fired reminder occurrences; due is an iterable of (reminder, fire_at).
+    Occurrences due before stale_before are skipped by the scheduler and
+    counted as stale_skipped instead of scheduled.
+    """
+    counts = Counter()
+    for reminder, fire_at in due:
+        field = 'stale_skipped' if stale_before is not None and fire_at < stale_before else 'scheduled'
+        counts[(reminder.pk, reminder.user_id, timezone.localdate(fire_at), field)] += 1
+    _apply(counts)
+
+
+def record_log(log):
+    """Count one newly created MedicationLog."""
+    if log.status not in LOG_STATUSES:
+        return
+    reminder = log.reminder
+    day = timezone.localdate(log.scheduled_time)
+    _apply(Counter({(reminder.pk, reminder.user_id, day, log.status): 1}))
+
+
+def _expected(row):
+    return max(row['scheduled'], row['taken'] + row['missed'] + row['skipped'])
+
+
+def _is_adherent(row):
+    expected = _expected(row)
+    return expected > 0 and row['taken'] >= expected
+
+
+def summarize(rows, today=None):
+    """
+    Build totals, adherence percentage, streaks and the missed-dose heatmap
+    from daily rows (dicts with date and COUNT_FIELDS, ordered by date).
+    Days with nothing scheduled or logged have no row and do not break a streak;
+    today only counts once all of its doses are taken.
+    """
+    today = today or timezone.localdate()
+    totals = {field: sum(row.get(field, 0) for row in rows) for field in COUNT_FIELDS}
+    expected = max(totals['scheduled'], totals['taken'] + totals['missed'] + totals['skipped'])
+
+    longest = run = 0
+    for row in rows:
+        run = run + 1 if _is_adherent(row) else 0
+        longest = max(longest, run)
+
+    current = 0
+    for row in reversed(rows):
+        if _is_adherent(row):
+            current += 1
+        elif row['date'] == today and not (row['missed'] or row['skipped']):
+            continue
+        else:
+            break
+
+    return {
+        **totals,
+        'adherence_percentage': round(100 * totals['taken'] / expected, 1) if expected else None,
+        'current_streak': current,
+        'longest_streak': longest,
+        'heatmap': [
+            {
+                'date': row['date'],
+                'scheduled': row['scheduled'],
+                'taken': row['taken'],
+                'missed_doses': max(_expected(row) - row['taken'], 0),
+            }
+            for row in rows
+        ],
+    }
+
+
+def daily_rows(queryset, days, today=None):
+    """Fetch the last `days` days of rollup rows as dicts in a single query."""
+    today = today or timezone.localdate()
+    return list(
+        queryset.filter(date__gt=today - timedelta(days=days), date__lte=today)
+        .order_by('date')
+        .values('date', *COUNT_FIELDS)
+    )
+
+
+def reminder_breakdown(user, days, today=None):
+    """Per-reminder totals and adherence percentage over the last `days` days."""
+    today = today or timezone.localdate()
+    rows = (
+        ReminderAdherenceDaily.objects
+        .filter(user=user, date__gt=today - timedelta(days=days), date__lte=today)
+        .values('reminder_id', 'reminder__medication__name')
+        .annotate(**{f'{field}_total': Sum(field) for field in COUNT_FIELDS})
+        .order_by('reminder_id')
+    )
+    breakdown = []
+    for totals in rows:
+        # Aggregates can't reuse the model field names, hence the _total suffix.
+        row = {field: totals[f'{field}_total'] for field in COUNT_FIELDS}
+        expected = _expected(row)
+        breakdown.append({
+            'reminder': totals['reminder_id'],
+            'medication_name': totals['reminder__medication__name'],
+            **row,
+            'adherence_percentage': round(100 * row['taken'] / expected, 1) if expected else None,
+        })
+    return breakdown
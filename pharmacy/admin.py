@@ -1,12 +1,12 @@
 from django.contrib import admin
-from .models import Pharmacy, Medication, PharmacyInventory, MedicationOrder, MedicationOrderItem, MedicationReminder, MedicationLog
+from .models import Pharmacy, GeocodedAddress, Medication, PharmacyInventory, MedicationOrder, MedicationOrderItem, OrderEvent, MedicationReminder, MedicationLog
 from payments.models import PharmacySubscription, PharmacySubscriptionRecord
 
 @admin.register(Pharmacy)
 class PharmacyAdmin(admin.ModelAdmin):
-    list_display = ('name', 'phone_number', 'email', 'is_24_hours', 'offers_delivery', 'is_active', 'subscription_expiry', 'created_at')
+    list_display = ('name', 'phone_number', 'email', 'is_24_hours', 'offers_delivery', 'is_active', 'subscription_expiry', 'subscription_lapsed', 'created_at')
     search_fields = ('name', 'address', 'phone_number', 'email')
-    list_filter = ('is_24_hours', 'offers_delivery', 'is_active', 'subscription_expiry', 'created_at')
+    list_filter = ('is_24_hours', 'offers_delivery', 'is_active', 'subscription_lapsed', 'subscription_expiry', 'created_at')
     ordering = ('-created_at',)
     readonly_fields = ('created_at', 'updated_at')
     fieldsets = (
@@ -17,7 +17,7 @@ class PharmacyAdmin(admin.ModelAdmin):
             'fields': ('is_24_hours', 'offers_delivery', 'is_active')
         }),
         ('Payment & Subscription', {
-            'fields': ('subaccount_id', 'bank_account_details', 'commission_rate', 'subscription_expiry'),
+            'fields': ('subaccount_id', 'bank_account_details', 'commission_rate', 'subscription_expiry', 'subscription_lapsed'),
             'classes': ('collapse',)
         }),
         ('Location', {
@@ -98,6 +98,14 @@ class MedicationOrderItemAdmin(admin.ModelAdmin):
         }),
     )
 
+@admin.register(OrderEvent)
+class OrderEventAdmin(admin.ModelAdmin):
+    list_display = ('id', 'order', 'pharmacy', 'event_type', 'from_status', 'to_status', 'created_at', 'dispatched_at')
+    search_fields = ('order__id', 'pharmacy__name')
+    list_filter = ('event_type', 'created_at', 'dispatched_at')
+    ordering = ('-id',)
+    readonly_fields = ('created_at',)
+
 @admin.register(MedicationReminder)
 class MedicationReminderAdmin(admin.ModelAdmin):
     list_display = ('user', 'medication', 'prescription_item', 'start_date', 'end_date', 'time_of_day', 'frequency', 'is_active', 'created_at')
@@ -187,4 +195,12 @@ class PharmacySubscriptionRecordAdmin(admin.ModelAdmin):
             'fields': ('created_at', 'updated_at'),
             'classes': ('collapse',)
         }),
-    )
\ No newline at end of file
+    )
+
+
+@admin.register(GeocodedAddress)
+class GeocodedAddressAdmin(admin.ModelAdmin):
+    list_display = ('address', 'status', 'provider', 'updated_at')
+    search_fields = ('address',)
+    list_filter = ('status', 'provider')
+    readonly_fields = ('address_hash', 'created_at', 'updated_at')
@@ -0,0 +1,128 @@
+# pharmacy/analytics.py
+"""
+Pharmacy portal analytics.
+
+PharmacyDailyStats and PharmacyMedicationDailyStats are updated in the same
+transaction as order creation and status changes, so reports over any date
+range read the aggregate tables only.
+"""
+from collections import Counter
+from decimal import Decimal
+from django.db.models import Sum
+from django.utils import timezone
+from .models import PharmacyDailyStats, PharmacyMedicationDailyStats
+from .utils import increment_counters
+
+STATUS_COUNTERS = ('processing', 'ready', 'delivering', 'completed', 'cancelled')
+DAILY_FIELDS = (
+    'orders_created', 'revenue', 'insurance_orders', 'insurance_revenue',
+    'cash_orders', 'cash_revenue', 'ready_seconds_total', 'complete_seconds_total',
+) + tuple(f'orders_{status}' for status in STATUS_COUNTERS)
+TOP_MEDICATIONS_LIMIT = 10
+
+
+def _daily(pharmacy_id, day, deltas):
+    increment_counters(PharmacyDailyStats, {'pharmacy_id': pharmacy_id, 'date': day}, deltas)
+
+
+def record_order_created(order):
+    _daily(order.pharmacy_id, timezone.localdate(order.order_date or timezone.now()), {'orders_created': 1})
+
+
+def record_status_change(order, to_status, at=None):
+    """Book an order's move into to_status; completion also books revenue and items."""
+    if to_status not in STATUS_COUNTERS:
+        return
+    at = at or timezone.now()
+    day = timezone.localdate(at)
+    deltas = {f'orders_{to_status}': 1}
+    elapsed = int((at - order.order_date).total_seconds()) if order.order_date else 0
+
+    if to_status == 'ready':
+        deltas['ready_seconds_total'] = elapsed
+    elif to_status == 'completed':
+        total = order.total_amount or Decimal('0')
+        deltas['complete_seconds_total'] = elapsed
+        deltas['revenue'] = total
+        if order.user_insurance_id:
+            covered = order.insurance_covered_amount or Decimal('0')
+            deltas['insurance_orders'] = 1
+            deltas['insurance_revenue'] = covered
+            deltas['cash_revenue'] = total - covered
+        else:
+            deltas['cash_orders'] = 1
+            deltas['cash_revenue'] = total
+        _record_items(order, day)
+
+    _daily(order.pharmacy_id, day, deltas)
+
+
+def _record_items(order, day):
+    quantities = Counter()
+    revenue = Counter()
+    for item in order.items.select_related('prescription_item__medication'):
+        medication = item.prescription_item.medication if item.prescription_item else None
+        name = (medication.name if medication else item.medication_name_text) or 'Unknown'
+        quantities[name] += item.quantity
+        revenue[name] += item.total_price or Decimal('0')
+    for name, quantity in quantities.items():
+        increment_counters(
+            PharmacyMedicationDailyStats,
+            {'pharmacy_id': order.pharmacy_id, 'date': day, 'medication_name': name[:200]},
+            {'quantity': quantity, 'revenue': revenue[name]},
+        )
+
+
+def _average_minutes(seconds, count):
+    return round(seconds / count / 60, 1) if count else None
+
+
+def pharmacy_report(pharmacy, start, end):
+    """Analytics for pharmacy between start and end (inclusive dates) from the aggregate tables."""
+    rows = list(
+        PharmacyDailyStats.objects.filter(pharmacy=pharmacy, date__gte=start, date__lte=end)
+        .order_by('date')
+        .values('date', *DAILY_FIELDS)
+    )
+    totals = {field: sum(row[field] for row in rows) for field in DAILY_FIELDS}
+
+    top_medications = (
+        PharmacyMedicationDailyStats.objects.filter(pharmacy=pharmacy, date__gte=start, date__lte=end)
+        .values('medication_name')
+        .annotate(total_quantity=Sum('quantity'), total_revenue=Sum('revenue'))
+        .order_by('-total_quantity', 'medication_name')[:TOP_MEDICATIONS_LIMIT]
+    )
+
+    return {
+        'start': start,
+        'end': end,
+        'daily': [
+            {
+                'date': row['date'],
+                'revenue': row['revenue'],
+                'orders_created': row['orders_created'],
+                'orders_completed': row['orders_completed'],
+                'orders_cancelled': row['orders_cancelled'],
+            }
+            for row in rows
+        ],
+        'total_revenue': totals['revenue'],
+        'orders_by_status': {
+            'created': totals['orders_created'],
+            **{status: totals[f'orders_{status}'] for status in STATUS_COUNTERS},
+        },
+        'avg_minutes_to_ready': _average_minutes(totals['ready_seconds_total'], totals['orders_ready']),
+        'avg_minutes_to_complete': _average_minutes(totals['complete_seconds_total'], totals['orders_completed']),
+        'top_medications': [
+            {
+                'medication_name': row['medication_name'],
+                'quantity': row['total_quantity'],
+                'revenue': row['total_revenue'],
+            }
+            for row in top_medications
+        ],
+        'payment_mix': {
+            'insurance': {'orders': totals['insurance_orders'], 'amount': totals['insurance_revenue']},
+            'cash': {'orders': totals['cash_orders'], 'amount': totals['cash_revenue']},
+        },
+    }
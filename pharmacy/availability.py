@@ -0,0 +1,86 @@
+# pharmacy/availability.py
+"""
+Which pharmacies can take orders right now.
+
+A pharmacy is orderable while it is active, has not been flagged as lapsed by
+the daily expiry job and its registration has not expired. The set of
+orderable IDs is cached per day in the shared cache (so expiries roll over at
+midnight without a write) and invalidated whenever a pharmacy or one of its
+subscription records is saved, and when a pharmacy is deleted.
+"""
+import logging
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+ORDERABLE_CACHE_TIMEOUT = 60 * 10  # seconds
+
+
+def _cache_key(day=None):
+    return f"pharmacy:orderable_ids:{(day or timezone.localdate()).isoformat()}"
+
+
+def orderable_pharmacies_filter(today=None):
+    today = today or timezone.localdate()
+    return Q(is_active=True, subscription_lapsed=False) & (Q(subscription_expiry__isnull=True) | Q(subscription_expiry__gte=today))
+
+
+def orderable_pharmacy_ids():
+    """Frozen set of IDs of pharmacies that can accept orders today."""
+    from .models import Pharmacy
+
+    key = _cache_key()
+    try:
+        ids = cache.get(key)
+    except Exception as e:
+        logger.warning(f"Orderable pharmacy cache unavailable, using the database: {e}")
+        return frozenset(Pharmacy.objects.filter(orderable_pharmacies_filter()).values_list('id', flat=True))
+    if ids is None:
+        ids = frozenset(Pharmacy.objects.filter(orderable_pharmacies_filter()).values_list('id', flat=True))
+        try:
+            cache.set(key, ids, ORDERABLE_CACHE_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Could not cache orderable pharmacies: {e}")
+    return ids
+
+
+def is_orderable(pharmacy_id):
+    try:
+        return int(pharmacy_id) in orderable_pharmacy_ids()
+    except (TypeError, ValueError):
+        return False
+
+
+def invalidate_orderable_pharmacies():
+    try:
+        cache.delete(_cache_key())
+    except Exception as e:
+        # Nothing was cached while the cache is down; entries expire after ORDERABLE_CACHE_TIMEOUT.
+        logger.warning(f"Could not invalidate orderable pharmacy cache: {e}")
+
+
+def expire_lapsed_subscriptions():
+    """
+    Bulk-expire active subscription records past their period end and flag
+    pharmacies whose registration has lapsed. Returns (records_expired, pharmacies_flagged).
+    """
+    from payments.models import PharmacySubscriptionRecord
+    from .models import Pharmacy
+
+    now = timezone.now()
+    today = timezone.localdate()
+
+    records_expired = PharmacySubscriptionRecord.objects.filter(
+        status='active', current_period_end__lte=now
+    ).update(status='expired', updated_at=now)
+
+    pharmacies_flagged = Pharmacy.objects.filter(
+        subscription_lapsed=False, subscription_expiry__lt=today
+    ).update(subscription_lapsed=True, updated_at=now)
+
+    if records_expired or pharmacies_flagged:
+        invalidate_orderable_pharmacies()
+    logger.info(f"Expired {records_expired} subscription records; flagged {pharmacies_flagged} lapsed pharmacies")
+    return records_expired, pharmacies_flagged
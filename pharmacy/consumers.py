@@ -0,0 +1,107 @@
+import json
+from datetime import timedelta
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+
+
+class PharmacyOrderConsumer(AsyncWebsocketConsumer):
+    """
+    Live order queue for pharmacy portal staff.
+
+    Every frame carries a ``cursor`` (the OrderEvent id). On reconnect, pass the
+    highest cursor seen as ``?cursor=<id>`` or send ``{"type": "resume", "cursor": <id>}``
+    to replay missed events. Ids are assigned at insert, not commit, so an event
+    can become visible after a higher one was sent; replay therefore also resends
+    events from the last REPLAY_OVERLAP below the cursor. Frames may be delivered
+    twice; ignore cursors already handled (not every cursor <= the highest one).
+    """
+    REPLAY_LIMIT = 200
+    REPLAY_OVERLAP = timedelta(seconds=30)
+
+    async def connect(self):
+        user = self.scope["user"]
+        if user.is_anonymous or not user.is_pharmacy_staff or not user.works_at_pharmacy_id:
+            await self.close()
+            return
+
+        from .services import pharmacy_orders_group
+
+        self.pharmacy_id = user.works_at_pharmacy_id
+        self.group_name = pharmacy_orders_group(self.pharmacy_id)
+
+        await self.channel_layer.group_add(
+            self.group_name,
+            self.channel_name
+        )
+        await self.accept()
+
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        cursor = query.get('cursor', [None])[0]
+        if cursor is not None:
+            await self.replay(cursor)
+        else:
+            await self.send(text_data=json.dumps({
+                'type': 'hello',
+                'cursor': await self.get_latest_cursor(),
+            }))
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'group_name'):
+            await self.channel_layer.group_discard(
+                self.group_name,
+                self.channel_name
+            )
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = json.loads(text_data or '{}')
+        except ValueError:
+            return
+        if data.get('type') == 'resume':
+            await self.replay(data.get('cursor'))
+
+    async def replay(self, cursor):
+        try:
+            cursor = int(cursor)
+        except (TypeError, ValueError):
+            await self.send(text_data=json.dumps({'type': 'error', 'message': 'Invalid cursor.'}))
+            return
+
+        frames, has_more = await self.get_events_since(cursor)
+        for frame in frames:
+            await self.send(text_data=json.dumps({'type': 'order_event', **frame}))
+
+        if has_more:
+            # Too far behind to replay; the portal should refetch the order list.
+            await self.send(text_data=json.dumps({
+                'type': 'resync_required',
+                'cursor': await self.get_latest_cursor(),
+            }))
+
+    # Receive message from pharmacy group
+    async def order_event(self, event):
+        await self.send(text_data=json.dumps({'type': 'order_event', **event['event']}))
+
+    @database_sync_to_async
+    def get_events_since(self, cursor):
+        from django.db.models import Q
+        from django.utils import timezone
+        from .models import OrderEvent
+        from .serializers import OrderEventSerializer
+
+        recent = Q(created_at__gte=timezone.now() - self.REPLAY_OVERLAP)
+        events = list(
+            OrderEvent.objects.filter(Q(id__gt=cursor) | recent, pharmacy_id=self.pharmacy_id)
+            .select_related('order')
+            .order_by('id')[:self.REPLAY_LIMIT + 1]
+        )
+        frames = OrderEventSerializer(events[:self.REPLAY_LIMIT], many=True).data
+        return frames, len(events) > self.REPLAY_LIMIT
+
+    @database_sync_to_async
+    def get_latest_cursor(self):
+        from .models import OrderEvent
+
+        latest = OrderEvent.objects.filter(pharmacy_id=self.pharmacy_id).order_by('-id').values_list('id', flat=True).first()
+        return latest or 0
@@ -0,0 +1,214 @@
+# pharmacy/geocoding.py
+"""
+Address geocoding for pharmacies and emergency services.
+
+Model saves only schedule work; lookups run on the task queue, go through the
+GeocodedAddress cache first and call the configured provider on a miss.
+Providers are pluggable via settings.GEOCODING_PROVIDER.
+"""
+import hashlib
+import logging
+import re
+import time
+from functools import lru_cache
+import requests
+from django.apps import apps
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.db import transaction
+from django.utils.module_loading import import_string
+from .models import GeocodedAddress
+
+logger = logging.getLogger(__name__)
+
+# Models whose empty `location` is filled from their `address`.
+GEOCODED_MODELS = ('pharmacy.Pharmacy', 'emergency.EmergencyService')
+
+
+class GeocodingError(Exception):
+    """Transient provider failure (quota, network, 5xx); the lookup can be retried."""
+
+
+class GeocodingProvider:
+    """Provider interface: geocode() returns (latitude, longitude) or None when not found."""
+    name = 'base'
+
+    def geocode(self, address):
+        raise NotImplementedError
+
+
+class GoogleGeocodingProvider(GeocodingProvider):
+    name = 'google'
+    url = 'https://maps.googleapis.com/maps/api/geocode/json'
+
+    def __init__(self):
+        self.api_key = getattr(settings, 'GOOGLE_MAPS_API_KEY', '')
+        self.timeout = getattr(settings, 'GEOCODING_TIMEOUT', 5)
+        self.session = requests.Session()
+
+    def geocode(self, address):
+        if not self.api_key:
+            raise GeocodingError("GOOGLE_MAPS_API_KEY is not configured")
+        try:
+            response = self.session.get(
+                self.url,
+                params={'address': address, 'key': self.api_key},
+                timeout=self.timeout
+            )
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise GeocodingError(str(e)) from e
+
+        status = data.get('status')
+        if status == 'OK' and data.get('results'):
+            location = data['results'][0]['geometry']['location']
+            return location['lat'], location['lng']
+        if status == 'ZERO_RESULTS':
+            return None
+        raise GeocodingError(f"Google geocoding returned {status}")
+
+
+class StubGeocodingProvider(GeocodingProvider):
+    """Offline provider for tests and local development: a stable point per address around Lagos."""
+    name = 'stub'
+
+    def geocode(self, address):
+        digest = hashlib.sha256(address.encode('utf-8')).digest()
+        latitude = 6.4 + digest[0] / 255 * 0.3
+        longitude = 3.3 + digest[1] / 255 * 0.3
+        return round(latitude, 6), round(longitude, 6)
+
+
+@lru_cache(maxsize=None)
+def _load_provider(path):
+    return import_string(path)()
+
+
+def get_provider():
+    return _load_provider(getattr(settings, 'GEOCODING_PROVIDER', 'pharmacy.geocoding.GoogleGeocodingProvider'))
+
+
+def normalize_address(address):
+    return re.sub(r'\s+', ' ', (address or '').strip().lower())
+
+
+def address_hash(address):
+    return hashlib.sha256(normalize_address(address).encode('utf-8')).hexdigest()
+
+
+def geocode_address(address, provider=None):
+    """
+    Return a Point for the address or None if the provider cannot find it.
+    Results (including misses) are cached; GeocodingError is raised on transient failures.
+    """
+    if not normalize_address(address):
+        return None
+    key = address_hash(address)
+
+    cached = GeocodedAddress.objects.filter(address_hash=key).first()
+    if cached is not None:
+        return cached.location
+
+    provider = provider or get_provider()
+    result = provider.geocode(address)
+    location = Point(result[1], result[0], srid=4326) if result else None  # Point(lon, lat)
+    GeocodedAddress.objects.update_or_create(
+        address_hash=key,
+        defaults={
+            'address': address,
+            'location': location,
+            'status': 'ok' if location else 'not_found',
+            'provider': provider.name,
+        }
+    )
+    return location
+
+
+def apply_geocode(model_label, pk):
+    """Geocode one row; never overwrites a location that was set in the meantime."""
+    model = apps.get_model(model_label)
+    address = model.objects.filter(pk=pk, location__isnull=True).values_list('address', flat=True).first()
+    if not address:
+        return False
+    location = geocode_address(address)
+    if location is None:
+        logger.warning(f"Geocoding found no match for {model_label} {pk}")
+        return False
+    return bool(model.objects.filter(pk=pk, location__isnull=True).update(location=location))
+
+
+def schedule_geocoding(instance):
+    """Queue a geocoding task for the instance once the current transaction commits."""
+    from .tasks import geocode_location_task
+
+    model_label = instance._meta.label
+    pk = instance.pk
+
+    def enqueue():
+        try:
+            geocode_location_task.delay(model_label, pk)
+        except Exception as e:
+            # The periodic backfill picks up anything that could not be queued.
+            logger.warning(f"Could not queue geocoding for {model_label} {pk}: {e}")
+
+    transaction.on_commit(enqueue)
+
+
+def backfill_locations(batch_size=100, max_lookups=500, rate_limit=None, provider=None):
+    """
+    Fill missing locations for every model in GEOCODED_MODELS, paging through
+    rows by primary key. Rows sharing an address are resolved with one lookup
+    and updated together; cache misses call the provider at most `max_lookups`
+    times, throttled to `rate_limit` requests per second. Transient provider
+    errors stop the run so the next one resumes where this left off.
+    Returns the number of rows updated.
+    """
+    provider = provider or get_provider()
+    rate_limit = rate_limit or getattr(settings, 'GEOCODING_RATE_LIMIT', 10)
+    min_interval = 1.0 / rate_limit
+    last_call = 0.0
+    lookups = 0
+    updated = 0
+
+    for model_label in GEOCODED_MODELS:
+        model = apps.get_model(model_label)
+        last_pk = 0
+        while True:
+            rows = list(
+                model.objects.filter(location__isnull=True, pk__gt=last_pk).exclude(address='')
+                .order_by('pk').values_list('pk', 'address')[:batch_size]
+            )
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+
+            by_hash = {}
+            for pk, address in rows:
+                by_hash.setdefault(address_hash(address), (address, []))[1].append(pk)
+            cached = dict(
+                GeocodedAddress.objects.filter(address_hash__in=by_hash.keys()).values_list('address_hash', 'location')
+            )
+
+            for key, (address, pks) in by_hash.items():
+                if key in cached:
+                    location = cached[key]
+                else:
+                    if lookups >= max_lookups:
+                        logger.info(f"Geocoding backfill reached {max_lookups} lookups; {updated} locations updated")
+                        return updated
+                    wait = min_interval - (time.monotonic() - last_call)
+                    if wait > 0:
+                        time.sleep(wait)
+                    lookups += 1
+                    try:
+                        location = geocode_address(address, provider=provider)
+                    except GeocodingError as e:
+                        logger.warning(f"Geocoding backfill stopped on {model_label}: {e}")
+                        return updated
+                    finally:
+                        last_call = time.monotonic()
+                if location is not None:
+                    updated += model.objects.filter(pk__in=pks, location__isnull=True).update(location=location)
+
+    logger.info(f"Geocoding backfill updated {updated} locations")
+    return updated
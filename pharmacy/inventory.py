@@ -0,0 +1,115 @@
+# pharmacy/inventory.py
+"""
+Stock reservation for medication orders.
+
+Every stock change is a single conditional UPDATE with F() expressions, so
+concurrent orders for the same inventory row cannot oversell and no table or
+row locks are held beyond the UPDATE itself:
+
+- reserve: reserved_quantity += n  WHERE quantity >= reserved_quantity + n
+- commit:  quantity -= n, reserved_quantity -= n  WHERE reserved_quantity >= n
+- release: reserved_quantity -= n  WHERE reserved_quantity >= n
+
+Items whose medication the pharmacy does not track in PharmacyInventory are
+left alone.
+"""
+import logging
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from .models import MedicationOrderItem, PharmacyInventory
+
+logger = logging.getLogger(__name__)
+
+
+def _link_inventory(order, items):
+    """Attach the pharmacy's inventory row to items that do not have one yet."""
+    unlinked = {}
+    for item in items:
+        if item.inventory_id is None and item.prescription_item and item.prescription_item.medication_id:
+            unlinked.setdefault(item.prescription_item.medication_id, []).append(item)
+    if not unlinked:
+        return
+    rows = PharmacyInventory.objects.filter(
+        pharmacy_id=order.pharmacy_id, medication_id__in=unlinked.keys()
+    ).values_list('medication_id', 'id')
+    for medication_id, inventory_id in rows:
+        for item in unlinked[medication_id]:
+            item.inventory_id = inventory_id
+
+
+def reserve_stock(order, strict=False):
+    """
+    Reserve the unreserved part of every tracked item. With strict=True a
+    shortage raises ValidationError; callers run inside a transaction so
+    reservations made before the failure roll back with it.
+    """
+    items = list(order.items.select_related('prescription_item'))
+    _link_inventory(order, items)
+
+    shortages = []
+    for item in items:
+        needed = item.quantity - item.reserved_quantity
+        if item.inventory_id is None or needed <= 0:
+            continue
+        reserved = PharmacyInventory.objects.filter(
+            pk=item.inventory_id, quantity__gte=F('reserved_quantity') + needed
+        ).update(reserved_quantity=F('reserved_quantity') + needed)
+        if reserved:
+            item.reserved_quantity += needed
+        else:
+            shortages.append(item.medication_name_text or f"item {item.pk}")
+
+    if shortages and strict:
+        raise ValidationError({'items': f"Insufficient stock for: {', '.join(shortages)}."})
+    MedicationOrderItem.objects.bulk_update(items, ['inventory', 'reserved_quantity'])
+    return shortages
+
+
+def commit_stock(order):
+    """Turn reservations into stock decrements when an order completes."""
+    items = [item for item in order.items.all() if item.inventory_id and item.reserved_quantity]
+    for item in items:
+        n = item.reserved_quantity
+        updated = PharmacyInventory.objects.filter(pk=item.inventory_id, reserved_quantity__gte=n, quantity__gte=n).update(
+            quantity=F('quantity') - n,
+            reserved_quantity=F('reserved_quantity') - n,
+            # SET expressions see the pre-update row, so compare against the old quantity.
+            in_stock=Case(When(quantity__gt=n, then=Value(True)), default=Value(False)),
+        )
+        if not updated:
+            logger.error(f"Stock commit for order item {item.pk} found inconsistent inventory {item.inventory_id}")
+        item.reserved_quantity = 0
+    MedicationOrderItem.objects.bulk_update(items, ['reserved_quantity'])
+
+
+def release_stock(order):
+    """Return reserved units to available stock when an order is cancelled."""
+    items = [item for item in order.items.all() if item.inventory_id and item.reserved_quantity]
+    for item in items:
+        n = item.reserved_quantity
+        PharmacyInventory.objects.filter(pk=item.inventory_id, reserved_quantity__gte=n).update(
+            reserved_quantity=F('reserved_quantity') - n
+        )
+        item.reserved_quantity = 0
+    MedicationOrderItem.objects.bulk_update(items, ['reserved_quantity'])
+
+
+def low_stock_queryset():
+    """Inventory rows at or below their threshold that have not been alerted yet."""
+    return PharmacyInventory.objects.filter(
+        low_stock_alerted_at__isnull=True,
+        quantity__lte=F('reserved_quantity') + F('low_stock_threshold'),
+    )
+
+
+def reset_low_stock_alerts():
+    """Re-arm alerts for rows that have been restocked above their threshold."""
+    return PharmacyInventory.objects.filter(
+        low_stock_alerted_at__isnull=False,
+        quantity__gt=F('reserved_quantity') + F('low_stock_threshold'),
+    ).update(low_stock_alerted_at=None)
+
+
+def mark_low_stock_alerted(inventory_ids):
+    return PharmacyInventory.objects.filter(pk__in=inventory_ids).update(low_stock_alerted_at=timezone.now())
@@ -1,10 +1,13 @@
 # pharmacy/models.py
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.conf import settings
 from django.contrib.gis.db import models as gis_models
-from django.contrib.gis.geos import Point
+from django.utils import timezone
 from doctors.models import Prescription, PrescriptionItem
-import requests
+from datetime import date, datetime, timedelta
+import calendar
 import logging
 
 logger = logging.getLogger(__name__)
@@ -25,36 +28,27 @@ class Pharmacy(models.Model):
     bank_account_details = models.JSONField(default=dict, blank=True, help_text="Bank account details")
     commission_rate = models.DecimalField(max_digits=5, decimal_places=2, default=5.00, help_text="Platform commission percentage for this pharmacy")
     subscription_expiry = models.DateField(null=True, blank=True, help_text="Date when the pharmacy's registration expires")
+    subscription_lapsed = models.BooleanField(default=False, help_text="Set by the daily expiry job once subscription_expiry has passed")
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def save(self, *args, **kwargs):
-        # Automatic Geocoding if location is missing but address is present
-        if not self.location and self.address:
-            try:
-                api_key = getattr(settings, 'GOOGLE_MAPS_API_KEY', None)
-                if api_key:
-                    response = requests.get(
-                        'https://maps.googleapis.com/maps/api/geocode/json',
-                        params={'address': self.address, 'key': api_key}
-                    )
-                    data = response.json()
-                    
-                    if data.get('status') == 'OK' and data.get('results'):
-                        location = data['results'][0]['geometry']['location']
-                        lat = location['lat']
-                        lng = location['lng']
-                        # Point takes (x, y) which is (longitude, latitude)
-                        self.location = Point(lng, lat, srid=4326)
-                    else:
-                        logger.warning(f"Geocoding failed for pharmacy {self.name}: {data.get('status')}")
-                else:
-                    logger.warning("GOOGLE_MAPS_API_KEY not found in settings. Automatic geocoding skipped.")
-            except Exception as e:
-                logger.error(f"Error during automatic geocoding for pharmacy {self.name}: {e}")
+        from .availability import invalidate_orderable_pharmacies
 
+        expiry = self.subscription_expiry
+        if hasattr(expiry, 'date'):
+            expiry = expiry.date()
+        if self.subscription_lapsed and expiry and expiry >= timezone.localdate():
+            self.subscription_lapsed = False
         super().save(*args, **kwargs)
+        # Again after commit, in case a concurrent read re-cached the old state.
+        invalidate_orderable_pharmacies()
+        transaction.on_commit(invalidate_orderable_pharmacies)
+        # Geocoding runs on the task queue after commit; saves never wait on the provider.
+        if not self.location and self.address:
+            from .geocoding import schedule_geocoding
+            schedule_geocoding(self)
     
     def __str__(self):
         return self.name
@@ -62,6 +56,37 @@ class Pharmacy(models.Model):
     class Meta:
         verbose_name_plural = "Pharmacies"
 
+
+@receiver(post_delete, sender=Pharmacy)
+def _invalidate_orderable_on_delete(sender, instance, **kwargs):
+    # post_delete also fires for queryset and cascade deletes, which skip Model.delete().
+    from .availability import invalidate_orderable_pharmacies
+
+    invalidate_orderable_pharmacies()
+    transaction.on_commit(invalidate_orderable_pharmacies)
+
+class GeocodedAddress(models.Model):
+    """Persistent address -> point cache shared by every geocoded model."""
+    STATUS_CHOICES = (
+        ('ok', 'Found'),
+        ('not_found', 'Not Found'),
+    )
+
+    address_hash = models.CharField(max_length=64, unique=True, help_text="SHA-256 of the normalized address")
+    address = models.TextField()
+    location = gis_models.PointField(null=True, blank=True, srid=4326)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='ok')
+    provider = models.CharField(max_length=50)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.address[:50]} ({self.status})"
+
+    class Meta:
+        verbose_name_plural = "Geocoded Addresses"
+
+
 class Medication(models.Model):
     name = models.CharField(max_length=200)
     generic_name = models.CharField(max_length=200, blank=True, null=True)
@@ -84,11 +109,18 @@ class PharmacyInventory(models.Model):
     medication = models.ForeignKey(Medication, on_delete=models.CASCADE, related_name='inventories')
     in_stock = models.BooleanField(default=True)
     quantity = models.PositiveIntegerField(default=0)
+    reserved_quantity = models.PositiveIntegerField(default=0, help_text="Units held for open orders; only changed through conditional F() updates")
+    low_stock_threshold = models.PositiveIntegerField(default=5, help_text="Alert pharmacy staff when available units fall to this level")
+    low_stock_alerted_at = models.DateTimeField(null=True, blank=True)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     last_updated = models.DateTimeField(auto_now=True)
     
     def __str__(self):
         return f"{self.pharmacy.name} - {self.medication.name} - {'In Stock' if self.in_stock else 'Out of Stock'}"
+
+    @property
+    def available_quantity(self):
+        return max(self.quantity - self.reserved_quantity, 0)
     
     class Meta:
         verbose_name_plural = "Pharmacy Inventories"
@@ -103,6 +135,15 @@ class MedicationOrder(models.Model):
         ('completed', 'Completed'),
         ('cancelled', 'Cancelled'),
     )
+
+    # Declared order lifecycle; terminal statuses have no outgoing transitions.
+    # Guards for individual edges live in pharmacy.services.OrderStateMachine.
+    ALLOWED_TRANSITIONS = {
+        'pending': ('processing', 'cancelled'),
+        'processing': ('ready', 'cancelled'),
+        'ready': ('delivering', 'completed', 'cancelled'),
+        'delivering': ('completed', 'cancelled'),
+    }
     
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='medication_orders')
     pharmacy = models.ForeignKey(Pharmacy, on_delete=models.CASCADE, related_name='orders')
@@ -139,6 +180,56 @@ class MedicationOrder(models.Model):
     def __str__(self):
         return f"Order {self.id} - {self.user.email} - {self.status}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._loaded_values = {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields
+        }
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        if hasattr(self, '_loaded_values'):
+            for field in self._meta.concrete_fields:
+                if fields is None or field.name in fields or field.attname in fields:
+                    self._loaded_values[field.attname] = getattr(self, field.attname)
+
+    def get_loaded_value(self, field_name, default=None):
+        """Value of a field as it was last read from or written to the database."""
+        field = self._meta.get_field(field_name)
+        return getattr(self, '_loaded_values', {}).get(field.attname, default)
+
+    def get_dirty_fields(self):
+        """Names of concrete fields changed in memory since the last load/save."""
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None:
+            return None
+        return [
+            field.name for field in self._meta.concrete_fields
+            if not field.primary_key
+            and field.attname in loaded
+            and getattr(self, field.attname) != loaded[field.attname]
+        ]
+
+    def save_dirty(self):
+        """Persist only the changed fields with a single UPDATE. Returns the fields written."""
+        dirty = self.get_dirty_fields()
+        if dirty is None:
+            self.save()
+            return [field.name for field in self._meta.concrete_fields]
+        if dirty:
+            self.save(update_fields=dirty)
+        return dirty
+
+    def can_transition_to(self, new_status):
+        return new_status in self.ALLOWED_TRANSITIONS.get(self.status, ())
+
 class MedicationOrderItem(models.Model):
     order = models.ForeignKey(MedicationOrder, on_delete=models.CASCADE, related_name='items')
     prescription_item = models.ForeignKey(PrescriptionItem, on_delete=models.SET_NULL, null=True, blank=True)
@@ -146,6 +237,8 @@ class MedicationOrderItem(models.Model):
     dosage_text = models.CharField(max_length=100, null=True, blank=True, help_text="Dosage as written on prescription")
     quantity = models.PositiveIntegerField(default=1)
     price_per_unit = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    inventory = models.ForeignKey(PharmacyInventory, on_delete=models.SET_NULL, null=True, blank=True, related_name='order_items', help_text="Inventory row holding this item's reservation")
+    reserved_quantity = models.PositiveIntegerField(default=0, help_text="Units currently reserved in inventory for this item")
     
     def __str__(self):
         return f"Order {self.order.id} - {self.medication_name_text}"
@@ -156,6 +249,86 @@ class MedicationOrderItem(models.Model):
              return self.quantity * self.price_per_unit
         return None
 
+class OrderEvent(models.Model):
+    """
+    Transactional outbox for order side effects.
+    Rows are written in the same transaction as the order change and
+    dispatched (notifications etc.) only after commit.
+    """
+    EVENT_TYPES = (
+        ('created', 'Created'),
+        ('priced', 'Priced'),
+        ('paid', 'Paid'),
+        ('status_changed', 'Status Changed'),
+    )
+
+    order = models.ForeignKey(MedicationOrder, on_delete=models.CASCADE, related_name='events')
+    pharmacy = models.ForeignKey(Pharmacy, on_delete=models.CASCADE, related_name='order_events')
+    event_type = models.CharField(max_length=20, choices=EVENT_TYPES)
+    from_status = models.CharField(max_length=20, blank=True)
+    to_status = models.CharField(max_length=20, blank=True)
+    actor = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    payload = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Order {self.order_id} - {self.event_type}"
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['pharmacy', 'id']),
+            models.Index(fields=['dispatched_at', 'id']),
+        ]
+
+
+class PharmacyDailyStats(models.Model):
+    """
+    Per-pharmacy daily order aggregates, incremented as orders are created and
+    change status. `orders_<status>` count transitions into that status on the day;
+    revenue and the insurance/cash mix are booked when an order completes.
+    """
+    pharmacy = models.ForeignKey(Pharmacy, on_delete=models.CASCADE, related_name='daily_stats')
+    date = models.DateField()
+    orders_created = models.PositiveIntegerField(default=0)
+    orders_processing = models.PositiveIntegerField(default=0)
+    orders_ready = models.PositiveIntegerField(default=0)
+    orders_delivering = models.PositiveIntegerField(default=0)
+    orders_completed = models.PositiveIntegerField(default=0)
+    orders_cancelled = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    insurance_orders = models.PositiveIntegerField(default=0)
+    insurance_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0, help_text="Amount covered by insurance")
+    cash_orders = models.PositiveIntegerField(default=0)
+    cash_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0, help_text="Amount paid by patients")
+    ready_seconds_total = models.BigIntegerField(default=0, help_text="Sum of order-to-ready durations for orders that became ready on this day")
+    complete_seconds_total = models.BigIntegerField(default=0, help_text="Sum of order-to-completion durations for orders completed on this day")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.pharmacy} - {self.date}"
+
+    class Meta:
+        unique_together = ('pharmacy', 'date')
+        verbose_name_plural = "Pharmacy Daily Stats"
+
+
+class PharmacyMedicationDailyStats(models.Model):
+    """Units and revenue per medication for orders completed on the day."""
+    pharmacy = models.ForeignKey(Pharmacy, on_delete=models.CASCADE, related_name='medication_daily_stats')
+    date = models.DateField()
+    medication_name = models.CharField(max_length=200)
+    quantity = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"{self.pharmacy} - {self.medication_name} - {self.date}"
+
+    class Meta:
+        unique_together = ('pharmacy', 'date', 'medication_name')
+        verbose_name_plural = "Pharmacy Medication Daily Stats"
+
 class MedicationReminder(models.Model):
     FREQUENCY_CHOICES = (
         ('daily', 'Daily'),
@@ -175,9 +348,71 @@ class MedicationReminder(models.Model):
     dosage = models.CharField(max_length=100)
     notes = models.TextField(blank=True, null=True)
     is_active = models.BooleanField(default=True)
+    next_fire_at = models.DateTimeField(null=True, blank=True, help_text="Next time this reminder is due; null once the schedule has ended.")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['is_active', 'next_fire_at']),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.next_fire_at = self.compute_next_fire_at() if self.is_active else None
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'next_fire_at'}
+        super().save(*args, **kwargs)
+
+    def get_interval_days(self):
+        """Day step for weekly/custom schedules; custom_frequency holds a number of days."""
+        if self.frequency == 'weekly':
+            return 7
+        if self.frequency == 'custom':
+            try:
+                days = int(self.custom_frequency)
+            except (TypeError, ValueError):
+                return None
+            return days if days > 0 else None
+        return None
+
+    def compute_next_fire_at(self, after=None):
+        """
+        First occurrence strictly after `after` (default: now), or None when the
+        schedule has ended or cannot be computed. Times are in the project timezone;
+        monthly reminders falling on a day a month does not have fire on its last day.
+        """
+        after = timezone.localtime(after or timezone.now())
+        day = max(self.start_date, after.date())
+
+        def fire_at(d):
+            return timezone.make_aware(datetime.combine(d, self.time_of_day))
+
+        if self.frequency == 'daily':
+            if fire_at(day) <= after:
+                day += timedelta(days=1)
+        elif self.frequency == 'monthly':
+            year, month = day.year, day.month
+            while True:
+                candidate = date(year, month, min(self.start_date.day, calendar.monthrange(year, month)[1]))
+                if candidate >= day and fire_at(candidate) > after:
+                    day = candidate
+                    break
+                year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        else:
+            interval = self.get_interval_days()
+            if interval is None:
+                return None
+            offset = (day - self.start_date).days % interval
+            if offset:
+                day += timedelta(days=interval - offset)
+            if fire_at(day) <= after:
+                day += timedelta(days=interval)
+
+        if self.end_date and day > self.end_date:
+            return None
+        return fire_at(day)
+
 class MedicationLog(models.Model):
     STATUS_CHOICES = (
         ('taken', 'Taken'),
@@ -197,4 +432,46 @@ class MedicationLog(models.Model):
         return f"{self.reminder.medication.name} - {self.status} at {self.taken_at or self.scheduled_time}"
 
     class Meta:
-        ordering = ['-scheduled_time']
\ No newline at end of file
+        ordering = ['-scheduled_time']
+
+
+class AdherenceCounts(models.Model):
+    """
+    Daily dose counters; `scheduled` counts reminder firings, `stale_skipped`
+    occurrences too late to send, the rest count MedicationLog rows.
+    """
+    date = models.DateField()
+    scheduled = models.PositiveIntegerField(default=0)
+    stale_skipped = models.PositiveIntegerField(default=0)
+    taken = models.PositiveIntegerField(default=0)
+    missed = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        abstract = True
+
+
+class ReminderAdherenceDaily(AdherenceCounts):
+    reminder = models.ForeignKey(MedicationReminder, on_delete=models.CASCADE, related_name='adherence_days')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='reminder_adherence_days')
+
+    class Meta:
+        unique_together = ('reminder', 'date')
+        indexes = [
+            models.Index(fields=['user', 'date']),
+        ]
+
+    def __str__(self):
+        return f"Reminder {self.reminder_id} on {self.date}: {self.taken}/{self.scheduled}"
+
+
+class UserAdherenceDaily(AdherenceCounts):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='adherence_days')
+
+    class Meta:
+        unique_together = ('user', 'date')
+        ordering = ['date']
+
+    def __str__(self):
+        return f"{self.user} on {self.date}: {self.taken}/{self.scheduled}"
\ No newline at end of file
@@ -0,0 +1,195 @@
+# pharmacy/search.py
+"""
+In-process prefix index for medication autocomplete.
+
+Each worker keeps a sorted array of normalized name keys and answers prefix
+lookups with bisect, ranking matches by how often the medication has been
+prescribed. The index is rebuilt in a background thread once it is older than
+REFRESH_INTERVAL; until the first build finishes lookups go to the database.
+"""
+import bisect
+import logging
+import re
+import threading
+import time
+import unicodedata
+from django.db import DatabaseError, transaction
+from django.db.models import Count, Q
+from .models import Medication
+
+logger = logging.getLogger(__name__)
+
+REFRESH_INTERVAL = 300  # seconds
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 25
+# Prefixes this short match a large slice of the catalog, so their top
+# results are precomputed at build time instead of scanned per request.
+PRECOMPUTED_PREFIX_LENGTH = 2
+
+_NON_ALNUM = re.compile(r'[^a-z0-9]+')
+
+
+def normalize(text):
+    """Lowercase, strip accents and collapse punctuation/whitespace to single spaces."""
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return _NON_ALNUM.sub(' ', text.lower()).strip()
+
+
+def _index_keys(*names):
+    """Full normalized names plus every word-start suffix ('folic acid' -> 'acid')."""
+    keys = set()
+    for name in names:
+        normalized = normalize(name)
+        if not normalized:
+            continue
+        words = normalized.split(' ')
+        for i in range(len(words)):
+            keys.add(' '.join(words[i:]))
+    return keys
+
+
+class MedicationAutocompleteIndex:
+    """Sorted-array prefix index over Medication.name and Medication.generic_name."""
+
+    def __init__(self, refresh_interval=REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._keys = []
+        self._ids = []
+        self._records = {}
+        self._rank = {}
+        self._top_by_prefix = {}
+        self._built_at = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    @property
+    def is_ready(self):
+        return self._built_at is not None
+
+    @property
+    def is_stale(self):
+        return not self.is_ready or time.monotonic() - self._built_at > self.refresh_interval
+
+    def build(self):
+        """Load the catalog and prescription counts and swap in a fresh index."""
+        from doctors.models import PrescriptionItem
+
+        frequency = dict(
+            PrescriptionItem.objects.filter(medication__isnull=False)
+            .values('medication_id')
+            .annotate(n=Count('id'))
+            .values_list('medication_id', 'n')
+        )
+
+        records = {}
+        pairs = []
+        for med in Medication.objects.values('id', 'name', 'generic_name', 'strength', 'dosage_form').iterator():
+            records[med['id']] = med
+            for key in _index_keys(med['name'], med['generic_name']):
+                pairs.append((key, med['id']))
+        pairs.sort()
+
+        rank = {
+            med_id: (-frequency.get(med_id, 0), normalize(med['name']), med_id)
+            for med_id, med in records.items()
+        }
+
+        top_by_prefix = {}
+        for key, med_id in pairs:
+            for length in range(1, PRECOMPUTED_PREFIX_LENGTH + 1):
+                if len(key) >= length:
+                    top_by_prefix.setdefault(key[:length], set()).add(med_id)
+        top_by_prefix = {
+            prefix: sorted(ids, key=rank.__getitem__)[:MAX_LIMIT]
+            for prefix, ids in top_by_prefix.items()
+        }
+
+        # Single reference swaps keep concurrent readers on a consistent snapshot.
+        self._keys = [key for key, _ in pairs]
+        self._ids = [med_id for _, med_id in pairs]
+        self._records = records
+        self._rank = rank
+        self._top_by_prefix = top_by_prefix
+        self._built_at = time.monotonic()
+        logger.info(f"Medication autocomplete index built: {len(records)} medications, {len(pairs)} keys")
+
+    def refresh_in_background(self):
+        """Start a rebuild unless one is already running."""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            from django.db import connection
+            try:
+                self.build()
+            except Exception as e:
+                logger.error(f"Medication autocomplete index refresh failed: {e}")
+            finally:
+                self._refreshing = False
+                connection.close()
+
+        threading.Thread(target=run, name='medication-autocomplete-refresh', daemon=True).start()
+
+    def lookup(self, query, limit=DEFAULT_LIMIT):
+        """Return medication records whose name or generic name has a word starting with query."""
+        prefix = normalize(query)
+        if not prefix:
+            return []
+
+        records = self._records
+        if len(prefix) <= PRECOMPUTED_PREFIX_LENGTH:
+            return [records[med_id] for med_id in self._top_by_prefix.get(prefix, ())[:limit]]
+
+        keys, ids = self._keys, self._ids
+        matches = set()
+        position = bisect.bisect_left(keys, prefix)
+        while position < len(keys) and keys[position].startswith(prefix):
+            matches.add(ids[position])
+            position += 1
+        ranked = sorted(matches, key=self._rank.__getitem__)[:limit]
+        return [records[med_id] for med_id in ranked]
+
+
+def database_lookup(query, limit=DEFAULT_LIMIT):
+    """Cold-start fallback: prefix match ranked by trigram similarity when pg_trgm is available."""
+    from django.contrib.postgres.search import TrigramSimilarity
+
+    query = query.strip()
+    if not query:
+        return []
+    fields = ('id', 'name', 'generic_name', 'strength', 'dosage_form')
+    queryset = Medication.objects.filter(
+        Q(name__istartswith=query) | Q(generic_name__istartswith=query)
+        | Q(name__icontains=f' {query}') | Q(generic_name__icontains=f' {query}')
+    )
+    try:
+        with transaction.atomic():
+            return list(
+                queryset.annotate(similarity=TrigramSimilarity('name', query))
+                .order_by('-similarity', 'name')
+                .values(*fields)[:limit]
+            )
+    except DatabaseError as e:
+        logger.warning(f"Trigram ranking unavailable for medication autocomplete: {e}")
+        return list(queryset.order_by('name').values(*fields)[:limit])
+
+
+medication_index = MedicationAutocompleteIndex()
+
+
+def autocomplete_medications(query, limit=DEFAULT_LIMIT):
+    """
+    Answer from the in-process index, scheduling a rebuild when it is stale.
+    Returns (results, source) where source is 'index' or 'database'.
+    """
+    limit = max(1, min(limit, MAX_LIMIT))
+    if medication_index.is_stale:
+        medication_index.refresh_in_background()
+    if not medication_index.is_ready:
+        return database_lookup(query, limit), 'database'
+    return medication_index.lookup(query, limit), 'index'
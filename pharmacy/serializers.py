@@ -2,10 +2,11 @@
 from rest_framework import serializers
 from .models import (
     Pharmacy, Medication, PharmacyInventory,
-    MedicationOrder, MedicationOrderItem, MedicationReminder,
+    MedicationOrder, MedicationOrderItem, OrderEvent, MedicationReminder,
     MedicationLog
 )
 from users.serializers import UserSerializer
+from insurance.serializers import UserInsuranceSerializer
 from django.contrib.gis.geos import Point
 
 class PharmacySerializer(serializers.ModelSerializer):
@@ -73,11 +74,22 @@ class PharmacyInventorySerializer(serializers.ModelSerializer):
         write_only=True,
         required=False
     )
+    available_quantity = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = PharmacyInventory
-        fields = ['id', 'pharmacy', 'medication', 'medication_id', 'in_stock', 'quantity', 'price', 'last_updated']
-        read_only_fields = ['last_updated', 'pharmacy']
+        fields = [
+            'id', 'pharmacy', 'medication', 'medication_id', 'in_stock', 'quantity',
+            'reserved_quantity', 'available_quantity', 'low_stock_threshold', 'price', 'last_updated'
+        ]
+        read_only_fields = ['last_updated', 'pharmacy', 'reserved_quantity']
+
+    def validate_quantity(self, value):
+        if self.instance and value < self.instance.reserved_quantity:
+            raise serializers.ValidationError(
+                f"Quantity cannot be lower than the {self.instance.reserved_quantity} units reserved for open orders."
+            )
+        return value
 
 
 class PharmacyOrderItemViewSerializer(serializers.ModelSerializer):
@@ -99,7 +111,6 @@ class MedicationOrderItemSerializer(serializers.ModelSerializer):
 
 class PharmacyOrderListSerializer(serializers.ModelSerializer):
     patient_name = serializers.SerializerMethodField()
-    payment_status = serializers.SerializerMethodField()
 
     class Meta:
         model = MedicationOrder
@@ -109,21 +120,12 @@ class PharmacyOrderListSerializer(serializers.ModelSerializer):
         if obj.user:
             return f"{obj.user.first_name} {obj.user.last_name}".strip() or obj.user.username
         return "N/A"
-    
-    def get_payment_status(self, obj):
-        """Safely get payment_status, handling cases where the field doesn't exist in DB yet"""
-        try:
-            if hasattr(obj, 'payment_status'):
-                return obj.payment_status
-            return 'pending'  # Default value if field doesn't exist
-        except (AttributeError, KeyError):
-            return 'pending'
+
 
 class PharmacyOrderDetailSerializer(serializers.ModelSerializer):
     items = PharmacyOrderItemViewSerializer(many=True, read_only=True)
     user = UserSerializer(read_only=True)
-    user_insurance = serializers.SerializerMethodField(read_only=True)
-    payment_status = serializers.SerializerMethodField(read_only=True)
+    user_insurance = UserInsuranceSerializer(read_only=True)
 
     class Meta:
         model = MedicationOrder
@@ -140,28 +142,7 @@ class PharmacyOrderDetailSerializer(serializers.ModelSerializer):
             'user_insurance', 'insurance_covered_amount', 'patient_copay',
             'insurance_claim_generated', 'payment_status'
         ]
-    
-    def get_user_insurance(self, obj):
-        if obj.user_insurance:
-            from insurance.serializers import UserInsuranceSerializer
-            return UserInsuranceSerializer(obj.user_insurance).data
-        return None
-    
-    def get_payment_status(self, obj):
-        """Safely get payment_status, handling cases where the field doesn't exist in DB yet"""
-        try:
-            # Refresh from database to get the latest payment_status
-            # This ensures we get the updated value after payment_reference is set
-            if hasattr(obj, 'pk') and obj.pk:
-                try:
-                    obj.refresh_from_db(fields=['payment_status', 'payment_reference'])
-                except Exception:
-                    pass  # If refresh fails, use current value
-            if hasattr(obj, 'payment_status'):
-                return obj.payment_status
-            return 'pending'  # Default value if field doesn't exist
-        except (AttributeError, KeyError):
-            return 'pending'
+
 
 class MedicationOrderSerializer(serializers.ModelSerializer):
     items = MedicationOrderItemSerializer(many=True)
@@ -176,14 +157,13 @@ class MedicationOrderSerializer(serializers.ModelSerializer):
         allow_null=True,
         help_text="ID of the insurance plan to use for this order"
     )
-    user_insurance = serializers.SerializerMethodField(read_only=True)
+    user_insurance = UserInsuranceSerializer(read_only=True)
     payment_reference = serializers.CharField(
         write_only=True,
         required=False,
         allow_null=True,
         help_text="Payment reference/transaction ID from payment gateway"
     )
-    payment_status = serializers.SerializerMethodField(read_only=True)
 
     class Meta:
         model = MedicationOrder
@@ -216,41 +196,6 @@ class MedicationOrderSerializer(serializers.ModelSerializer):
                 raise serializers.ValidationError("Insurance plan not found or does not belong to you.")
         return value
     
-    def get_user_insurance(self, obj):
-        if obj.user_insurance:
-            from insurance.serializers import UserInsuranceSerializer
-            return UserInsuranceSerializer(obj.user_insurance).data
-        return None
-
-    def get_payment_status(self, obj):
-        """Safely get payment_status, always fetching fresh from database"""
-        try:
-            # Always refresh from database to get the latest payment_status
-            # This ensures we get the updated value after payment_reference is set
-            if hasattr(obj, 'pk') and obj.pk:
-                try:
-                    # Force refresh from database
-                    obj.refresh_from_db(fields=['payment_status', 'payment_reference'])
-                    # Double-check by querying directly to ensure we have the latest value
-                    from pharmacy.models import MedicationOrder
-                    db_obj = MedicationOrder.objects.filter(pk=obj.pk).values('payment_status', 'payment_reference').first()
-                    if db_obj:
-                        # Use the value directly from database
-                        return db_obj['payment_status']
-                except Exception as e:
-                    import logging
-                    logger = logging.getLogger(__name__)
-                    logger.warning(f"Failed to refresh payment_status for order {obj.pk}: {e}")
-                    # If refresh fails, use current value
-            if hasattr(obj, 'payment_status'):
-                return obj.payment_status
-            return 'pending'  # Default value if field doesn't exist
-        except (AttributeError, KeyError) as e:
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.warning(f"Error getting payment_status for order {getattr(obj, 'pk', 'unknown')}: {e}")
-            return 'pending'
-
     def create(self, validated_data):
         items_data = validated_data.pop('items')
         order = MedicationOrder.objects.create(**validated_data)
@@ -260,19 +205,14 @@ class MedicationOrderSerializer(serializers.ModelSerializer):
 
 
 class PharmacyOrderUpdateSerializer(serializers.ModelSerializer):
-    user_insurance = serializers.SerializerMethodField(read_only=True)
+    user_insurance = UserInsuranceSerializer(read_only=True)
     payment_reference = serializers.CharField(
         write_only=True,
         required=False,
         allow_null=True,
         help_text="Payment reference/transaction ID from payment gateway"
     )
-    ALLOWED_STATUS_TRANSITIONS = {
-        'pending': ['processing', 'cancelled'],
-        'processing': ['ready', 'cancelled'],
-        'ready': ['delivering', 'completed', 'cancelled'],
-        'delivering': ['completed', 'cancelled'],
-    }
+    ALLOWED_STATUS_TRANSITIONS = MedicationOrder.ALLOWED_TRANSITIONS
 
     class Meta:
         model = MedicationOrder
@@ -285,17 +225,11 @@ class PharmacyOrderUpdateSerializer(serializers.ModelSerializer):
             'user_insurance', 'insurance_covered_amount', 'patient_copay',
             'insurance_claim_generated'
         ]
-    
-    def get_user_insurance(self, obj):
-        if obj.user_insurance:
-            from insurance.serializers import UserInsuranceSerializer
-            return UserInsuranceSerializer(obj.user_insurance).data
-        return None
 
     def validate_status(self, value):
         if self.instance:
             current_status = self.instance.status
-            allowed_next = self.ALLOWED_STATUS_TRANSITIONS.get(current_status, [])
+            allowed_next = self.ALLOWED_STATUS_TRANSITIONS.get(current_status, ())
             if value not in allowed_next:
                 raise serializers.ValidationError(
                     f"Cannot transition from status '{current_status}' to '{value}'. "
@@ -304,6 +238,29 @@ class PharmacyOrderUpdateSerializer(serializers.ModelSerializer):
         return value
 
 
+class OrderEventSerializer(serializers.ModelSerializer):
+    """Compact order frame pushed to the pharmacy portal over WebSockets."""
+    cursor = serializers.IntegerField(source='id', read_only=True)
+    event = serializers.CharField(source='event_type', read_only=True)
+    order = serializers.SerializerMethodField()
+
+    class Meta:
+        model = OrderEvent
+        fields = ['cursor', 'event', 'order', 'from_status', 'to_status', 'created_at']
+        read_only_fields = fields
+
+    def get_order(self, obj):
+        order = obj.order
+        return {
+            'id': order.id,
+            'status': order.status,
+            'payment_status': order.payment_status,
+            'total_amount': str(order.total_amount) if order.total_amount is not None else None,
+            'is_delivery': order.is_delivery,
+            'order_date': order.order_date.isoformat() if order.order_date else None,
+        }
+
+
 class MedicationReminderSerializer(serializers.ModelSerializer):
     medication_display = MedicationSerializer(source='medication', read_only=True)
     medication_id = serializers.PrimaryKeyRelatedField(
@@ -323,9 +280,9 @@ class MedicationReminderSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'user', 'medication_display', 'medication_id', 'medication_name_input',
             'prescription_item', 'start_date', 'end_date', 'time_of_day', 'frequency',
-            'custom_frequency', 'dosage', 'notes', 'is_active', 'created_at', 'updated_at'
+            'custom_frequency', 'dosage', 'notes', 'is_active', 'next_fire_at', 'created_at', 'updated_at'
         ]
-        read_only_fields = ['user', 'created_at', 'updated_at']
+        read_only_fields = ['user', 'next_fire_at', 'created_at', 'updated_at']
         extra_kwargs = {
             'prescription_item': {'required': False, 'allow_null': True}
         }
@@ -0,0 +1,352 @@
+# pharmacy/services.py
+"""
+Order workflow for medication orders: state machine, single-write persistence
+and the post-commit outbox dispatcher.
+"""
+import logging
+from decimal import Decimal
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from notifications.utils import create_notification
+from . import analytics, inventory
+from .models import MedicationOrder, OrderEvent
+
+logger = logging.getLogger(__name__)
+
+
+def _require_payment(order):
+    """Uninsured, priced orders must be paid before they can leave 'pending'."""
+    if order.user_insurance_id or not order.total_amount or order.total_amount <= 0:
+        return None
+    if order.payment_reference and order.payment_status == 'paid':
+        return None
+    return (
+        'Payment is required for this order. Please ensure the patient has completed '
+        'payment before the order can proceed to processing.'
+    )
+
+
+# Guards per (from_status, to_status) edge. Each returns an error message or None.
+TRANSITION_GUARDS = {
+    ('pending', 'processing'): (_require_payment,),
+}
+
+# Patient notification per target status: (verb, title, level, action_text)
+STATUS_NOTIFICATIONS = {
+    'processing': (
+        "Your medication order #{id} from {pharmacy} is now being processed.",
+        "Order #{id} Processing", 'info', "View Order",
+    ),
+    'ready': (
+        "Your medication order #{id} from {pharmacy} is ready for {fulfilment}.",
+        "Order #{id} Ready", 'success', "View Order",
+    ),
+    'delivering': (
+        "Your medication order #{id} from {pharmacy} is out for delivery.",
+        "Order #{id} Out for Delivery", 'info', "Track Order",
+    ),
+    'completed': (
+        "Your medication order #{id} from {pharmacy} has been completed.",
+        "Order #{id} Completed", 'success', "View Order",
+    ),
+    'cancelled': (
+        "Your medication order #{id} from {pharmacy} has been cancelled.",
+        "Order #{id} Cancelled", 'warning', "View Details",
+    ),
+}
+
+
+class OrderStateMachine:
+    """
+    Applies edits to a MedicationOrder in memory, validates status changes against
+    MedicationOrder.ALLOWED_TRANSITIONS and TRANSITION_GUARDS, and persists the
+    result with a single UPDATE. Side effects are written to the OrderEvent outbox
+    in the same transaction and dispatched after commit.
+    """
+
+    def __init__(self, order, actor=None):
+        self.order = order
+        self.actor = actor
+        self.initial_status = order.status
+        self.initial_total = order.total_amount
+        self.initial_payment_status = order.payment_status
+
+    def apply(self, changes):
+        """Set field values; a 'status' key is routed through transition_to()."""
+        for attr, value in changes.items():
+            if attr == 'status':
+                if value != self.order.status:
+                    self.transition_to(value)
+            else:
+                setattr(self.order, attr, value)
+        return self
+
+    def transition_to(self, new_status):
+        if not self.order.can_transition_to(new_status):
+            allowed = MedicationOrder.ALLOWED_TRANSITIONS.get(self.order.status, ())
+            raise ValidationError({
+                'status': f"Cannot transition from status '{self.order.status}' to '{new_status}'. "
+                          f"Allowed transitions: {', '.join(allowed) or 'None'}."
+            })
+        self.order.status = new_status
+        return self
+
+    def record_payment(self, payment_reference):
+        self.order.payment_reference = payment_reference
+        self.order.payment_status = 'paid'
+        return self
+
+    @property
+    def status_changed(self):
+        return self.order.status != self.initial_status
+
+    def save(self):
+        order = self.order
+        with transaction.atomic():
+            self._check_guards()
+            self._update_stock()
+            self._recalculate_coverage()
+            self._generate_claim()
+            order.save_dirty()
+            if self.status_changed:
+                analytics.record_status_change(order, order.status)
+
+            events = OrderEvent.objects.bulk_create(self._collect_events())
+            if events:
+                event_ids = [event.pk for event in events]
+                transaction.on_commit(lambda: dispatch_order_events(event_ids))
+        return order
+
+    def _check_guards(self):
+        if not self.status_changed:
+            return
+        for guard in TRANSITION_GUARDS.get((self.initial_status, self.order.status), ()):
+            error = guard(self.order)
+            if error:
+                raise ValidationError({'status': error})
+
+    def _update_stock(self):
+        order = self.order
+        if self.status_changed and order.status == 'completed':
+            inventory.commit_stock(order)
+        elif self.status_changed and order.status == 'cancelled':
+            inventory.release_stock(order)
+        elif self.is_being_priced:
+            # Pricing confirms the order, so every tracked item must be covered by stock.
+            inventory.reserve_stock(order, strict=True)
+
+    @property
+    def is_being_priced(self):
+        return not self.initial_total and bool(self.order.total_amount) and self.order.total_amount > 0
+
+    def _recalculate_coverage(self):
+        order = self.order
+        if not order.user_insurance_id or not order.total_amount:
+            return
+        dirty = set(order.get_dirty_fields() or ())
+        if not ({'total_amount', 'user_insurance'} & dirty) and order.insurance_covered_amount is not None:
+            return
+
+        from insurance.utils import calculate_insurance_coverage
+
+        coverage = calculate_insurance_coverage(
+            order.user_insurance,
+            Decimal(str(order.total_amount)),
+            service_type='medication'
+        )
+        order.insurance_covered_amount = coverage['covered_amount']
+        order.patient_copay = coverage['patient_copay']
+
+    def _generate_claim(self):
+        order = self.order
+        if not (self.status_changed and order.status == 'completed'):
+            return
+        if not order.user_insurance_id or not order.total_amount or order.insurance_claim_generated:
+            return
+
+        from insurance.utils import generate_insurance_claim
+
+        try:
+            items_desc = ", ".join(
+                f"{item.medication_name_text or 'Medication'} ({item.quantity}x)"
+                for item in order.items.all()
+            )
+            # Savepoint: a failed claim insert must not break the order's transaction.
+            with transaction.atomic():
+                generate_insurance_claim(
+                    user_insurance=order.user_insurance,
+                    service_type='medication',
+                    service_date=order.order_date.date(),
+                    provider_name=order.pharmacy.name,
+                    service_description=f"Medication Order: {items_desc}",
+                    claimed_amount=order.total_amount,
+                    approved_amount=order.insurance_covered_amount,
+                    patient_responsibility=order.patient_copay,
+                )
+            order.insurance_claim_generated = True
+        except Exception as e:
+            logger.error(f"Error generating insurance claim for order {order.id}: {e}")
+
+    def _collect_events(self):
+        order = self.order
+        events = []
+
+        def event(event_type, **kwargs):
+            events.append(OrderEvent(
+                order=order,
+                pharmacy_id=order.pharmacy_id,
+                event_type=event_type,
+                actor=self.actor,
+                **kwargs
+            ))
+
+        if self.initial_payment_status != 'paid' and order.payment_status == 'paid':
+            event('paid', payload={'payment_reference': order.payment_reference})
+
+        if self.is_being_priced:
+            event('priced', payload={'total_amount': str(order.total_amount)})
+
+        if self.status_changed:
+            event('status_changed', from_status=self.initial_status, to_status=order.status)
+
+        return events
+
+
+def _notify_paid(event):
+    order = event.order
+    create_notification(
+        recipient=order.user,
+        verb=f"Payment confirmed for your medication order #{order.id}.",
+        title=f"Payment Confirmed - Order #{order.id}",
+        level='success',
+        category='order',
+        action_url=f"/orders/{order.id}",
+        action_text="View Order"
+    )
+
+
+def _notify_priced(event):
+    order = event.order
+    pharmacy_name = order.pharmacy.name if order.pharmacy else "Pharmacy"
+    total_formatted = f"₦{Decimal(event.payload.get('total_amount') or order.total_amount):,.2f}"
+
+    if order.user_insurance_id:
+        message = f"Your medication order #{order.id} from {pharmacy_name} has been priced at {total_formatted}. Your insurance coverage and copay have been calculated."
+    else:
+        message = f"Your medication order #{order.id} from {pharmacy_name} has been priced at {total_formatted}. Please proceed with payment to continue."
+
+    create_notification(
+        recipient=order.user,
+        verb=message,
+        title=f"Order #{order.id} Priced",
+        level='info',
+        category='order',
+        action_url=f"/orders/{order.id}",
+        action_text="View Order & Pay"
+    )
+
+
+def _notify_status_changed(event):
+    spec = STATUS_NOTIFICATIONS.get(event.to_status)
+    if not spec:
+        return
+    order = event.order
+    verb, title, level, action_text = spec
+    context = {
+        'id': order.id,
+        'pharmacy': order.pharmacy.name if order.pharmacy else "Pharmacy",
+        'fulfilment': 'delivery' if order.is_delivery else 'pickup',
+    }
+    create_notification(
+        recipient=order.user,
+        verb=verb.format(**context),
+        title=title.format(**context),
+        level=level,
+        category='order',
+        action_url=f"/orders/{order.id}",
+        action_text=action_text
+    )
+
+
+EVENT_HANDLERS = {
+    'paid': _notify_paid,
+    'priced': _notify_priced,
+    'status_changed': _notify_status_changed,
+}
+
+
+def pharmacy_orders_group(pharmacy_id):
+    """Channel layer group that receives order events for one pharmacy's portal."""
+    return f"pharmacy_{pharmacy_id}_orders"
+
+
+def record_order_created(order, actor=None):
+    """
+    Book a new order: reserve whatever stock is available for its items, count
+    it in the pharmacy's analytics and write the 'created' outbox row, which is
+    dispatched after commit.
+    """
+    inventory.reserve_stock(order)
+    analytics.record_order_created(order)
+    event = OrderEvent.objects.create(
+        order=order,
+        pharmacy_id=order.pharmacy_id,
+        event_type='created',
+        to_status=order.status,
+        actor=actor,
+    )
+    transaction.on_commit(lambda: dispatch_order_events([event.pk]))
+    return event
+
+
+def broadcast_order_events(events):
+    """Push compact order frames to each pharmacy's portal group."""
+    channel_layer = get_channel_layer()
+    if channel_layer is None or not events:
+        return
+
+    from .serializers import OrderEventSerializer
+
+    group_send = async_to_sync(channel_layer.group_send)
+    for event in events:
+        try:
+            group_send(pharmacy_orders_group(event.pharmacy_id), {
+                'type': 'order.event',
+                'event': OrderEventSerializer(event).data,
+            })
+        except Exception as e:
+            # Portals recover missed frames through the resume cursor.
+            logger.warning(f"Could not broadcast order event {event.pk}: {e}")
+
+
+def dispatch_order_events(event_ids):
+    """
+    Run side effects for outbox rows, mark them dispatched and broadcast them
+    to the pharmacy portal. Rows are claimed with SKIP LOCKED so the
+    post-commit hook and the sweeper task never handle the same event twice.
+    """
+    with transaction.atomic():
+        events = list(
+            OrderEvent.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(pk__in=event_ids, dispatched_at__isnull=True)
+            .select_related('order__user', 'order__pharmacy')
+        )
+        for event in events:
+            handler = EVENT_HANDLERS.get(event.event_type)
+            if handler is None:
+                continue
+            try:
+                handler(event)
+            except Exception as e:
+                logger.error(f"Error dispatching {event.event_type} event for order {event.order_id}: {e}")
+
+        if events:
+            OrderEvent.objects.filter(pk__in=[event.pk for event in events]).update(
+                dispatched_at=timezone.now()
+            )
+
+    broadcast_order_events(events)
+    return len(events)
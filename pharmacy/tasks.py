@@ -1,95 +1,224 @@
 # pharmacy/tasks.py
 import logging
-from datetime import date
+from datetime import timedelta
 from celery import shared_task
-from django.utils import timezone
+from django.db import transaction
 from django.db.models import Q
-from .models import MedicationReminder
-from vitanips.core.utils import send_app_email
-from notifications.utils import create_notification
+from django.utils import timezone
+from .models import MedicationReminder, OrderEvent
+from .adherence import record_scheduled
+from notifications.models import Notification
+from notifications.utils import TITLE_MAX_LENGTH, create_notifications, save_notifications
 
 logger = logging.getLogger(__name__)
 
-def is_reminder_due(reminder: MedicationReminder, today: date) -> bool:
-    start_date = reminder.start_date
-    if reminder.frequency == MedicationReminder.FrequencyChoices.DAILY:
-        return True
-    elif reminder.frequency == MedicationReminder.FrequencyChoices.WEEKLY:
-        return start_date.weekday() == today.weekday()
-    elif reminder.frequency == MedicationReminder.FrequencyChoices.MONTHLY:
-        try:
-            return start_date.day == today.day
-        except ValueError:
-            return False
-    elif reminder.frequency == MedicationReminder.FrequencyChoices.CUSTOM:
+# Occurrences older than this (e.g. after worker downtime) are skipped rather than sent late.
+REMINDER_MAX_LATENESS = timedelta(hours=1)
+
+
+def schedule_unscheduled_reminders(now, batch_size):
+    """
+    Give active reminders saved before next_fire_at existed their next
+    occurrence, in batches with bulk_update. Occurrences within the lateness
+    window still count, so such a reminder fires in the same run. Reminders
+    past their end_date keep next_fire_at null and are not looked at.
+    """
+    today = timezone.localdate(now)
+    pending = MedicationReminder.objects.filter(
+        Q(end_date__isnull=True) | Q(end_date__gte=today), is_active=True, next_fire_at__isnull=True
+    ).order_by('pk')
+    scheduled = 0
+    last_pk = 0
+    while True:
+        reminders = list(pending.filter(pk__gt=last_pk)[:batch_size])
+        if not reminders:
+            break
+        last_pk = reminders[-1].pk
+        for reminder in reminders:
+            reminder.next_fire_at = reminder.compute_next_fire_at(after=now - REMINDER_MAX_LATENESS)
+        reminders = [reminder for reminder in reminders if reminder.next_fire_at]
+        MedicationReminder.objects.bulk_update(reminders, ['next_fire_at'])
+        scheduled += len(reminders)
+    if scheduled:
+        logger.info(f"Scheduled {scheduled} medication reminders that had no next_fire_at")
+    return scheduled
+
+
+def claim_due_reminders(now, batch_size):
+    """
+    Lock up to batch_size due reminders with SKIP LOCKED, advance their
+    next_fire_at in one bulk UPDATE, count the occurrences in the adherence
+    rollups (stale ones separately) and return them with the occurrence that
+    was due. Concurrent workers never claim the same row.
+    """
+    with transaction.atomic():
+        reminders = list(
+            MedicationReminder.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(is_active=True, next_fire_at__lte=now)
+            .select_related('user', 'medication')
+            .order_by('next_fire_at')[:batch_size]
+        )
+        due = []
+        for reminder in reminders:
+            due.append((reminder, reminder.next_fire_at))
+            reminder.next_fire_at = reminder.compute_next_fire_at(after=now)
+        MedicationReminder.objects.bulk_update(reminders, ['next_fire_at'])
+        record_scheduled(due, stale_before=now - REMINDER_MAX_LATENESS)
+    return due
+
+
+def send_medication_reminders(due):
+    """
+    Notify a batch of (reminder, occurrence) pairs: one INSERT for the in-app
+    notifications, then one email task for the users who asked for reminder
+    emails, sent through the batched delivery engine.
+    """
+    from notifications.tasks import send_email_notifications_batch
+
+    notifications = []
+    for reminder, fire_at in due:
+        medication_name = reminder.medication.name
+        notifications.append(Notification(
+            recipient=reminder.user,
+            title=f"Medication Reminder: {medication_name}"[:TITLE_MAX_LENGTH],
+            verb=f"Time to take {medication_name} ({reminder.dosage}).",
+            level='info',
+            category='medication',
+            action_url="/medications/reminders",
+            action_text="Log Dose",
+            metadata={'reminder_id': reminder.id, 'scheduled_time': fire_at.isoformat()},
+        ))
+    notifications = save_notifications(notifications)
+
+    email_ids = [
+        notification.pk for notification, (reminder, _) in zip(notifications, due)
+        if reminder.user.email and reminder.user.notify_refill_reminder_email
+    ]
+    if email_ids:
+        transaction.on_commit(lambda: send_email_notifications_batch.delay(email_ids))
+    return len(notifications)
+
+
+@shared_task(name="pharmacy.tasks.send_medication_reminders_task")
+def send_medication_reminders_task(batch_size=200):
+    """
+    Send every reminder whose next_fire_at has passed. Work per run is
+    proportional to the number of due reminders, not the table size.
+    """
+    now = timezone.now()
+    schedule_unscheduled_reminders(now, batch_size)
+    sent = skipped = 0
+    while True:
         try:
-            days_interval = int(reminder.custom_frequency)
-            if days_interval > 0:
-                delta_days = (today - start_date).days
-                return delta_days >= 0 and delta_days % days_interval == 0
-        except (ValueError, TypeError):
-            logger.warning(f"Invalid custom_frequency for reminder {reminder.id}")
-    return False
-
-@shared_task(name="pharmacy.tasks.send_medication_reminders_task", bind=True)
-def send_medication_reminders_task(self):
-    """Send medication reminders for due schedules."""
+            # A failed insert rolls the claim back, so the batch is retried on the next run.
+            with transaction.atomic():
+                due = claim_due_reminders(now, batch_size)
+                fresh = [(reminder, fire_at) for reminder, fire_at in due if now - fire_at <= REMINDER_MAX_LATENESS]
+                batch_sent = send_medication_reminders(fresh) if fresh else 0
+        except Exception as e:
+            logger.error(f"Failed to send medication reminders, will retry next run: {e}")
+            break
+        if not due:
+            break
+        sent += batch_sent
+        skipped += len(due) - len(fresh)
+        if len(due) < batch_size:
+            break
+
+    if not (sent or skipped):
+        return "No reminders to process"
+    result = f"Sent {sent} medication reminders, skipped {skipped} stale"
+    logger.info(result)
+    return result
+
+
+@shared_task(name="pharmacy.tasks.dispatch_pending_order_events")
+def dispatch_pending_order_events(batch_size=500):
+    """Dispatch order outbox rows whose post-commit hook never ran (e.g. the process died)."""
+    from .services import dispatch_order_events
+
+    cutoff = timezone.now() - timedelta(minutes=5)
+    event_ids = list(
+        OrderEvent.objects.filter(dispatched_at__isnull=True, created_at__lt=cutoff)
+        .values_list('id', flat=True)[:batch_size]
+    )
+    if not event_ids:
+        return 0
+    dispatched = dispatch_order_events(event_ids)
+    logger.info(f"Dispatched {dispatched} pending order events")
+    return dispatched
+
+
+@shared_task(name="pharmacy.tasks.geocode_location_task", bind=True, max_retries=3)
+def geocode_location_task(self, model_label, pk):
+    """Resolve the location of one Pharmacy or EmergencyService row."""
+    from .geocoding import apply_geocode, GeocodingError
+
     try:
-        now = timezone.now()
-        today = now.date()
-        current_time = now.time()
-
-        potential_reminders = MedicationReminder.objects.filter(
-            is_active=True,
-            start_date__lte=today,
-            time_of_day__hour=current_time.hour,
-            time_of_day__minute=current_time.minute,
-        ).filter(
-            Q(end_date__gte=today) | Q(end_date__isnull=True)
-        ).select_related('user', 'medication').prefetch_related('user__profile')
-
-        if not potential_reminders.exists():
-            logger.info("No medication reminders for current time slot")
-            return "No reminders to process"
-
-        reminders_due_count = 0
-        for reminder in potential_reminders:
-            if not is_reminder_due(reminder, today):
-                continue
-
-            user = reminder.user
-            if not (user and user.email and user.notify_refill_reminder_email):
-                logger.debug(f"Skipping reminder {reminder.id}: Invalid user or notification settings")
-                continue
-
-            reminders_due_count += 1
-            try:
-                context = {
-                    'user': user,
-                    'reminder': reminder,
-                    'medication': reminder.medication,
-                    'subject': f"Medication Reminder: {reminder.medication.name}"
-                }
-                send_app_email(
-                    to_email=user.email,
-                    subject=context['subject'],
-                    template_name='emails/medication_reminder.html',
-                    context=context
-                )
-                create_notification(
-                    user=user,
-                    notification_type='MEDICATION_REMINDER',
-                    message=f"Time to take {reminder.medication.name}",
-                    related_object=reminder
-                )
-                logger.info(f"Sent reminder for '{reminder.medication.name}' to {user.email}")
-            except Exception as e:
-                logger.error(f"Failed to send reminder {reminder.id} to {user.email}: {str(e)}")
-
-        result = f"Processed {potential_reminders.count()} reminders, sent {reminders_due_count}"
-        logger.info(result)
-        return result
-
-    except Exception as e:
-        logger.error(f"Medication reminder task failed: {str(e)}", exc_info=True)
-        raise self.retry(countdown=300)
\ No newline at end of file
+        return apply_geocode(model_label, pk)
+    except GeocodingError as e:
+        logger.warning(f"Geocoding {model_label} {pk} failed: {e}")
+        raise self.retry(countdown=60 * (2 ** self.request.retries), exc=e)
+
+
+@shared_task(name="pharmacy.tasks.backfill_geocodes_task")
+def backfill_geocodes_task(batch_size=100, max_lookups=500):
+    """Periodic, rate-limited backfill of missing pharmacy and emergency service locations."""
+    from .geocoding import backfill_locations
+
+    return backfill_locations(batch_size=batch_size, max_lookups=max_lookups)
+
+
+LOW_STOCK_ITEMS_PER_ALERT = 10
+
+
+@shared_task(name="pharmacy.tasks.send_low_stock_alerts")
+def send_low_stock_alerts():
+    """
+    Send each pharmacy's staff one notification listing inventory that has fallen
+    to its low-stock threshold. Rows are alerted once until restocked.
+    """
+    from django.contrib.auth import get_user_model
+    from .inventory import low_stock_queryset, mark_low_stock_alerted, reset_low_stock_alerts
+
+    User = get_user_model()
+    reset_low_stock_alerts()
+
+    by_pharmacy = {}
+    for row in low_stock_queryset().select_related('medication').order_by('pharmacy_id', 'quantity'):
+        by_pharmacy.setdefault(row.pharmacy_id, []).append(row)
+    if not by_pharmacy:
+        return 0
+
+    staff_by_pharmacy = {}
+    for staff in User.objects.filter(is_pharmacy_staff=True, is_active=True, works_at_pharmacy_id__in=by_pharmacy.keys()):
+        staff_by_pharmacy.setdefault(staff.works_at_pharmacy_id, []).append(staff)
+
+    for pharmacy_id, rows in by_pharmacy.items():
+        listed = ", ".join(
+            f"{row.medication.name} ({row.available_quantity} left)" for row in rows[:LOW_STOCK_ITEMS_PER_ALERT]
+        )
+        if len(rows) > LOW_STOCK_ITEMS_PER_ALERT:
+            listed += f" and {len(rows) - LOW_STOCK_ITEMS_PER_ALERT} more"
+        create_notifications(
+            staff_by_pharmacy.get(pharmacy_id, []),
+            verb=f"Low stock: {listed}.",
+            title=f"{len(rows)} item(s) running low",
+            level='warning',
+            category='system',
+            action_url="/portal/inventory",
+            action_text="Restock"
+        )
+
+    alerted = mark_low_stock_alerted([row.pk for rows in by_pharmacy.values() for row in rows])
+    logger.info(f"Sent low stock alerts for {alerted} inventory items across {len(by_pharmacy)} pharmacies")
+    return alerted
+
+
+@shared_task(name="pharmacy.tasks.expire_pharmacy_subscriptions")
+def expire_pharmacy_subscriptions():
+    """Bulk-expire lapsed subscription records and flag pharmacies whose registration has expired."""
+    from .availability import expire_lapsed_subscriptions
+
+    records_expired, pharmacies_flagged = expire_lapsed_subscriptions()
+    return f"Expired {records_expired} subscriptions, flagged {pharmacies_flagged} pharmacies"
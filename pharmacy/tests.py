@@ -1,15 +1,20 @@
 # pharmacy/tests.py
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.core.cache import cache
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from django.contrib.gis.geos import Point
-from datetime import timedelta, time
+from datetime import date, datetime, timedelta, time
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
-from unittest.mock import patch, MagicMock
+from rest_framework.pagination import PageNumberPagination
+from unittest.mock import patch
 
 from .models import Pharmacy, Medication, PharmacyInventory, MedicationOrder, MedicationReminder
 from doctors.models import Doctor, Prescription, PrescriptionItem, Appointment
+from notifications.models import Notification
 
 User = get_user_model()
 
@@ -177,11 +182,8 @@ class PrescriptionForwardingTest(APITestCase):
         )
         self.client.force_authenticate(user=self.user)
     
-    @patch('pharmacy.tasks.send_app_email')
-    def test_forward_prescription_to_pharmacy(self, mock_send_email):
+    def test_forward_prescription_to_pharmacy(self):
         """Test forwarding prescription to pharmacy"""
-        mock_send_email.return_value = True
-        
         # Use the correct endpoint: /api/doctors/prescriptions/<pk>/forward/
         url = f'/api/doctors/prescriptions/{self.prescription.id}/forward/'
         data = {'pharmacy_id': self.pharmacy.id}
@@ -229,225 +231,181 @@ class MedicationReminderTest(TestCase):
         self.assertEqual(self.reminder.frequency, 'daily')
         self.assertTrue(self.reminder.is_active)
     
-    @patch('pharmacy.tasks.send_app_email')
-    @patch('pharmacy.tasks.create_notification')
-    @patch('pharmacy.tasks.is_reminder_due')
-    @patch('pharmacy.tasks.MedicationReminder.objects.filter')
-    def test_send_daily_medication_reminder(self, mock_filter, mock_is_due, mock_notification, mock_send_email):
-        """Test sending daily medication reminder at scheduled time"""
-        from pharmacy.tasks import send_medication_reminders_task
-        
-        # Create a mock queryset
-        mock_queryset = MagicMock()
-        mock_queryset.exists.return_value = True
-        mock_queryset.count.return_value = 1
-        mock_queryset.__iter__.return_value = iter([self.reminder])
-        
-        # Setup mock filter chain
-        mock_filter.return_value.filter.return_value.select_related.return_value.prefetch_related.return_value = mock_queryset
-        
-        mock_is_due.return_value = True
-        mock_send_email.return_value = True
-        mock_notification.return_value = None
-        
-        # Run the task
-        result = send_medication_reminders_task()
-        
-        # Verify email was sent
-        self.assertTrue(mock_send_email.called)
-        
-        # Verify notification was created
-        self.assertTrue(mock_notification.called)
-        
-        # Verify result indicates processing
-        self.assertIn('Processed', result)
-    
-    @patch('pharmacy.tasks.MedicationReminder.objects.filter')
-    def test_no_reminders_sent_at_wrong_time(self, mock_filter):
-        """Test that reminders are not sent at wrong time"""
-        from pharmacy.tasks import send_medication_reminders_task
-        
-        # Create mock empty queryset
-        mock_queryset = MagicMock()
-        mock_queryset.exists.return_value = False
-        
-        # Setup mock filter chain to return empty queryset
-        mock_filter.return_value.filter.return_value.select_related.return_value.prefetch_related.return_value = mock_queryset
-        
-        # Run the task
-        result = send_medication_reminders_task()
-        
-        # Should return no reminders message
-        self.assertIn('No reminders', result)
-    
-    @patch('pharmacy.tasks.send_app_email')
-    @patch('pharmacy.tasks.is_reminder_due')
-    @patch('pharmacy.tasks.MedicationReminder.objects.filter')
-    def test_weekly_reminder_on_correct_day(self, mock_filter, mock_is_due, mock_send_email):
-        """Test weekly reminder is sent only on the correct day"""
-        from pharmacy.tasks import send_medication_reminders_task
-        
-        # Create weekly reminder
-        weekly_reminder = MedicationReminder.objects.create(
-            user=self.user,
-            medication=self.medication,
-            dosage="1 tablet",
-            frequency='weekly',
-            time_of_day=time(9, 0),
-            start_date=timezone.now().date(),
-            is_active=True
+    def make_reminder(self, **kwargs):
+        fields = {
+            'user': self.user,
+            'medication': self.medication,
+            'dosage': "1 tablet",
+            'frequency': 'daily',
+            'time_of_day': time(9, 0),
+            'start_date': date(2025, 1, 15),
+        }
+        fields.update(kwargs)
+        return MedicationReminder.objects.create(**fields)
+
+    def make_due(self, reminder, minutes_ago=1):
+        MedicationReminder.objects.filter(pk=reminder.pk).update(
+            next_fire_at=timezone.now() - timedelta(minutes=minutes_ago)
         )
-        
-        # Create mock queryset with the weekly reminder
-        mock_queryset = MagicMock()
-        mock_queryset.exists.return_value = True
-        mock_queryset.count.return_value = 1
-        mock_queryset.__iter__.return_value = iter([weekly_reminder])
-        
-        mock_filter.return_value.filter.return_value.select_related.return_value.prefetch_related.return_value = mock_queryset
-        mock_is_due.return_value = True
-        mock_send_email.return_value = True
-        
-        # Run the task
-        send_medication_reminders_task()
-        
-        # Email should be sent if day matches
-        self.assertTrue(mock_send_email.called)
-        self.assertTrue(weekly_reminder.is_active)
-    
-    @patch('pharmacy.tasks.is_reminder_due')
-    @patch('pharmacy.tasks.MedicationReminder.objects.filter')
-    def test_reminder_not_sent_to_users_with_disabled_notifications(self, mock_filter, mock_is_due):
-        """Test reminders are not sent when user has disabled email notifications"""
+
+    def test_next_fire_at_set_on_save(self):
+        """Test next_fire_at is stored on save and cleared for inactive reminders"""
+        self.assertIsNotNone(self.reminder.next_fire_at)
+        self.assertGreater(self.reminder.next_fire_at, timezone.now())
+
+        self.reminder.is_active = False
+        self.reminder.save()
+        self.assertIsNone(self.reminder.next_fire_at)
+
+    def test_compute_next_fire_at_per_frequency(self):
+        """Test daily, weekly, monthly and custom schedules"""
+        after = timezone.make_aware(datetime(2025, 3, 10, 10, 0))  # Monday, after the 09:00 dose
+
+        daily = self.make_reminder(frequency='daily')
+        self.assertEqual(daily.compute_next_fire_at(after), timezone.make_aware(datetime(2025, 3, 11, 9, 0)))
+
+        weekly = self.make_reminder(frequency='weekly')  # 2025-01-15 is a Wednesday
+        self.assertEqual(weekly.compute_next_fire_at(after), timezone.make_aware(datetime(2025, 3, 12, 9, 0)))
+
+        monthly = self.make_reminder(frequency='monthly', start_date=date(2025, 1, 31))
+        self.assertEqual(monthly.compute_next_fire_at(after), timezone.make_aware(datetime(2025, 3, 31, 9, 0)))
+        feb = timezone.make_aware(datetime(2025, 2, 1, 0, 0))
+        self.assertEqual(monthly.compute_next_fire_at(feb), timezone.make_aware(datetime(2025, 2, 28, 9, 0)))
+
+        custom = self.make_reminder(frequency='custom', custom_frequency='3')
+        self.assertEqual(custom.compute_next_fire_at(after), timezone.make_aware(datetime(2025, 3, 12, 9, 0)))
+
+        invalid = self.make_reminder(frequency='custom', custom_frequency='every other day')
+        self.assertIsNone(invalid.compute_next_fire_at(after))
+
+    def test_compute_next_fire_at_respects_end_date(self):
+        """Test schedules stop after end_date"""
+        reminder = self.make_reminder(end_date=date(2025, 3, 10))
+        after = timezone.make_aware(datetime(2025, 3, 10, 10, 0))
+        self.assertIsNone(reminder.compute_next_fire_at(after))
+
+    def run_reminders(self):
         from pharmacy.tasks import send_medication_reminders_task
-        
-        # Disable email notifications for user
+
+        with self.captureOnCommitCallbacks(execute=True):
+            return send_medication_reminders_task()
+
+    @patch('notifications.tasks.send_email_notifications_batch.delay')
+    @patch('notifications.utils.broadcast_notifications')
+    def test_due_reminder_sent_and_advanced(self, mock_broadcast, mock_email):
+        """Test due reminders are sent once and moved to their next occurrence"""
+        self.make_due(self.reminder)
+        result = self.run_reminders()
+
+        self.assertIn('Sent 1', result)
+        notification = Notification.objects.get(recipient=self.user, category='medication')
+        self.assertEqual(notification.metadata['reminder_id'], self.reminder.id)
+        mock_email.assert_called_once_with([notification.pk])
+        self.reminder.refresh_from_db()
+        self.assertGreater(self.reminder.next_fire_at, timezone.now())
+
+        # Already advanced, so a second tick sends nothing
+        self.assertIn('No reminders', self.run_reminders())
+        self.assertEqual(mock_email.call_count, 1)
+
+    @patch('notifications.tasks.send_email_notifications_batch.delay')
+    @patch('notifications.utils.broadcast_notifications')
+    def test_batch_is_created_with_one_insert(self, mock_broadcast, mock_email):
+        """Test a batch of due reminders is notified with one INSERT and one email task"""
+        from pharmacy.tasks import send_medication_reminders
+
+        other = self.make_reminder(dosage="2 tablets")
+        self.make_due(self.reminder)
+        self.make_due(other)
+        due = [(reminder, timezone.now()) for reminder in MedicationReminder.objects.select_related('user', 'medication')]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(send_medication_reminders(due), 2)
+
+        table = Notification._meta.db_table
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith(f'INSERT INTO "{table}"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(len(mock_email.call_args.args[0]), 2)
+
+    @patch('notifications.tasks.send_email_notifications_batch.delay')
+    @patch('notifications.utils.broadcast_notifications')
+    def test_no_reminders_sent_before_next_fire_at(self, mock_broadcast, mock_email):
+        """Test that reminders are not sent before they are due"""
+        result = self.run_reminders()
+
+        self.assertIn('No reminders', result)
+        self.assertFalse(mock_email.called)
+        self.assertFalse(Notification.objects.filter(recipient=self.user).exists())
+
+    @patch('notifications.tasks.send_email_notifications_batch.delay')
+    @patch('notifications.utils.broadcast_notifications')
+    def test_reminder_not_emailed_to_users_with_disabled_notifications(self, mock_broadcast, mock_email):
+        """Test reminders skip email when the user has disabled email notifications"""
         self.user.notify_refill_reminder_email = False
         self.user.save()
-        
-        # Create mock queryset
-        mock_queryset = MagicMock()
-        mock_queryset.exists.return_value = True
-        mock_queryset.count.return_value = 1
-        mock_queryset.__iter__.return_value = iter([self.reminder])
-        
-        mock_filter.return_value.filter.return_value.select_related.return_value.prefetch_related.return_value = mock_queryset
-        mock_is_due.return_value = True
-        
-        # Run the task
-        result = send_medication_reminders_task()
-        
-        # Should skip because user has disabled notifications
-        self.assertIn('sent 0', result)
-    
-    @patch('pharmacy.tasks.is_reminder_due')
-    @patch('pharmacy.tasks.MedicationReminder.objects.filter')
-    def test_reminder_not_sent_for_inactive_reminders(self, mock_filter, mock_is_due):
+        self.make_due(self.reminder)
+
+        self.run_reminders()
+
+        self.assertFalse(mock_email.called)
+        self.assertTrue(Notification.objects.filter(recipient=self.user).exists())
+
+    @patch('notifications.tasks.send_email_notifications_batch.delay')
+    @patch('notifications.utils.broadcast_notifications')
+    def test_reminder_not_sent_for_inactive_reminders(self, mock_broadcast, mock_email):
         """Test that inactive reminders are not sent"""
-        from pharmacy.tasks import send_medication_reminders_task
-        
-        # Deactivate reminder
-        self.reminder.is_active = False
-        self.reminder.save()
-        
-        # Create mock empty queryset (because filter for is_active=True will find nothing)
-        mock_queryset = MagicMock()
-        mock_queryset.exists.return_value = False
-        
-        mock_filter.return_value.filter.return_value.select_related.return_value.prefetch_related.return_value = mock_queryset
-        
-        # Run the task
-        result = send_medication_reminders_task()
-        
-        # Should return no reminders
-        self.assertIn('No reminders', result)
-    
-    @patch('pharmacy.tasks.is_reminder_due')
-    @patch('pharmacy.tasks.MedicationReminder.objects.filter')
-    def test_reminder_not_sent_after_end_date(self, mock_filter, mock_is_due):
-        """Test that reminders are not sent after end date"""
-        from pharmacy.tasks import send_medication_reminders_task
-        
-        # Set end date to yesterday
-        self.reminder.end_date = (timezone.now() - timedelta(days=1)).date()
-        self.reminder.save()
-        
-        # Create mock empty queryset (because filter for end_date check will exclude it)
-        mock_queryset = MagicMock()
-        mock_queryset.exists.return_value = False
-        
-        mock_filter.return_value.filter.return_value.select_related.return_value.prefetch_related.return_value = mock_queryset
-        
-        # Run the task
-        result = send_medication_reminders_task()
-        
-        # Should return no reminders
+        self.make_due(self.reminder)
+        MedicationReminder.objects.filter(pk=self.reminder.pk).update(is_active=False)
+
+        result = self.run_reminders()
+
         self.assertIn('No reminders', result)
-    
-    @patch('pharmacy.tasks.send_app_email')
-    @patch('pharmacy.tasks.is_reminder_due')
-    @patch('pharmacy.tasks.MedicationReminder.objects.filter')
-    def test_monthly_reminder_on_correct_day(self, mock_filter, mock_is_due, mock_send_email):
-        """Test monthly reminder is sent on correct day of month"""
-        from pharmacy.tasks import send_medication_reminders_task
-        
-        # Create monthly reminder starting on 15th
-        start_date = timezone.now().replace(day=15).date()
-        monthly_reminder = MedicationReminder.objects.create(
-            user=self.user,
-            medication=self.medication,
-            dosage="1 tablet",
-            frequency='monthly',
-            time_of_day=time(9, 0),
-            start_date=start_date,
-            is_active=True
-        )
-        
-        # Create mock queryset
-        mock_queryset = MagicMock()
-        mock_queryset.exists.return_value = True
-        mock_queryset.count.return_value = 1
-        mock_queryset.__iter__.return_value = iter([monthly_reminder])
-        
-        mock_filter.return_value.filter.return_value.select_related.return_value.prefetch_related.return_value = mock_queryset
-        mock_is_due.return_value = True
-        mock_send_email.return_value = True
-        
-        # Run the task
-        send_medication_reminders_task()
-        
-        # Verify reminder was processed
-        self.assertTrue(mock_send_email.called)
-        self.assertTrue(monthly_reminder.is_active)
-    
+        self.assertFalse(mock_email.called)
+
+    @patch('notifications.tasks.send_email_notifications_batch.delay')
+    @patch('notifications.utils.broadcast_notifications')
+    def test_stale_occurrence_skipped(self, mock_broadcast, mock_email):
+        """Test occurrences missed by more than the lateness window are skipped but advanced"""
+        self.make_due(self.reminder, minutes_ago=180)
+        result = self.run_reminders()
+
+        self.assertIn('skipped 1', result)
+        self.assertFalse(mock_email.called)
+        self.reminder.refresh_from_db()
+        self.assertGreater(self.reminder.next_fire_at, timezone.now())
+
     @patch('pharmacy.tasks.logger')
-    @patch('pharmacy.tasks.send_app_email')
-    @patch('pharmacy.tasks.is_reminder_due')
-    @patch('pharmacy.tasks.MedicationReminder.objects.filter')
-    def test_task_handles_email_send_failure_gracefully(self, mock_filter, mock_is_due, mock_send_email, mock_logger):
-        """Test that task handles email send failures gracefully"""
-        from pharmacy.tasks import send_medication_reminders_task
-        
-        # Create mock queryset
-        mock_queryset = MagicMock()
-        mock_queryset.exists.return_value = True
-        mock_queryset.count.return_value = 1
-        mock_queryset.__iter__.return_value = iter([self.reminder])
-        
-        mock_filter.return_value.filter.return_value.select_related.return_value.prefetch_related.return_value = mock_queryset
-        mock_is_due.return_value = True
-        
-        # Mock email send to raise exception
-        mock_send_email.side_effect = Exception('Email service unavailable')
-        
-        # Run the task - should not crash
-        result = send_medication_reminders_task()
-        
-        # Verify error was logged
+    @patch('pharmacy.tasks.save_notifications')
+    def test_task_handles_notification_failure_gracefully(self, mock_save, mock_logger):
+        """Test that a failing batch is logged and its claim rolled back for the next run"""
+        from pharmacy.models import UserAdherenceDaily
+
+        self.make_due(self.reminder)
+        due_at = MedicationReminder.objects.get(pk=self.reminder.pk).next_fire_at
+        mock_save.side_effect = Exception('Database unavailable')
+
+        result = self.run_reminders()
+
         self.assertTrue(mock_logger.error.called)
-        
-        # Task should complete
         self.assertIsNotNone(result)
+        self.assertEqual(MedicationReminder.objects.get(pk=self.reminder.pk).next_fire_at, due_at)
+        self.assertFalse(UserAdherenceDaily.objects.filter(user=self.user, scheduled__gt=0).exists())
+
+    @patch('notifications.tasks.send_email_notifications_batch.delay')
+    @patch('notifications.utils.broadcast_notifications')
+    def test_reminder_without_next_fire_at_is_scheduled_and_fires(self, mock_broadcast, mock_email):
+        """Test reminders saved before next_fire_at existed are backfilled and sent"""
+        ten_minutes_ago = timezone.localtime(timezone.now() - timedelta(minutes=10))
+        reminder = self.make_reminder(time_of_day=ten_minutes_ago.time(), start_date=ten_minutes_ago.date())
+        MedicationReminder.objects.filter(pk=reminder.pk).update(next_fire_at=None)
+
+        result = self.run_reminders()
+
+        self.assertIn('Sent 1', result)
+        self.assertTrue(Notification.objects.filter(recipient=self.user, metadata__reminder_id=reminder.id).exists())
+        reminder.refresh_from_db()
+        self.assertGreater(reminder.next_fire_at, timezone.now())
 
 
 class MedicationOrderTest(APITestCase):
@@ -524,3 +482,611 @@ class MedicationOrderTest(APITestCase):
         order.save()
         self.assertEqual(order.status, 'completed')
 
+
+
+class OrderStateMachineTest(TestCase):
+    """Test the declarative order state machine"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='patient',
+            email='patient@test.com',
+            password='testpass123'
+        )
+        self.pharmacy = Pharmacy.objects.create(
+            name="TestPharm",
+            address="123 Test St",
+            phone_number="+1234567890",
+            operating_hours="9-5",
+            is_active=True
+        )
+        self.order = MedicationOrder.objects.create(
+            user=self.user,
+            pharmacy=self.pharmacy,
+            status='pending'
+        )
+
+    def test_invalid_transition_rejected(self):
+        """Test transitions outside the declared table are rejected"""
+        from rest_framework.exceptions import ValidationError
+        from pharmacy.services import OrderStateMachine
+
+        with self.assertRaises(ValidationError):
+            OrderStateMachine(self.order).transition_to('completed')
+
+    def test_unpaid_order_cannot_leave_pending(self):
+        """Test the payment guard on pending -> processing"""
+        from rest_framework.exceptions import ValidationError
+        from pharmacy.services import OrderStateMachine
+
+        order = MedicationOrder.objects.get(pk=self.order.pk)
+        with self.assertRaises(ValidationError):
+            OrderStateMachine(order).apply({'total_amount': 100, 'status': 'processing'}).save()
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'pending')
+        self.assertIsNone(self.order.total_amount)
+
+    def test_pricing_and_payment_written_in_single_update(self):
+        """Test price, payment and status changes persist with one UPDATE and queue outbox events"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from pharmacy.models import OrderEvent
+        from pharmacy.services import OrderStateMachine
+
+        order = MedicationOrder.objects.get(pk=self.order.pk)
+        with CaptureQueriesContext(connection) as ctx:
+            OrderStateMachine(order).apply({'total_amount': 100, 'status': 'processing'}).record_payment('REF-1').save()
+
+        updates = [q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "pharmacy_medicationorder"')]
+        self.assertEqual(len(updates), 1)
+
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'processing')
+        self.assertEqual(order.payment_status, 'paid')
+        self.assertEqual(
+            set(OrderEvent.objects.filter(order=order).values_list('event_type', flat=True)),
+            {'paid', 'priced', 'status_changed'}
+        )
+
+    def test_order_event_frame_is_compact(self):
+        """Test created events serialize to the compact portal frame"""
+        from pharmacy.serializers import OrderEventSerializer
+        from pharmacy.services import record_order_created
+
+        event = record_order_created(self.order, actor=self.user)
+        frame = OrderEventSerializer(event).data
+
+        self.assertEqual(frame['cursor'], event.id)
+        self.assertEqual(frame['event'], 'created')
+        self.assertEqual(frame['order']['id'], self.order.id)
+        self.assertEqual(frame['order']['status'], 'pending')
+
+
+class MedicationAutocompleteTest(APITestCase):
+    """Test the in-process medication autocomplete index"""
+
+    def setUp(self):
+        from pharmacy.search import MedicationAutocompleteIndex
+
+        def medication(name, generic_name=None):
+            return Medication.objects.create(
+                name=name, generic_name=generic_name, description="Test",
+                dosage_form="Tablet", strength="500mg"
+            )
+
+        self.amlodipine = medication("Amlodipine")
+        self.amoxicillin = medication("Amoxicillin")
+        self.augmentin = medication("Augmentin", "Amoxicillin Clavulanate")
+        self.folic_acid = medication("Folic Acid")
+        self.paracetamol = medication("Paracétamol")
+
+        user = User.objects.create_user(username='patient', email='patient@test.com', password='testpass123')
+        doctor = Doctor.objects.create(
+            first_name="Sarah", last_name="Johnson", gender="F", years_of_experience=8,
+            education="MD", bio="General practitioner", languages_spoken="English"
+        )
+        appointment = Appointment.objects.create(
+            user=user, doctor=doctor, date=timezone.now().date(),
+            start_time=time(10, 0), end_time=time(11, 0), reason="Consultation"
+        )
+        prescription = Prescription.objects.create(
+            appointment=appointment, user=user, doctor=doctor, diagnosis="Infection"
+        )
+        for _ in range(2):
+            PrescriptionItem.objects.create(
+                prescription=prescription, medication=self.augmentin, medication_name="Augmentin",
+                dosage="625mg", frequency="Twice daily", duration="7 days"
+            )
+
+        self.index = MedicationAutocompleteIndex()
+        self.index.build()
+
+    def names(self, results):
+        return [record['name'] for record in results]
+
+    def test_prefix_matches_ranked_by_prescription_frequency(self):
+        """Test generic-name matches count and frequently prescribed drugs come first"""
+        self.assertEqual(self.names(self.index.lookup("amox")), ["Augmentin", "Amoxicillin"])
+        self.assertEqual(self.names(self.index.lookup("am")), ["Augmentin", "Amlodipine", "Amoxicillin"])
+
+    def test_matches_later_words_and_normalizes_accents(self):
+        """Test word-start matching inside names and accent-insensitive lookups"""
+        self.assertEqual(self.names(self.index.lookup("acid")), ["Folic Acid"])
+        self.assertEqual(self.names(self.index.lookup("PARACETAM")), ["Paracétamol"])
+        self.assertEqual(self.index.lookup("   "), [])
+
+    def test_endpoint_serves_from_index(self):
+        """Test the autocomplete endpoint answers from a built index"""
+        with patch('pharmacy.search.medication_index', self.index):
+            response = self.client.get('/api/pharmacy/medications/autocomplete/', {'q': 'amox', 'limit': 1})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['source'], 'index')
+        self.assertEqual(self.names(response.data['results']), ["Augmentin"])
+
+
+@override_settings(GEOCODING_PROVIDER='pharmacy.geocoding.StubGeocodingProvider', GEOCODING_RATE_LIMIT=1000)
+class GeocodingTest(TestCase):
+    """Test queued, cached geocoding of pharmacies and emergency services"""
+
+    def test_save_does_not_call_provider(self):
+        """Test saving a pharmacy without a location only schedules geocoding"""
+        with patch('pharmacy.geocoding.StubGeocodingProvider.geocode') as mock_geocode, \
+                patch('pharmacy.geocoding.schedule_geocoding') as mock_schedule:
+            pharmacy = Pharmacy.objects.create(
+                name="NoLocation Pharm", address="1 Broad Street, Lagos",
+                phone_number="+1234567890", operating_hours="9-5"
+            )
+
+        mock_geocode.assert_not_called()
+        mock_schedule.assert_called_once_with(pharmacy)
+        self.assertIsNone(pharmacy.location)
+
+    def test_geocode_address_is_cached(self):
+        """Test repeated lookups for the same address hit the cache table"""
+        from pharmacy.geocoding import StubGeocodingProvider, geocode_address
+        from pharmacy.models import GeocodedAddress
+
+        provider = StubGeocodingProvider()
+        with patch.object(provider, 'geocode', wraps=provider.geocode) as spy:
+            first = geocode_address("12 Awolowo Road, Ikoyi", provider=provider)
+            second = geocode_address("  12 awolowo road,   IKOYI ", provider=provider)
+
+        self.assertEqual(spy.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(GeocodedAddress.objects.count(), 1)
+
+    def test_backfill_fills_pharmacies_and_emergency_services(self):
+        """Test the backfill resolves shared addresses once and updates every model"""
+        from emergency.models import EmergencyService
+        from pharmacy.geocoding import StubGeocodingProvider, backfill_locations
+
+        with patch('pharmacy.geocoding.schedule_geocoding'):
+            pharmacies = [
+                Pharmacy.objects.create(
+                    name=f"Pharm {i}", address="Alausa, Ikeja, Lagos",
+                    phone_number="+1234567890", operating_hours="9-5"
+                )
+                for i in range(3)
+            ]
+            service = EmergencyService.objects.create(
+                name="LASAMBUS", service_type='ambulance', address="Alausa, Ikeja, Lagos", phone_number="767"
+            )
+
+        provider = StubGeocodingProvider()
+        with patch.object(provider, 'geocode', wraps=provider.geocode) as spy:
+            updated = backfill_locations(batch_size=2, provider=provider)
+
+        self.assertEqual(updated, 4)
+        self.assertEqual(spy.call_count, 1)
+        for pharmacy in pharmacies:
+            pharmacy.refresh_from_db()
+            self.assertIsNotNone(pharmacy.location)
+        service.refresh_from_db()
+        self.assertEqual(service.location, pharmacies[0].location)
+
+
+class MedicationAdherenceTest(APITestCase):
+    """Test adherence rollups and reports"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='patient', email='patient@test.com', password='testpass123')
+        self.medication = Medication.objects.create(
+            name="Metformin", description="Antidiabetic", dosage_form="Tablet", strength="500mg"
+        )
+        self.reminder = MedicationReminder.objects.create(
+            user=self.user, medication=self.medication, dosage="1 tablet", frequency='daily',
+            time_of_day=time(8, 0), start_date=timezone.now().date()
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_logging_intake_updates_rollups(self):
+        """Test scheduled firings and logged doses are counted per reminder and per user"""
+        from pharmacy.adherence import record_scheduled
+        from pharmacy.models import ReminderAdherenceDaily, UserAdherenceDaily
+
+        now = timezone.now()
+        record_scheduled([(self.reminder, now), (self.reminder, now)])
+        self.client.post(f'/api/pharmacy/reminders/{self.reminder.id}/log/', {'status': 'taken'})
+        self.client.post('/api/pharmacy/logs/', {
+            'reminder': self.reminder.id, 'status': 'missed', 'scheduled_time': now.isoformat()
+        })
+
+        day = UserAdherenceDaily.objects.get(user=self.user)
+        self.assertEqual((day.scheduled, day.taken, day.missed), (2, 1, 1))
+        self.assertEqual(ReminderAdherenceDaily.objects.get(reminder=self.reminder).taken, 1)
+
+        response = self.client.get('/api/pharmacy/adherence/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['adherence_percentage'], 50.0)
+        self.assertEqual(response.data['reminders'][0]['medication_name'], "Metformin")
+        self.assertEqual(response.data['reminders'][0]['scheduled'], 2)
+
+    def test_stale_occurrences_are_not_scheduled_doses(self):
+        """Test occurrences too late to send are counted apart from scheduled doses"""
+        from pharmacy.adherence import record_scheduled
+        from pharmacy.models import UserAdherenceDaily
+
+        now = timezone.now().replace(hour=12, minute=0)
+        record_scheduled(
+            [(self.reminder, now - timedelta(hours=3)), (self.reminder, now)],
+            stale_before=now - timedelta(hours=1),
+        )
+
+        day = UserAdherenceDaily.objects.get(user=self.user)
+        self.assertEqual((day.scheduled, day.stale_skipped), (1, 1))
+
+    def test_streaks_and_heatmap(self):
+        """Test streaks skip days without doses and today's pending doses"""
+        from pharmacy.adherence import summarize
+
+        today = date(2025, 3, 10)
+
+        def row(days_ago, scheduled, taken, missed=0):
+            return {'date': today - timedelta(days=days_ago), 'scheduled': scheduled,
+                    'taken': taken, 'missed': missed, 'skipped': 0}
+
+        rows = [row(6, 2, 2), row(5, 2, 1, 1), row(4, 2, 2), row(3, 2, 2), row(1, 2, 2), row(0, 2, 1)]
+        summary = summarize(rows, today=today)
+
+        self.assertEqual(summary['current_streak'], 3)
+        self.assertEqual(summary['longest_streak'], 3)
+        self.assertEqual(summary['heatmap'][1]['missed_doses'], 1)
+        self.assertEqual(summary['heatmap'][-1]['missed_doses'], 1)
+
+    def test_doctor_reads_only_own_patients(self):
+        """Test doctors can read adherence only for patients they have seen"""
+        from pharmacy.adherence import record_scheduled
+
+        doctor_user = User.objects.create_user(username='doc', email='doc@test.com', password='testpass123')
+        doctor = Doctor.objects.create(
+            user=doctor_user, first_name="Sarah", last_name="Johnson", gender="F",
+            years_of_experience=8, education="MD", bio="GP", languages_spoken="English"
+        )
+        record_scheduled([(self.reminder, timezone.now())])
+        self.client.force_authenticate(user=doctor_user)
+        url = f'/api/pharmacy/adherence/patients/{self.user.id}/'
+
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+        Appointment.objects.create(
+            user=self.user, doctor=doctor, date=timezone.now().date(),
+            start_time=time(10, 0), end_time=time(11, 0), reason="Follow-up"
+        )
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['scheduled'], 1)
+
+
+class PharmacyAnalyticsTest(APITestCase):
+    """Test pharmacy portal analytics built from daily aggregates"""
+
+    def setUp(self):
+        self.patient = User.objects.create_user(username='patient', email='patient@test.com', password='testpass123')
+        self.pharmacy = Pharmacy.objects.create(
+            name="TestPharm", address="123 Test St", phone_number="+1234567890", operating_hours="9-5"
+        )
+        self.staff = User.objects.create_user(
+            username='staff', email='staff@test.com', password='testpass123',
+            is_pharmacy_staff=True, works_at_pharmacy=self.pharmacy
+        )
+
+    @patch('pharmacy.services.dispatch_order_events')
+    def test_order_lifecycle_updates_daily_stats(self, mock_dispatch):
+        """Test creation, transitions and completion are reflected in the report"""
+        from pharmacy.models import MedicationOrderItem, PharmacyDailyStats
+        from pharmacy.services import OrderStateMachine, record_order_created
+
+        order = MedicationOrder.objects.create(user=self.patient, pharmacy=self.pharmacy, status='pending')
+        MedicationOrderItem.objects.create(order=order, medication_name_text="Amoxicillin", quantity=3, price_per_unit=200)
+        record_order_created(order)
+
+        for next_status in ('processing', 'ready', 'completed'):
+            machine = OrderStateMachine(MedicationOrder.objects.get(pk=order.pk))
+            if next_status == 'processing':
+                machine.apply({'total_amount': 600}).record_payment('REF-1')
+            machine.transition_to(next_status).save()
+
+        stats = PharmacyDailyStats.objects.get(pharmacy=self.pharmacy)
+        self.assertEqual((stats.orders_created, stats.orders_ready, stats.orders_completed), (1, 1, 1))
+        self.assertEqual(stats.revenue, 600)
+
+        self.client.force_authenticate(user=self.staff)
+        response = self.client.get('/api/pharmacy/portal/analytics/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['orders_by_status']['completed'], 1)
+        self.assertEqual(response.data['payment_mix']['cash']['orders'], 1)
+        self.assertEqual(response.data['top_medications'][0]['medication_name'], "Amoxicillin")
+        self.assertEqual(response.data['top_medications'][0]['quantity'], 3)
+        self.assertIsNotNone(response.data['avg_minutes_to_complete'])
+
+    def test_invalid_range_rejected(self):
+        """Test reversed date ranges are rejected"""
+        self.client.force_authenticate(user=self.staff)
+        response = self.client.get('/api/pharmacy/portal/analytics/', {'start': '2025-03-10', 'end': '2025-03-01'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@patch('pharmacy.services.dispatch_order_events')
+class StockReservationTest(TestCase):
+    """Test inventory reservation across the order lifecycle"""
+
+    def setUp(self):
+        self.patient = User.objects.create_user(username='patient', email='patient@test.com', password='testpass123')
+        self.pharmacy = Pharmacy.objects.create(
+            name="TestPharm", address="123 Test St", phone_number="+1234567890", operating_hours="9-5"
+        )
+        self.medication = Medication.objects.create(
+            name="Amoxicillin", description="Antibiotic", dosage_form="Capsule", strength="500mg"
+        )
+        self.inventory = PharmacyInventory.objects.create(
+            pharmacy=self.pharmacy, medication=self.medication, quantity=5, price=100, low_stock_threshold=1
+        )
+        doctor = Doctor.objects.create(
+            first_name="Sarah", last_name="Johnson", gender="F", years_of_experience=8,
+            education="MD", bio="GP", languages_spoken="English"
+        )
+        appointment = Appointment.objects.create(
+            user=self.patient, doctor=doctor, date=timezone.now().date(),
+            start_time=time(10, 0), end_time=time(11, 0), reason="Consultation"
+        )
+        self.prescription = Prescription.objects.create(
+            appointment=appointment, user=self.patient, doctor=doctor, diagnosis="Infection"
+        )
+        self.prescription_item = PrescriptionItem.objects.create(
+            prescription=self.prescription, medication=self.medication, medication_name="Amoxicillin",
+            dosage="500mg", frequency="Twice daily", duration="7 days"
+        )
+
+    def place_order(self, quantity):
+        from pharmacy.models import MedicationOrderItem
+        from pharmacy.services import record_order_created
+
+        order = MedicationOrder.objects.create(user=self.patient, pharmacy=self.pharmacy, status='pending')
+        MedicationOrderItem.objects.create(
+            order=order, prescription_item=self.prescription_item,
+            medication_name_text="Amoxicillin", quantity=quantity, price_per_unit=100
+        )
+        record_order_created(order)
+        return MedicationOrder.objects.get(pk=order.pk)
+
+    def test_reservation_released_on_cancel(self, mock_dispatch):
+        """Test creating reserves stock and cancelling gives it back"""
+        from pharmacy.services import OrderStateMachine
+
+        order = self.place_order(3)
+        self.inventory.refresh_from_db()
+        self.assertEqual((self.inventory.quantity, self.inventory.reserved_quantity), (5, 3))
+
+        OrderStateMachine(order).transition_to('cancelled').save()
+        self.inventory.refresh_from_db()
+        self.assertEqual((self.inventory.quantity, self.inventory.reserved_quantity), (5, 0))
+
+    def test_every_item_of_a_medication_is_reserved(self, mock_dispatch):
+        """Test two items for the same medication both link to its inventory row"""
+        from pharmacy.models import MedicationOrderItem
+        from pharmacy.services import record_order_created
+
+        order = MedicationOrder.objects.create(user=self.patient, pharmacy=self.pharmacy, status='pending')
+        for quantity in (1, 2):
+            MedicationOrderItem.objects.create(
+                order=order, prescription_item=self.prescription_item,
+                medication_name_text="Amoxicillin", quantity=quantity, price_per_unit=100
+            )
+        record_order_created(order)
+
+        self.inventory.refresh_from_db()
+        self.assertEqual(self.inventory.reserved_quantity, 3)
+        self.assertEqual(set(order.items.values_list('inventory_id', flat=True)), {self.inventory.id})
+
+    def test_pricing_rejects_oversold_order(self, mock_dispatch):
+        """Test an order that could not be reserved cannot be priced"""
+        from rest_framework.exceptions import ValidationError
+        from pharmacy.services import OrderStateMachine
+
+        self.place_order(4)
+        second = self.place_order(2)
+
+        with self.assertRaises(ValidationError):
+            OrderStateMachine(second).apply({'total_amount': 200}).save()
+        second.refresh_from_db()
+        self.assertIsNone(second.total_amount)
+        self.inventory.refresh_from_db()
+        self.assertEqual(self.inventory.reserved_quantity, 4)
+
+    def test_completion_commits_reservation(self, mock_dispatch):
+        """Test completing an order decrements stock and clears the reservation"""
+        from pharmacy.services import OrderStateMachine
+
+        order = self.place_order(5)
+        MedicationOrder.objects.filter(pk=order.pk).update(status='ready')
+        order = MedicationOrder.objects.get(pk=order.pk)
+
+        OrderStateMachine(order).transition_to('completed').save()
+        self.inventory.refresh_from_db()
+        self.assertEqual((self.inventory.quantity, self.inventory.reserved_quantity), (0, 0))
+        self.assertFalse(self.inventory.in_stock)
+
+    @patch('pharmacy.tasks.create_notifications')
+    def test_low_stock_alert_sent_once_per_pharmacy(self, mock_notifications, mock_dispatch):
+        """Test low stock rows produce one batched alert per staff member and are not re-alerted"""
+        from pharmacy.tasks import send_low_stock_alerts
+
+        staff = User.objects.create_user(
+            username='staff', email='staff@test.com', password='testpass123',
+            is_pharmacy_staff=True, works_at_pharmacy=self.pharmacy
+        )
+        other = Medication.objects.create(name="Ibuprofen", description="NSAID", dosage_form="Tablet", strength="400mg")
+        PharmacyInventory.objects.create(pharmacy=self.pharmacy, medication=other, quantity=0, price=50)
+        self.place_order(4)
+
+        self.assertEqual(send_low_stock_alerts(), 2)
+        mock_notifications.assert_called_once()
+        self.assertEqual(mock_notifications.call_args.args[0], [staff])
+
+        self.assertEqual(send_low_stock_alerts(), 0)
+
+
+class PharmacyAvailabilityTest(APITestCase):
+    """Test the cached orderable-pharmacy set and the subscription expiry job"""
+
+    def setUp(self):
+        cache.clear()
+        today = timezone.localdate()
+        self.open = Pharmacy.objects.create(
+            name="Open Pharm", address="1 Test St", phone_number="+1234567890", operating_hours="9-5",
+            subscription_expiry=today + timedelta(days=30)
+        )
+        self.expired = Pharmacy.objects.create(
+            name="Expired Pharm", address="2 Test St", phone_number="+1234567890", operating_hours="9-5",
+            subscription_expiry=today - timedelta(days=1)
+        )
+        self.inactive = Pharmacy.objects.create(
+            name="Closed Pharm", address="3 Test St", phone_number="+1234567890", operating_hours="9-5",
+            is_active=False
+        )
+
+    def test_orderable_set_cached_and_invalidated(self):
+        """Test the set is served from cache and refreshed when a pharmacy changes"""
+        from pharmacy.availability import orderable_pharmacy_ids
+
+        self.assertEqual(orderable_pharmacy_ids(), {self.open.id})
+        with self.assertNumQueries(0):
+            orderable_pharmacy_ids()
+
+        self.expired.subscription_expiry = timezone.localdate() + timedelta(days=365)
+        self.expired.save()
+        self.assertEqual(orderable_pharmacy_ids(), {self.open.id, self.expired.id})
+
+    def test_deleted_pharmacy_leaves_orderable_set(self):
+        """Test deleting a pharmacy invalidates the cached set"""
+        from pharmacy.availability import orderable_pharmacy_ids
+
+        self.assertEqual(orderable_pharmacy_ids(), {self.open.id})
+        Pharmacy.objects.filter(pk=self.open.pk).delete()
+        self.assertEqual(orderable_pharmacy_ids(), frozenset())
+
+    def test_cache_outage_falls_back_to_database(self):
+        """Test reads, saves and deletes keep working when the cache backend is down"""
+        from pharmacy.availability import orderable_pharmacy_ids
+
+        with patch('pharmacy.availability.cache') as mock_cache:
+            mock_cache.get.side_effect = ConnectionError("cache down")
+            mock_cache.delete.side_effect = ConnectionError("cache down")
+            self.assertEqual(orderable_pharmacy_ids(), {self.open.id})
+            self.open.save()
+            self.expired.delete()
+        self.assertEqual(orderable_pharmacy_ids(), {self.open.id})
+
+    def test_lapsed_flag_excludes_pharmacy(self):
+        """Test a pharmacy flagged as lapsed is not orderable until its expiry is renewed"""
+        from pharmacy.availability import invalidate_orderable_pharmacies, is_orderable
+
+        Pharmacy.objects.filter(pk=self.open.pk).update(subscription_lapsed=True)
+        invalidate_orderable_pharmacies()
+        self.assertFalse(is_orderable(self.open.id))
+
+        self.open.subscription_expiry = timezone.localdate() + timedelta(days=365)
+        self.open.save()
+        self.assertTrue(is_orderable(self.open.id))
+
+    def test_list_hides_pharmacies_that_cannot_take_orders(self):
+        """Test expired and inactive pharmacies are not listed"""
+        response = self.client.get('/api/pharmacy/')
+        results = response.data['results'] if isinstance(response.data, dict) else response.data
+        self.assertEqual([p['id'] for p in results], [self.open.id])
+
+    def test_expiry_job_flags_lapsed_pharmacies(self):
+        """Test the daily job expires records and flags pharmacies in bulk"""
+        from payments.models import PharmacySubscription, PharmacySubscriptionRecord
+        from pharmacy.availability import expire_lapsed_subscriptions
+
+        plan = PharmacySubscription.objects.create(name="Annual", tier='standard', description="Annual", annual_price=1000)
+        record = PharmacySubscriptionRecord.objects.create(
+            pharmacy=self.expired, plan=plan, status='active',
+            current_period_start=timezone.now() - timedelta(days=366),
+            current_period_end=timezone.now() - timedelta(days=1)
+        )
+
+        self.assertEqual(expire_lapsed_subscriptions(), (1, 1))
+        record.refresh_from_db()
+        self.expired.refresh_from_db()
+        self.assertEqual(record.status, 'expired')
+        self.assertTrue(self.expired.subscription_lapsed)
+
+
+class OrderListQueryBudgetTest(APITestCase):
+    """Order list pages run a fixed number of queries regardless of page size"""
+
+    def setUp(self):
+        from insurance.models import InsuranceProvider, InsurancePlan, UserInsurance
+
+        self.user = User.objects.create_user(username='budget', email='budget@test.com', password='testpass123')
+        self.pharmacy = Pharmacy.objects.create(
+            name="BudgetPharm", address="1 Budget St", phone_number="+1234567890",
+            operating_hours="9-5", is_active=True, location=Point(3.3792, 6.5244, srid=4326)
+        )
+        provider = InsuranceProvider.objects.create(name="BudgetCare")
+        plan = InsurancePlan.objects.create(
+            provider=provider, name="Basic", plan_type='HMO', description="Basic plan",
+            monthly_premium=10, annual_deductible=100, out_of_pocket_max=1000, coverage_details="All"
+        )
+        self.insurance = UserInsurance.objects.create(
+            user=self.user, plan=plan, policy_number="P-1", member_id="M-1", start_date=date.today()
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def create_orders(self, count):
+        for i in range(count):
+            order = MedicationOrder.objects.create(
+                user=self.user,
+                pharmacy=self.pharmacy,
+                user_insurance=self.insurance if i % 2 else None,
+            )
+            for n in range(2):
+                order.items.create(medication_name_text=f"Med {n}", quantity=1)
+
+    def count_list_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/pharmacy/orders/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context), response
+
+    def test_page_of_fifty_orders_uses_fixed_query_count(self):
+        """Test a page of 50 orders costs the same queries as a page of one"""
+        with patch.object(PageNumberPagination, 'page_size', 50):
+            self.create_orders(1)
+            baseline, _ = self.count_list_queries()
+
+            self.create_orders(49)
+            with self.assertNumQueries(baseline):
+                response = self.client.get('/api/pharmacy/orders/')
+
+        self.assertEqual(len(response.data['results']), 50)
+        insured = [row for row in response.data['results'] if row['user_insurance']]
+        self.assertEqual(len(insured), 25)
+        self.assertEqual(insured[0]['user_insurance']['plan']['provider']['name'], "BudgetCare")
+        self.assertEqual(response.data['results'][0]['payment_status'], 'pending')
+        self.assertEqual(len(response.data['results'][0]['items']), 2)
@@ -2,11 +2,12 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .views import (
-    PharmacyListView, PharmacyOrderListView, PharmacyOrderDetailView,
-    MedicationListView, PharmacyInventoryListView, MedicationOrderListCreateView,
+    PharmacyListView, PharmacyOrderListView, PharmacyOrderDetailView, PharmacyAnalyticsView,
+    MedicationListView, MedicationAutocompleteView, PharmacyInventoryListView, MedicationOrderListCreateView,
     MedicationOrderDetailView, ConfirmPickupView, MedicationReminderListCreateView, MedicationReminderDetailView,
     CreateOrderFromPrescriptionView, PharmacyDetailView,
     MedicationLogListCreateView, LogMedicationIntakeView,
+    MedicationAdherenceView, MedicationAdherenceHeatmapView, PatientMedicationAdherenceView,
     PharmacyInventoryPortalViewSet, PharmacyBankDetailsView, VerifyBankAccountView
 )
 
@@ -17,9 +18,11 @@ urlpatterns = [
     path('', PharmacyListView.as_view(), name='pharmacy-list'),
     path('<int:pk>/', PharmacyDetailView.as_view(), name='pharmacy-detail'),
     path('medications/', MedicationListView.as_view(), name='medication-list'),
+    path('medications/autocomplete/', MedicationAutocompleteView.as_view(), name='medication-autocomplete'),
     path('<int:pharmacy_id>/inventory/', PharmacyInventoryListView.as_view(), name='pharmacy-inventory'),
     path('portal/orders/', PharmacyOrderListView.as_view(), name='pharmacy-order-list'),
     path('portal/orders/<int:pk>/', PharmacyOrderDetailView.as_view(), name='pharmacy-order-detail'),
+    path('portal/analytics/', PharmacyAnalyticsView.as_view(), name='pharmacy-analytics'),
     path('portal/onboarding/bank/', PharmacyBankDetailsView.as_view(), name='pharmacy-bank-details'),
     path('portal/verify-account/', VerifyBankAccountView.as_view(), name='pharmacy-verify-account'),
     path('prescriptions/<int:prescription_id>/create_order/', CreateOrderFromPrescriptionView.as_view(), name='prescription-create-order'),
@@ -30,5 +33,8 @@ urlpatterns = [
     path('reminders/<int:pk>/', MedicationReminderDetailView.as_view(), name='medication-reminder-detail'),
     path('logs/', MedicationLogListCreateView.as_view(), name='medication-log-list'),
     path('reminders/<int:reminder_id>/log/', LogMedicationIntakeView.as_view(), name='medication-log-intake'),
+    path('adherence/', MedicationAdherenceView.as_view(), name='medication-adherence'),
+    path('adherence/heatmap/', MedicationAdherenceHeatmapView.as_view(), name='medication-adherence-heatmap'),
+    path('adherence/patients/<int:patient_id>/', PatientMedicationAdherenceView.as_view(), name='patient-medication-adherence'),
     path('', include(router.urls)),  # Include router URLs for portal inventory
 ]
\ No newline at end of file
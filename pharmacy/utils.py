@@ -0,0 +1,20 @@
+# pharmacy/utils.py
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+
+def increment_counters(model, lookup, deltas, defaults=None):
+    """
+    Add deltas to the counter columns of the row identified by lookup with a
+    single conditional UPDATE, creating the row on first use. Safe under
+    concurrent writers without locking the table.
+    """
+    updates = {field: F(field) + value for field, value in deltas.items()}
+    if model.objects.filter(**lookup).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **(defaults or {}), **deltas)
+    except IntegrityError:
+        # Another writer created the row first.
+        model.objects.filter(**lookup).update(**updates)
@@ -2,10 +2,10 @@
 from rest_framework import generics, permissions, filters, status, views, viewsets
 from rest_framework.routers import DefaultRouter
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework.serializers import ValidationError
+from rest_framework.serializers import ValidationError, raise_errors_on_nested_writes
 from rest_framework.response import Response
-from notifications.utils import create_notification
-from pharmacy.models import Pharmacy, Medication, PharmacyInventory, MedicationOrder, MedicationOrderItem, MedicationReminder, MedicationLog
+from notifications.utils import create_notifications
+from pharmacy.models import Pharmacy, Medication, PharmacyInventory, MedicationOrder, MedicationOrderItem, MedicationReminder, MedicationLog, UserAdherenceDaily
 from pharmacy.serializers import (
     PharmacySerializer, PharmacyOrderListSerializer,
     PharmacyOrderDetailSerializer, PharmacyOrderUpdateSerializer,
@@ -13,19 +13,44 @@ from pharmacy.serializers import (
     MedicationOrderSerializer, MedicationReminderSerializer,
     MedicationLogSerializer
 )
+from pharmacy.services import OrderStateMachine, record_order_created
+from pharmacy.search import autocomplete_medications, DEFAULT_LIMIT
+from pharmacy.adherence import daily_rows, record_log, reminder_breakdown, summarize
+from pharmacy.analytics import pharmacy_report
+from pharmacy.availability import is_orderable, orderable_pharmacy_ids
 from .permissions import IsPharmacyStaffOfOrderPharmacy
+from doctors.permissions import IsDoctorUser
 from doctors.models import Prescription, PrescriptionItem, Appointment
+from insurance.models import UserInsurance
 from django.shortcuts import get_object_or_404
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Exists, OuterRef, Prefetch
+from django.utils import timezone
 from django.contrib.gis.geos import Point
 from django.contrib.gis.measure import D
 from django.contrib.gis.db.models.functions import Distance
+from datetime import date, timedelta
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+def _order_queryset(queryset):
+    """
+    Eager-load everything the order serializers render (user with its nested
+    profile lists, insurance plan, pharmacy and items) so a page of orders
+    costs a fixed number of queries regardless of its size.
+    """
+    return queryset.select_related(
+        'user__doctor_profile', 'pharmacy', 'user_insurance__plan__provider'
+    ).prefetch_related(
+        'items',
+        Prefetch('user__insurance_plans', queryset=UserInsurance.objects.select_related('plan__provider')),
+        'user__emergency_contacts',
+        'user__vaccinations',
+    )
+
+
 class PharmacyDetailView(generics.RetrieveAPIView):
     queryset = Pharmacy.objects.all()
     serializer_class = PharmacySerializer
@@ -41,8 +66,9 @@ class PharmacyListView(generics.ListAPIView):
     def get_queryset(self):
         """
         Filter pharmacies by proximity using GeoDjango if lat, lon, and radius params are provided.
+        Only pharmacies that can currently accept orders are listed.
         """
-        queryset = Pharmacy.objects.all()
+        queryset = Pharmacy.objects.filter(pk__in=orderable_pharmacy_ids())
 
         # --- Proximity Filtering ---
         latitude = self.request.query_params.get('lat')
@@ -104,12 +130,39 @@ class PharmacyOrderListView(generics.ListAPIView):
         """Filter orders for the staff member's assigned pharmacy."""
         user = self.request.user
         if hasattr(user, 'works_at_pharmacy') and user.works_at_pharmacy:
-            return MedicationOrder.objects.filter(pharmacy=user.works_at_pharmacy)
+            return MedicationOrder.objects.filter(pharmacy=user.works_at_pharmacy).select_related('user')
         return MedicationOrder.objects.none()
 
+class PharmacyAnalyticsView(views.APIView):
+    """
+    Sales and fulfilment analytics for the staff member's pharmacy.
+    GET ?start=YYYY-MM-DD&end=YYYY-MM-DD (defaults to the last 30 days, at most 366 days).
+    """
+    permission_classes = [permissions.IsAuthenticated, IsPharmacyStaffOfOrderPharmacy]
+    MAX_RANGE_DAYS = 366
+
+    def get(self, request):
+        pharmacy = getattr(request.user, 'works_at_pharmacy', None)
+        if not pharmacy:
+            return Response({'error': 'You are not assigned to a pharmacy.'}, status=status.HTTP_403_FORBIDDEN)
+
+        today = timezone.localdate()
+        try:
+            end = date.fromisoformat(request.query_params.get('end', today.isoformat()))
+            start = date.fromisoformat(request.query_params.get('start', (end - timedelta(days=29)).isoformat()))
+        except ValueError:
+            raise ValidationError({'detail': 'start and end must be dates in YYYY-MM-DD format.'})
+        if start > end:
+            raise ValidationError({'start': 'start must be on or before end.'})
+        if (end - start).days >= self.MAX_RANGE_DAYS:
+            raise ValidationError({'detail': f'Date range cannot exceed {self.MAX_RANGE_DAYS} days.'})
+
+        return Response(pharmacy_report(pharmacy, start, end))
+
+
 class PharmacyOrderDetailView(generics.RetrieveUpdateAPIView):
     """Retrieve or Update a specific order for the pharmacy."""
-    queryset = MedicationOrder.objects.all()
+    queryset = _order_queryset(MedicationOrder.objects.all())
     permission_classes = [permissions.IsAuthenticated, IsPharmacyStaffOfOrderPharmacy]
 
     def get_serializer_class(self):
@@ -119,200 +172,15 @@ class PharmacyOrderDetailView(generics.RetrieveUpdateAPIView):
         return PharmacyOrderDetailSerializer
     
     def perform_update(self, serializer):
-        """Override to trigger notification on status change by pharmacy and handle insurance."""
-        old_instance = self.get_object()
-        
-        # Handle payment_reference if provided
-        payment_reference = serializer.validated_data.pop('payment_reference', None)
-        old_payment_status = old_instance.payment_status
-        
-        new_instance = serializer.save()
-        
-        # Update payment fields if payment_reference is provided
-        payment_status_changed = False
+        """Apply the pharmacy's edits through the order state machine: one UPDATE, notifications after commit."""
+        changes = dict(serializer.validated_data)
+        payment_reference = changes.pop('payment_reference', None)
+
+        machine = OrderStateMachine(serializer.instance, actor=self.request.user).apply(changes)
         if payment_reference:
-            new_instance.payment_reference = payment_reference
-            new_instance.payment_status = 'paid'
-            new_instance.save()
-            payment_status_changed = (old_payment_status != 'paid' and new_instance.payment_status == 'paid')
-        
-        # Send notification when payment is confirmed
-        if payment_status_changed:
-            try:
-                patient = new_instance.user
-                create_notification(
-                    recipient=patient,
-                    verb=f"Payment confirmed for your medication order #{new_instance.id}.",
-                    title=f"Payment Confirmed - Order #{new_instance.id}",
-                    level='success',
-                    category='order',
-                    action_url=f"/orders/{new_instance.id}",
-                    action_text="View Order"
-                )
-                print(f"Payment confirmation notification created for user {patient.id} for order {new_instance.id}")
-            except Exception as e:
-                print(f"Error creating payment confirmation notification for order {new_instance.id}: {e}")
-                import traceback
-                traceback.print_exc()
-        
-        # Check if payment is required when trying to change status from pending
-        # Payment is required when pharmacy sets total_amount and user tries to proceed
-        # Only check this when status is actually being changed, not when just updating total_amount
-        status_changed = old_instance.status != new_instance.status
-        if status_changed and old_instance.status == 'pending' and new_instance.status != 'pending' and new_instance.status != 'cancelled':
-            if not new_instance.user_insurance and new_instance.total_amount and new_instance.total_amount > 0:
-                if not new_instance.payment_reference or new_instance.payment_status != 'paid':
-                    from rest_framework.exceptions import ValidationError
-                    raise ValidationError({
-                        'status': 'Payment is required for this order. Please ensure the patient has completed payment before the order can proceed to processing.'
-                    })
-        
-        # Check if total_amount was just added (price was set for the first time)
-        total_amount_added = (
-            (old_instance.total_amount is None or old_instance.total_amount == 0) and
-            new_instance.total_amount and
-            new_instance.total_amount > 0
-        )
-        
-        # Send notification when pharmacy adds prices to order
-        if total_amount_added:
-            try:
-                patient = new_instance.user
-                pharmacy_name = new_instance.pharmacy.name if new_instance.pharmacy else "Pharmacy"
-                
-                # Format the total amount
-                from decimal import Decimal
-                total_formatted = f"₦{Decimal(str(new_instance.total_amount)):,.2f}"
-                
-                # Check if insurance is being used
-                if new_instance.user_insurance:
-                    message = f"Your medication order #{new_instance.id} from {pharmacy_name} has been priced at {total_formatted}. Your insurance coverage and copay have been calculated."
-                else:
-                    message = f"Your medication order #{new_instance.id} from {pharmacy_name} has been priced at {total_formatted}. Please proceed with payment to continue."
-                
-                create_notification(
-                    recipient=patient,
-                    verb=message,
-                    title=f"Order #{new_instance.id} Priced",
-                    level='info',
-                    category='order',
-                    action_url=f"/orders/{new_instance.id}",
-                    action_text="View Order & Pay"
-                )
-                logger.info(f"Price notification created for user {patient.id} for order {new_instance.id} (total: {total_formatted})")
-            except Exception as e:
-                logger.error(f"Error creating price notification for order {new_instance.id}: {e}")
-                import traceback
-                traceback.print_exc()
-        
-        # Recalculate insurance if total_amount is updated
-        if new_instance.user_insurance and new_instance.total_amount:
-            from insurance.utils import calculate_insurance_coverage
-            from decimal import Decimal
-            
-            total_amount = Decimal(str(new_instance.total_amount))
-            coverage = calculate_insurance_coverage(
-                new_instance.user_insurance,
-                total_amount,
-                service_type='medication'
-            )
-            
-            new_instance.insurance_covered_amount = coverage['covered_amount']
-            new_instance.patient_copay = coverage['patient_copay']
-            new_instance.save()
-        
-        # Generate insurance claim automatically when order is completed
-        if old_instance.status != new_instance.status and new_instance.status == 'completed':
-            if new_instance.user_insurance and new_instance.total_amount and not new_instance.insurance_claim_generated:
-                from insurance.utils import generate_insurance_claim
-                from django.utils import timezone
-                
-                try:
-                    # Build service description from order items
-                    items_desc = ", ".join([
-                        f"{item.medication_name_text or 'Medication'} ({item.quantity}x)"
-                        for item in new_instance.items.all()
-                    ])
-                    
-                    claim = generate_insurance_claim(
-                        user_insurance=new_instance.user_insurance,
-                        service_type='medication',
-                        service_date=new_instance.order_date.date(),
-                        provider_name=new_instance.pharmacy.name,
-                        service_description=f"Medication Order: {items_desc}",
-                        claimed_amount=new_instance.total_amount,
-                        approved_amount=new_instance.insurance_covered_amount,
-                        patient_responsibility=new_instance.patient_copay,
-                    )
-                    new_instance.insurance_claim_generated = True
-                    new_instance.save()
-                except Exception as e:
-                    print(f"Error generating insurance claim for order {new_instance.id}: {e}")
-
-        # Send notifications for order status changes
-        status_changed = old_instance.status != new_instance.status
-        if status_changed:
-            try:
-                patient = new_instance.user
-                pharmacy_name = new_instance.pharmacy.name if new_instance.pharmacy else "Pharmacy"
-                
-                if new_instance.status == 'processing':
-                    create_notification(
-                        recipient=patient,
-                        verb=f"Your medication order #{new_instance.id} from {pharmacy_name} is now being processed.",
-                        title=f"Order #{new_instance.id} Processing",
-                        level='info',
-                        category='order',
-                        action_url=f"/orders/{new_instance.id}",
-                        action_text="View Order"
-                    )
-                elif new_instance.status == 'ready':
-                    delivery_text = 'delivery' if new_instance.is_delivery else 'pickup'
-                    create_notification(
-                        recipient=patient,
-                        verb=f"Your medication order #{new_instance.id} from {pharmacy_name} is ready for {delivery_text}.",
-                        title=f"Order #{new_instance.id} Ready",
-                        level='success',
-                        category='order',
-                        action_url=f"/orders/{new_instance.id}",
-                        action_text="View Order"
-                    )
-                elif new_instance.status == 'delivering':
-                    create_notification(
-                        recipient=patient,
-                        verb=f"Your medication order #{new_instance.id} from {pharmacy_name} is out for delivery.",
-                        title=f"Order #{new_instance.id} Out for Delivery",
-                        level='info',
-                        category='order',
-                        action_url=f"/orders/{new_instance.id}",
-                        action_text="Track Order"
-                    )
-                elif new_instance.status == 'completed':
-                    create_notification(
-                        recipient=patient,
-                        verb=f"Your medication order #{new_instance.id} from {pharmacy_name} has been completed.",
-                        title=f"Order #{new_instance.id} Completed",
-                        level='success',
-                        category='order',
-                        action_url=f"/orders/{new_instance.id}",
-                        action_text="View Order"
-                    )
-                elif new_instance.status == 'cancelled':
-                    create_notification(
-                        recipient=patient,
-                        verb=f"Your medication order #{new_instance.id} from {pharmacy_name} has been cancelled.",
-                        title=f"Order #{new_instance.id} Cancelled",
-                        level='warning',
-                        category='order',
-                        action_url=f"/orders/{new_instance.id}",
-                        action_text="View Details"
-                    )
-                
-                print(f"Status change notification created for user {patient.id} for order {new_instance.id} (status: {new_instance.status})")
-            except Exception as e:
-                print(f"Error creating status change notification for order {new_instance.id}: {e}")
-                import traceback
-                traceback.print_exc()
+            machine.record_payment(payment_reference)
+        serializer.instance = machine.save()
+
 
 class MedicationListView(generics.ListAPIView):
     queryset = Medication.objects.all()
@@ -321,6 +189,24 @@ class MedicationListView(generics.ListAPIView):
     filter_backends = [filters.SearchFilter]
     search_fields = ['name', 'generic_name']
 
+
+class MedicationAutocompleteView(views.APIView):
+    """
+    Type-ahead suggestions for the medication catalog.
+    GET ?q=<prefix>&limit=<n> returns compact records ranked by prescription frequency.
+    """
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request):
+        query = request.query_params.get('q', '')
+        try:
+            limit = int(request.query_params.get('limit', DEFAULT_LIMIT))
+        except (TypeError, ValueError):
+            limit = DEFAULT_LIMIT
+
+        results, source = autocomplete_medications(query, limit)
+        return Response({'results': results, 'source': source})
+
 class PharmacyInventoryListView(generics.ListAPIView):
     serializer_class = PharmacyInventorySerializer
     permission_classes = [permissions.AllowAny]
@@ -411,33 +297,19 @@ class CreateOrderFromPrescriptionView(views.APIView):
             except UserInsurance.DoesNotExist:
                 pass  # Continue without insurance if invalid
 
-        # Fetch Pharmacy
-        try:
-            pharmacy = Pharmacy.objects.get(pk=pharmacy_id)
-        except Pharmacy.DoesNotExist:
-            return Response(
-                {"error": f"Pharmacy with ID {pharmacy_id} not found."},
-                status=status.HTTP_404_NOT_FOUND
-            )
-        except (ValueError, TypeError):
-             return Response(
-                {"error": f"Invalid pharmacy_id format provided."},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
         # --- Validation 3: Check if Pharmacy is Active and Subscribed ---
-        if not pharmacy.is_active:
+        # Answered from the cached orderable set; unknown, inactive and expired pharmacies are all excluded.
+        if not is_orderable(pharmacy_id):
             return Response(
-                {"error": f"The selected pharmacy '{pharmacy.name}' is currently inactive and cannot accept orders."},
+                {"error": f"Pharmacy with ID {pharmacy_id} was not found or cannot accept orders (inactive or expired registration)."},
                 status=status.HTTP_400_BAD_REQUEST
             )
-            
-        # Check subscription expiry
-        from django.utils import timezone
-        if pharmacy.subscription_expiry and pharmacy.subscription_expiry < timezone.now().date():
-             return Response(
-                {"error": f"The selected pharmacy '{pharmacy.name}' has an expired registration and cannot accept orders."},
-                status=status.HTTP_400_BAD_REQUEST
+        pharmacy = Pharmacy.objects.filter(pk=pharmacy_id).first()
+        if pharmacy is None:
+            # Deleted after the orderable set was read.
+            return Response(
+                {"error": f"Pharmacy with ID {pharmacy_id} was not found."},
+                status=status.HTTP_404_NOT_FOUND
             )
         # --- End Validation 3 ---
 
@@ -511,6 +383,8 @@ class CreateOrderFromPrescriptionView(views.APIView):
                 # price_per_unit will be filled by pharmacy later
             )
 
+        record_order_created(order, actor=request.user)
+
         # Refresh the order from database to ensure items are accessible
         order.refresh_from_db()
         
@@ -529,18 +403,17 @@ class CreateOrderFromPrescriptionView(views.APIView):
             patient_name = f"{request.user.first_name} {request.user.last_name}".strip() or request.user.email
             prescription_items_count = prescription_items.count()
             
-            for staff_member in pharmacy_staff:
-                create_notification(
-                    recipient=staff_member,
-                    verb=f"New medication order #{order.id} received from {patient_name}. Prescription includes {prescription_items_count} medication(s).",
-                    title=f"New Order #{order.id}",
-                    level='info',
-                    category='order',
-                    actor=request.user,
-                    action_url=f"/portal/orders/{order.id}",
-                    action_text="View Order"
-                )
-            logger.info(f"Created notifications for {pharmacy_staff.count()} pharmacy staff members for order {order.id}")
+            notifications = create_notifications(
+                pharmacy_staff,
+                verb=f"New medication order #{order.id} received from {patient_name}. Prescription includes {prescription_items_count} medication(s).",
+                title=f"New Order #{order.id}",
+                level='info',
+                category='order',
+                actor=request.user,
+                action_url=f"/portal/orders/{order.id}",
+                action_text="View Order"
+            )
+            logger.info(f"Created notifications for {len(notifications)} pharmacy staff members for order {order.id}")
         except Exception as e:
             logger.error(f"Error creating notifications for pharmacy staff for order {order.id}: {e}")
             import traceback
@@ -568,7 +441,7 @@ class MedicationOrderListCreateView(generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return MedicationOrder.objects.filter(user=self.request.user)
+        return _order_queryset(MedicationOrder.objects.filter(user=self.request.user))
 
     def perform_create(self, serializer):
         # Enforce prescription requirement
@@ -589,6 +462,7 @@ class MedicationOrderListCreateView(generics.ListCreateAPIView):
                 pass  # Continue without insurance if invalid
         
         order = serializer.save(user=self.request.user, user_insurance=user_insurance)
+        record_order_created(order, actor=self.request.user)
         
         # Send notifications to all pharmacy staff members
         if order.pharmacy:
@@ -603,18 +477,17 @@ class MedicationOrderListCreateView(generics.ListCreateAPIView):
                 patient_name = f"{self.request.user.first_name} {self.request.user.last_name}".strip() or self.request.user.email
                 items_count = order.items.count() if hasattr(order, 'items') else 0
                 
-                for staff_member in pharmacy_staff:
-                    create_notification(
-                        recipient=staff_member,
-                        verb=f"New medication order #{order.id} received from {patient_name}. Order includes {items_count} medication(s).",
-                        title=f"New Order #{order.id}",
-                        level='info',
-                        category='order',
-                        actor=self.request.user,
-                        action_url=f"/portal/orders/{order.id}",
-                        action_text="View Order"
-                    )
-                logger.info(f"Created notifications for {pharmacy_staff.count()} pharmacy staff members for order {order.id}")
+                notifications = create_notifications(
+                    pharmacy_staff,
+                    verb=f"New medication order #{order.id} received from {patient_name}. Order includes {items_count} medication(s).",
+                    title=f"New Order #{order.id}",
+                    level='info',
+                    category='order',
+                    actor=self.request.user,
+                    action_url=f"/portal/orders/{order.id}",
+                    action_text="View Order"
+                )
+                logger.info(f"Created notifications for {len(notifications)} pharmacy staff members for order {order.id}")
             except Exception as e:
                 logger.error(f"Error creating notifications for pharmacy staff for order {order.id}: {e}")
                 import traceback
@@ -801,9 +674,7 @@ class ConfirmPickupView(views.APIView):
             )
         
         # Update status to completed
-        old_status = order.status
-        order.status = 'completed'
-        order.save()
+        OrderStateMachine(order, actor=request.user).transition_to('completed').save()
         
         # Send notification to pharmacy
         try:
@@ -829,150 +700,31 @@ class MedicationOrderDetailView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return MedicationOrder.objects.filter(user=self.request.user)
-    
-    def update(self, request, *args, **kwargs):
-        """Override update to ensure we return the updated instance with correct payment_status"""
-        partial = kwargs.pop('partial', False)
-        instance = self.get_object()
-        serializer = self.get_serializer(instance, data=request.data, partial=partial)
-        serializer.is_valid(raise_exception=True)
-        self.perform_update(serializer)
-        
-        # Get the updated instance (it should have payment_status updated in perform_update)
-        updated_instance = self.get_object()
-        # Force refresh from database to ensure we have the latest payment_status
-        updated_instance.refresh_from_db(fields=['payment_reference', 'payment_status', 'status', 'total_amount'])
-        
-        # Return the updated instance with fresh data
-        response_serializer = self.get_serializer(updated_instance)
-        response_data = response_serializer.data
-        
-        # Ensure payment_status is in the response (in case serializer method fails)
-        # Force refresh payment_status from database to ensure we return the latest value
-        updated_instance.refresh_from_db(fields=['payment_status', 'payment_reference'])
-        actual_payment_status = updated_instance.payment_status
-        
-        # Override payment_status in response if serializer method didn't return correct value
-        if 'payment_status' not in response_data or response_data['payment_status'] != actual_payment_status:
-            logger.warning(f"Payment status mismatch - serializer returned: {response_data.get('payment_status')}, actual DB value: {actual_payment_status}")
-            response_data['payment_status'] = actual_payment_status
-        
-        # Also ensure payment_reference is in response if it exists
-        if updated_instance.payment_reference and 'payment_reference' not in response_data:
-            response_data['payment_reference'] = updated_instance.payment_reference
-        
-        logger.info(f"Returning order {updated_instance.id} with payment_status: {response_data.get('payment_status')}, payment_reference: {response_data.get('payment_reference')}")
-        return Response(response_data)
+        return _order_queryset(MedicationOrder.objects.filter(user=self.request.user))
     
     def perform_update(self, serializer):
-        """Override to handle insurance calculation and claim generation."""
-        old_instance = self.get_object()
-        
-        # Handle insurance if being updated
-        user_insurance_id = serializer.validated_data.pop('user_insurance_id', None)
-        payment_reference = serializer.validated_data.pop('payment_reference', None)
-        user_insurance = old_instance.user_insurance  # Keep existing if not updating
-        
-        if user_insurance_id is not None:  # Explicitly set (could be None to remove)
-            from insurance.models import UserInsurance
+        """Apply the patient's edits (insurance, payment) through the order state machine."""
+        changes = dict(serializer.validated_data)
+        raise_errors_on_nested_writes('update', serializer, changes)
+        user_insurance_id = changes.pop('user_insurance_id', None)
+        payment_reference = changes.pop('payment_reference', None)
+
+        if user_insurance_id is not None:  # Explicitly set (0 removes insurance)
             if user_insurance_id:
+                from insurance.models import UserInsurance
                 try:
-                    user_insurance = UserInsurance.objects.get(id=user_insurance_id, user=self.request.user)
+                    changes['user_insurance'] = UserInsurance.objects.get(id=user_insurance_id, user=self.request.user)
                 except UserInsurance.DoesNotExist:
                     pass  # Keep existing insurance if invalid
             else:
-                user_insurance = None  # Remove insurance
-        
-        new_instance = serializer.save(user_insurance=user_insurance)
-        
-        # Update payment fields if payment_reference is provided
-        payment_status_changed = False
+                changes['user_insurance'] = None
+
+        machine = OrderStateMachine(serializer.instance, actor=self.request.user).apply(changes)
         if payment_reference:
-            old_payment_status = old_instance.payment_status
-            logger.info(f"Updating order {new_instance.id} with payment_reference: {payment_reference}")
-            logger.info(f"Order {new_instance.id} current payment_status before update: {new_instance.payment_status}")
-            logger.info(f"Order {new_instance.id} current payment_reference before update: {new_instance.payment_reference}")
-            
-            # Use update() to ensure atomic update
-            from pharmacy.models import MedicationOrder
-            updated_count = MedicationOrder.objects.filter(pk=new_instance.id).update(
-                payment_reference=payment_reference,
-                payment_status='paid'
-            )
-            
-            if updated_count > 0:
-                logger.info(f"✓ Order {new_instance.id} payment fields updated successfully via QuerySet.update()")
-                # Refresh the instance to get updated values
-                new_instance.refresh_from_db(fields=['payment_reference', 'payment_status'])
-                logger.info(f"Order {new_instance.id} payment_status after refresh: {new_instance.payment_status}")
-                logger.info(f"Order {new_instance.id} payment_reference after refresh: {new_instance.payment_reference}")
-                payment_status_changed = (old_payment_status != 'paid' and new_instance.payment_status == 'paid')
-            else:
-                logger.error(f"❌ Failed to update order {new_instance.id} - no rows affected")
-        
-        # Send notification when payment is confirmed
-        if payment_status_changed:
-            try:
-                patient = new_instance.user
-                create_notification(
-                    recipient=patient,
-                    verb=f"Payment confirmed for your medication order #{new_instance.id}.",
-                    title=f"Payment Confirmed - Order #{new_instance.id}",
-                    level='success',
-                    category='order',
-                    action_url=f"/orders/{new_instance.id}",
-                    action_text="View Order"
-                )
-                logger.info(f"Payment confirmation notification created for user {patient.id} for order {new_instance.id}")
-            except Exception as e:
-                logger.error(f"Error creating payment confirmation notification for order {new_instance.id}: {e}")
-                import traceback
-                traceback.print_exc()
-        
-        # Recalculate insurance if total_amount is set and insurance exists
-        if user_insurance and new_instance.total_amount:
-            from insurance.utils import calculate_insurance_coverage
-            from decimal import Decimal
-            
-            total_amount = Decimal(str(new_instance.total_amount))
-            coverage = calculate_insurance_coverage(
-                user_insurance,
-                total_amount,
-                service_type='medication'
-            )
-            
-            new_instance.insurance_covered_amount = coverage['covered_amount']
-            new_instance.patient_copay = coverage['patient_copay']
-            new_instance.save()
-        
-        # Generate insurance claim automatically when order is completed
-        if old_instance.status != new_instance.status and new_instance.status == 'completed':
-            if new_instance.user_insurance and new_instance.total_amount and not new_instance.insurance_claim_generated:
-                from insurance.utils import generate_insurance_claim
-                from django.utils import timezone
-                
-                try:
-                    # Build service description from order items
-                    items_desc = ", ".join([
-                        f"{item.medication_name_text or 'Medication'} ({item.quantity}x)"
-                        for item in new_instance.items.all()
-                    ])
-                    
-                    claim = generate_insurance_claim(
-                        user_insurance=new_instance.user_insurance,
-                        service_type='medication',
-                        service_date=new_instance.order_date.date(),
-                        provider_name=new_instance.pharmacy.name,
-                        service_description=f"Medication Order: {items_desc}",
-                        claimed_amount=new_instance.total_amount,
-                        approved_amount=new_instance.insurance_covered_amount,
-                        patient_responsibility=new_instance.patient_copay,
-                    )
-                    new_instance.insurance_claim_generated = True
-                    new_instance.save()
-                except Exception as e:
-                    print(f"Error generating insurance claim for order {new_instance.id}: {e}")
+            logger.info(f"Recording payment_reference {payment_reference} for order {serializer.instance.id}")
+            machine.record_payment(payment_reference)
+        serializer.instance = machine.save()
+
 
 class MedicationReminderListCreateView(generics.ListCreateAPIView):
     serializer_class = MedicationReminderSerializer
@@ -1043,7 +795,9 @@ class MedicationLogListCreateView(generics.ListCreateAPIView):
         reminder = serializer.validated_data['reminder']
         if reminder.user != self.request.user:
             raise ValidationError("You cannot log intake for another user's reminder.")
-        serializer.save()
+        with transaction.atomic():
+            log = serializer.save()
+            record_log(log)
 
 class LogMedicationIntakeView(views.APIView):
     permission_classes = [permissions.IsAuthenticated]
@@ -1056,33 +810,82 @@ class LogMedicationIntakeView(views.APIView):
         notes = request.data.get('notes', '')
         
         if not taken_at and status_value == 'taken':
-            from django.utils import timezone
             taken_at = timezone.now()
-            
-        # Create the log entry
-        log = MedicationLog.objects.create(
-            reminder=reminder,
-            scheduled_time=taken_at or timezone.now(), # Simplified logic; ideally match to next schedule
-            taken_at=taken_at,
-            status=status_value,
-            notes=notes
-        )
+
+        serializer = MedicationLogSerializer(data={
+            'reminder': reminder.id,
+            'scheduled_time': taken_at or timezone.now(), # Simplified logic; ideally match to next schedule
+            'taken_at': taken_at,
+            'status': status_value,
+            'notes': notes,
+        })
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            log = serializer.save()
+            record_log(log)
         
         return Response(MedicationLogSerializer(log).data, status=status.HTTP_201_CREATED)
-        taken_at = request.data.get('taken_at') # Optional override
-        notes = request.data.get('notes', '')
-        
-        if not taken_at and status_value == 'taken':
-            from django.utils import timezone
-            taken_at = timezone.now()
-            
-        # Create the log entry
-        log = MedicationLog.objects.create(
-            reminder=reminder,
-            scheduled_time=taken_at or timezone.now(), # Simplified logic; ideally match to next schedule
-            taken_at=taken_at,
-            status=status_value,
-            notes=notes
+
+
+class MedicationAdherenceView(views.APIView):
+    """
+    Adherence summary for the current user over the last `days` days (default 30):
+    totals, adherence percentage, streaks and a per-reminder breakdown.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        days = _adherence_days(request)
+        rows = daily_rows(UserAdherenceDaily.objects.filter(user=request.user), days)
+        summary = summarize(rows)
+        summary.pop('heatmap')
+        summary['days'] = days
+        summary['reminders'] = reminder_breakdown(request.user, days)
+        return Response(summary)
+
+
+class MedicationAdherenceHeatmapView(views.APIView):
+    """Missed doses per day for the current user over the last `days` days (default 90)."""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        days = _adherence_days(request, default=90)
+        rows = daily_rows(UserAdherenceDaily.objects.filter(user=request.user), days)
+        return Response({'days': days, 'heatmap': summarize(rows)['heatmap']})
+
+
+class PatientMedicationAdherenceView(views.APIView):
+    """
+    Adherence summary and heatmap for one of the requesting doctor's patients.
+    The rollup rows are read in a single query that also checks the doctor has
+    an appointment with the patient.
+    """
+    permission_classes = [permissions.IsAuthenticated, IsDoctorUser]
+
+    def get(self, request, patient_id):
+        doctor = request.user.doctor_profile
+        days = _adherence_days(request)
+        has_appointment = Appointment.objects.filter(user_id=OuterRef('user_id'), doctor=doctor)
+        rows = daily_rows(
+            UserAdherenceDaily.objects.filter(user_id=patient_id).filter(Exists(has_appointment)),
+            days
         )
-        
-        return Response(MedicationLogSerializer(log).data, status=status.HTTP_201_CREATED)
\ No newline at end of file
+        if not rows and not Appointment.objects.filter(user_id=patient_id, doctor=doctor).exists():
+            return Response(
+                {'error': 'You can only view adherence for your own patients.'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        summary = summarize(rows)
+        summary['days'] = days
+        summary['patient'] = patient_id
+        return Response(summary)
+
+
+def _adherence_days(request, default=30):
+    try:
+        days = int(request.query_params.get('days', default))
+    except (TypeError, ValueError):
+        raise ValidationError({'days': 'Must be an integer.'})
+    if not 1 <= days <= 366:
+        raise ValidationError({'days': 'Must be between 1 and 366.'})
+    return days
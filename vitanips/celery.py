@@ -1,10 +1,14 @@
 # vitanips/celery.py
+import logging
 import os
 from celery import Celery
+from celery.signals import worker_process_init
 from celery.schedules import crontab
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'vitanips.settings')
 
+logger = logging.getLogger(__name__)
+
 app = Celery('vitanips')
 
 app.config_from_object('django.conf:settings', namespace='CELERY')
@@ -16,12 +20,78 @@ app.conf.beat_schedule = {
         'task': 'doctors.tasks.send_appointment_reminders_task',
         'schedule': crontab(minute='*/15'),
     },
-    'send-medication-reminders-daily': {
+    'send-medication-reminders-every-minute': {
         'task': 'pharmacy.tasks.send_medication_reminders_task',
-        'schedule': crontab(hour=8, minute=0),
+        'schedule': crontab(),
+    },
+    'dispatch-pending-order-events-every-5-mins': {
+        'task': 'pharmacy.tasks.dispatch_pending_order_events',
+        'schedule': crontab(minute='*/5'),
+    },
+    'send-low-stock-alerts-every-30-mins': {
+        'task': 'pharmacy.tasks.send_low_stock_alerts',
+        'schedule': crontab(minute='*/30'),
+    },
+    'expire-pharmacy-subscriptions-daily': {
+        'task': 'pharmacy.tasks.expire_pharmacy_subscriptions',
+        'schedule': crontab(hour=0, minute=5),
+    },
+    'backfill-geocodes-hourly': {
+        'task': 'pharmacy.tasks.backfill_geocodes_task',
+        'schedule': crontab(minute=30),
+    },
+    # Notifications. Appointment reminders are sent by doctors.tasks above, so
+    # notifications.tasks.check_appointment_reminders is not scheduled as well.
+    'check-medication-refill-reminders': {
+        'task': 'notifications.tasks.check_medication_refill_reminders',
+        'schedule': crontab(hour='9', minute='0'),  # Daily at 9 AM
+    },
+    'process-scheduled-notifications': {
+        'task': 'notifications.tasks.process_scheduled_notifications',
+        'schedule': crontab(),  # Every minute; only schedules past next_send_at are claimed
+    },
+    'retry-failed-deliveries': {
+        'task': 'notifications.tasks.retry_failed_deliveries',
+        'schedule': crontab(),  # Every minute; backoff lives in each row's next_retry_at
+    },
+    'cleanup-old-notifications': {
+        'task': 'notifications.tasks.cleanup_old_notifications',
+        'schedule': crontab(hour='2-5', minute='0'),  # Hourly 2-5 AM; each run resumes the last checkpoint
+    },
+    'send-queued-notification-deliveries': {
+        'task': 'notifications.tasks.send_queued_deliveries_task',
+        'schedule': crontab(),  # Every minute; sweeps anything the per-batch tasks left queued
+    },
+    'release-deferred-notifications': {
+        'task': 'notifications.tasks.release_deferred_notifications',
+        'schedule': crontab(),  # Every minute; releases notifications held by quiet hours
+    },
+    'send-notification-digests': {
+        'task': 'notifications.tasks.send_notification_digests',
+        'schedule': crontab(minute='*/15'),  # Digest times are honoured to the quarter hour
+    },
+    'apply-delivery-status-events': {
+        'task': 'notifications.tasks.apply_delivery_status_events',
+        'schedule': crontab(),  # Every minute; applies queued provider callbacks in batches
+    },
+    'reconcile-unread-notification-counters': {
+        'task': 'notifications.tasks.reconcile_unread_notification_counters',
+        'schedule': crontab(minute='20'),  # Hourly
     },
 }
 
+@worker_process_init.connect
+def warm_notification_templates(**kwargs):
+    """Compile notification templates before the first delivery batch needs them."""
+    from notifications.template_cache import warm_template_cache
+
+    try:
+        warm_template_cache()
+    except Exception:
+        # Templates still compile lazily on first use.
+        logger.exception("Could not warm notification template cache")
+
+
 @app.task(bind=True, ignore_result=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
\ No newline at end of file
@@ -0,0 +1,301 @@
+# vitanips/core/clients.py
+"""
+Long-lived clients for external providers (Twilio, SMTP, Flutterwave).
+
+Each worker process lazily builds one client per provider and reuses it, so
+connections stay open between messages instead of paying a TCP/TLS handshake
+per SMS, email or payment call. Clients are rebuilt after a fork, never shared
+across processes. HTTP clients have default timeouts and retry connection
+errors with backoff; every provider sits behind a circuit breaker that fails
+fast with ProviderUnavailable after repeated failures.
+"""
+import logging
+import os
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+import requests
+from django.conf import settings
+from django.core.mail import get_connection
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ProviderUnavailable(Exception):
+    """The provider's circuit is open; the call was not attempted."""
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls for
+    `reset_timeout` seconds, then lets one trial call through (half-open): a
+    success closes the circuit, a failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def check(self):
+        with self._lock:
+            state = self.state
+            if state == 'open':
+                raise ProviderUnavailable(f"{self.name} is unavailable (circuit open)")
+            if state == 'half-open':
+                # Re-arm the timeout so concurrent callers see 'open' while this trial runs.
+                self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f"Opening circuit for {self.name} after {self.failures} failures")
+                self.opened_at = time.monotonic()
+
+    @contextmanager
+    def guard(self, is_failure=None, fail_fast=True):
+        """
+        Run a provider call; exceptions for which is_failure(exc) is true (all
+        of them by default) count towards opening the circuit. Client errors
+        such as an invalid phone number should not: the provider answered, so
+        they count as a success. With fail_fast=False the call is attempted
+        even while the circuit is open (its outcome is still recorded).
+        """
+        if fail_fast:
+            self.check()
+        try:
+            yield
+        except Exception as e:
+            if is_failure is None or is_failure(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        self.record_success()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default timeout to requests made without one."""
+
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def build_session(timeout, max_retries, backoff_factor=0.5):
+    """
+    A pooled keep-alive session. Connection failures are retried for every
+    method (the request never reached the provider); HTTP error statuses are
+    retried for GETs only so a payment is never submitted twice.
+    """
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=0,
+        status=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({'GET', 'HEAD'}),
+        raise_on_status=False,
+    )
+    adapter = TimeoutHTTPAdapter(timeout=timeout, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _build_twilio():
+    if not (settings.TWILIO_ACCOUNT_SID and settings.TWILIO_AUTH_TOKEN):
+        return None
+    from twilio.http.http_client import TwilioHttpClient
+    from twilio.rest import Client
+
+    http_client = TwilioHttpClient(
+        pool_connections=True,
+        timeout=settings.PROVIDER_CLIENT_TIMEOUT,
+        max_retries=settings.PROVIDER_CLIENT_MAX_RETRIES,
+    )
+    return Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN, http_client=http_client)
+
+
+def _build_flutterwave():
+    return build_session(settings.PROVIDER_CLIENT_TIMEOUT, settings.PROVIDER_CLIENT_MAX_RETRIES)
+
+
+def _build_smtp():
+    # Opened on first send and kept open; see send_email_messages().
+    return get_connection(fail_silently=False)
+
+
+class ProviderClients:
+    """Per-process registry of provider clients and their circuit breakers."""
+    factories = {
+        'twilio': _build_twilio,
+        'flutterwave': _build_flutterwave,
+        'smtp': _build_smtp,
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._clients = {}
+        self._breakers = {}
+
+    def _check_pid(self):
+        # A forked worker must not share the parent's sockets.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._clients = {}
+                    self._breakers = {}
+                    self._pid = os.getpid()
+
+    def get(self, name):
+        self._check_pid()
+        if name not in self._clients:
+            with self._lock:
+                if name not in self._clients:
+                    self._clients[name] = self.factories[name]()
+                    logger.info(f"Created {name} client for process {self._pid}")
+        return self._clients[name]
+
+    def breaker(self, name):
+        self._check_pid()
+        if name not in self._breakers:
+            with self._lock:
+                self._breakers.setdefault(name, CircuitBreaker(
+                    name,
+                    failure_threshold=settings.PROVIDER_CIRCUIT_FAILURE_THRESHOLD,
+                    reset_timeout=settings.PROVIDER_CIRCUIT_RESET_TIMEOUT,
+                ))
+        return self._breakers[name]
+
+    def twilio(self):
+        """Shared Twilio REST client, or None when Twilio is not configured."""
+        return self.get('twilio')
+
+    def flutterwave(self):
+        return self.get('flutterwave')
+
+    def smtp(self):
+        return self.get('smtp')
+
+    def reset(self):
+        """Drop every client (closing the SMTP connection) and breaker."""
+        with self._lock:
+            clients, self._clients, self._breakers = self._clients, {}, {}
+        if clients.get('smtp') is not None:
+            clients['smtp'].close()
+        if clients.get('flutterwave') is not None:
+            clients['flutterwave'].close()
+
+
+provider_clients = ProviderClients()
+
+
+def _is_twilio_failure(exc):
+    from twilio.base.exceptions import TwilioRestException
+
+    # 4xx responses (bad number, unsubscribed recipient) are the caller's problem.
+    return not isinstance(exc, TwilioRestException) or exc.status >= 500
+
+
+def send_sms(to, body, from_=None, status_callback=None, fail_fast=True):
+    """
+    Send one SMS through the shared Twilio client; returns the Twilio message.
+    Twilio posts delivery status updates to status_callback when given.
+    Pass fail_fast=False for messages that must be attempted even while the
+    circuit is open (emergency alerts).
+    """
+    client = provider_clients.twilio()
+    if client is None:
+        raise ProviderUnavailable("Twilio is not configured")
+    kwargs = {'status_callback': status_callback} if status_callback else {}
+    with provider_clients.breaker('twilio').guard(_is_twilio_failure, fail_fast=fail_fast):
+        return client.messages.create(body=body, from_=from_ or settings.TWILIO_PHONE_NUMBER, to=to, **kwargs)
+
+
+@contextmanager
+def twilio_call():
+    """
+    Run a Twilio Video API call (rooms, recordings) behind its own breaker, so
+    a Video outage does not stop SMS; yields the client.
+    """
+    client = provider_clients.twilio()
+    if client is None:
+        raise ProviderUnavailable("Twilio is not configured")
+    with provider_clients.breaker('twilio_video').guard(_is_twilio_failure):
+        yield client
+
+
+def _is_smtp_failure(exc):
+    # Refused recipients or a rejected message are about that message, not the server.
+    if isinstance(exc, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    return isinstance(exc, OSError) and not isinstance(exc, smtplib.SMTPException)
+
+
+def send_email_messages(messages):
+    """
+    Send EmailMessages over the process's persistent mail connection. Servers
+    drop idle connections, so a disconnect reopens the connection and retries
+    once. Returns the number of messages sent.
+    """
+    connection = provider_clients.smtp()
+    with provider_clients.breaker('smtp').guard(_is_smtp_failure):
+        # Opening explicitly stops send_messages() from closing the connection afterwards.
+        connection.open()
+        try:
+            return connection.send_messages(messages)
+        except smtplib.SMTPServerDisconnected:
+            connection.close()
+            connection.open()
+            return connection.send_messages(messages)
+
+
+def flutterwave_request(method, url, **kwargs):
+    """
+    Make a Flutterwave API call on the shared session. Network errors and 5xx
+    responses count towards the circuit; the response is returned as-is.
+    """
+    breaker = provider_clients.breaker('flutterwave')
+    breaker.check()
+    try:
+        response = provider_clients.flutterwave().request(method, url, **kwargs)
+    except requests.RequestException:
+        breaker.record_failure()
+        raise
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
@@ -1,9 +1,18 @@
 # vitanips/core/tests.py
+import smtplib
+from unittest.mock import MagicMock, patch
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
 from django.contrib.auth import get_user_model
 from faker import Faker
+from twilio.base.exceptions import TwilioRestException
+from .clients import (
+    CircuitBreaker, ProviderClients, ProviderUnavailable, flutterwave_request,
+    provider_clients, send_email_messages, send_sms,
+)
 
 User = get_user_model()
 
@@ -49,3 +58,150 @@ class AdminViewsTestCase(APITestCase):
         url = reverse('admin-stats')
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(PROVIDER_CIRCUIT_FAILURE_THRESHOLD=2, PROVIDER_CIRCUIT_RESET_TIMEOUT=30)
+class ProviderClientsTestCase(SimpleTestCase):
+    def setUp(self):
+        provider_clients.reset()
+        self.addCleanup(provider_clients.reset)
+
+    def test_circuit_opens_and_half_opens(self):
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+        for _ in range(2):
+            with self.assertRaises(ValueError), breaker.guard():
+                raise ValueError("down")
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaises(ProviderUnavailable), breaker.guard():
+            self.fail("call made while the circuit was open")
+
+        with patch('vitanips.core.clients.time.monotonic', return_value=breaker.opened_at + 31):
+            self.assertEqual(breaker.state, 'half-open')
+            with breaker.guard():
+                pass
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_half_open_admits_a_single_trial(self):
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=30)
+        with self.assertRaises(ValueError), breaker.guard():
+            raise ValueError("down")
+
+        with patch('vitanips.core.clients.time.monotonic', return_value=breaker.opened_at + 31):
+            with breaker.guard():
+                with self.assertRaises(ProviderUnavailable), breaker.guard():
+                    self.fail("second call admitted while the trial was running")
+        self.assertEqual(breaker.state, 'closed')
+
+        with self.assertRaises(ValueError), breaker.guard():
+            raise ValueError("down")
+        with patch('vitanips.core.clients.time.monotonic', return_value=breaker.opened_at + 31):
+            with self.assertRaises(ValueError), breaker.guard():
+                raise ValueError("still down")
+            self.assertEqual(breaker.state, 'open')
+
+    def test_clients_are_built_once_per_process(self):
+        factory = MagicMock(side_effect=lambda: object())
+        registry = ProviderClients()
+        with patch.dict(registry.factories, {'flutterwave': factory}):
+            first = registry.flutterwave()
+            self.assertIs(registry.flutterwave(), first)
+            with patch('vitanips.core.clients.os.getpid', return_value=registry._pid + 1):
+                self.assertIsNot(registry.flutterwave(), first)
+        self.assertEqual(factory.call_count, 2)
+
+    def test_sms_client_errors_do_not_trip_the_circuit(self):
+        client = MagicMock()
+        client.messages.create.side_effect = TwilioRestException(status=400, uri='/Messages', msg='Invalid number')
+        with patch.object(provider_clients, 'twilio', return_value=client):
+            for _ in range(3):
+                with self.assertRaises(TwilioRestException):
+                    send_sms('+2348000000000', 'Hello')
+        self.assertEqual(provider_clients.breaker('twilio').state, 'closed')
+
+    def test_client_error_during_half_open_trial_closes_the_circuit(self):
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=30)
+        with self.assertRaises(ValueError), breaker.guard():
+            raise ValueError("down")
+
+        with patch('vitanips.core.clients.time.monotonic', return_value=breaker.opened_at + 31):
+            with self.assertRaises(KeyError), breaker.guard(is_failure=lambda e: not isinstance(e, KeyError)):
+                raise KeyError("bad request")
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_rejected_recipients_do_not_trip_the_smtp_circuit(self):
+        connection = MagicMock()
+        connection.send_messages.side_effect = smtplib.SMTPRecipientsRefused({'bad@example.com': (550, b'No such user')})
+        with patch.object(provider_clients, 'smtp', return_value=connection):
+            for _ in range(3):
+                with self.assertRaises(smtplib.SMTPRecipientsRefused):
+                    send_email_messages([MagicMock()])
+        self.assertEqual(provider_clients.breaker('smtp').state, 'closed')
+
+        connection.send_messages.side_effect = TimeoutError()
+        with patch.object(provider_clients, 'smtp', return_value=connection):
+            for _ in range(2):
+                with self.assertRaises(TimeoutError):
+                    send_email_messages([MagicMock()])
+        self.assertEqual(provider_clients.breaker('smtp').state, 'open')
+
+    def test_video_outage_does_not_block_sms(self):
+        from .clients import twilio_call
+
+        client = MagicMock()
+        with patch.object(provider_clients, 'twilio', return_value=client):
+            for _ in range(2):
+                with self.assertRaises(ConnectionError), twilio_call():
+                    raise ConnectionError("video down")
+            send_sms('+2348000000000', 'Hello')
+        self.assertEqual(provider_clients.breaker('twilio_video').state, 'open')
+        self.assertEqual(provider_clients.breaker('twilio').state, 'closed')
+
+    def test_emergency_sms_is_attempted_while_the_circuit_is_open(self):
+        client = MagicMock()
+        client.messages.create.side_effect = [ConnectionError(), ConnectionError(), MagicMock(sid='SM1')]
+        with patch.object(provider_clients, 'twilio', return_value=client):
+            for _ in range(2):
+                with self.assertRaises(ConnectionError):
+                    send_sms('+2348000000000', 'Hello')
+            with self.assertRaises(ProviderUnavailable):
+                send_sms('+2348000000000', 'Hello')
+            self.assertEqual(send_sms('+2348000000000', 'SOS', fail_fast=False).sid, 'SM1')
+        self.assertEqual(provider_clients.breaker('twilio').state, 'closed')
+
+    def test_flutterwave_5xx_opens_the_circuit(self):
+        session = MagicMock()
+        session.request.return_value = MagicMock(status_code=503)
+        with patch.object(provider_clients, 'flutterwave', return_value=session):
+            flutterwave_request('GET', 'https://api.flutterwave.com/v3/banks')
+            flutterwave_request('GET', 'https://api.flutterwave.com/v3/banks')
+            with self.assertRaises(ProviderUnavailable):
+                flutterwave_request('GET', 'https://api.flutterwave.com/v3/banks')
+        self.assertEqual(session.request.call_count, 2)
+
+    def test_email_reconnects_after_server_disconnect(self):
+        connection = MagicMock()
+        connection.send_messages.side_effect = [smtplib.SMTPServerDisconnected(), 1]
+        with patch.object(provider_clients, 'smtp', return_value=connection):
+            self.assertEqual(send_email_messages([MagicMock()]), 1)
+        connection.close.assert_called_once()
+        self.assertEqual(connection.open.call_count, 2)
+
+
+class BeatScheduleTestCase(SimpleTestCase):
+    def test_notification_jobs_are_scheduled(self):
+        from vitanips.celery import app
+
+        scheduled = {entry['task'] for entry in app.conf.beat_schedule.values()}
+        for task in (
+            'notifications.tasks.release_deferred_notifications',
+            'notifications.tasks.send_notification_digests',
+            'notifications.tasks.apply_delivery_status_events',
+            'notifications.tasks.send_queued_deliveries_task',
+            'notifications.tasks.retry_failed_deliveries',
+            'notifications.tasks.process_scheduled_notifications',
+            'notifications.tasks.reconcile_unread_notification_counters',
+            'notifications.tasks.cleanup_old_notifications',
+        ):
+            self.assertIn(task, scheduled)
+        self.assertFalse(getattr(settings, 'CELERY_BEAT_SCHEDULE', None))
+
@@ -1,9 +1,10 @@
 # vitanips/core/utils.py
-from django.core.mail import send_mail
+from django.core.mail import EmailMultiAlternatives
 from django.template.loader import render_to_string
 from django.conf import settings
 from django.utils.html import strip_tags
 import logging
+from .clients import send_email_messages
 
 logger = logging.getLogger(__name__)
 
@@ -37,14 +38,10 @@ def send_app_email(to_email: str, subject: str, template_name: str, context: dic
         logger.info(f"Attempting to send email to {to_email} using backend: {email_backend}")
         logger.debug(f"From: {from_email}, Subject: {subject}")
         
-        result = send_mail(
-            subject,
-            plain_message,
-            from_email,
-            [to_email],
-            html_message=html_message,
-            fail_silently=False,
-        )
+        email = EmailMultiAlternatives(subject, plain_message, from_email, [to_email])
+        email.attach_alternative(html_message, "text/html")
+        # Reuses the worker's open SMTP connection instead of a new handshake per email.
+        result = send_email_messages([email])
         
         if result:
             logger.info(f"✅ Email sent successfully to {to_email} with subject: {subject}")
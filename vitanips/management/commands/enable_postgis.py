@@ -20,3 +20,8 @@ class Command(BaseCommand):
             except Exception as e:
                 self.stdout.write(self.style.WARNING(f'PostGIS Topology extension: {e}'))
 
+            try:
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+                self.stdout.write(self.style.SUCCESS('✓ pg_trgm extension enabled'))
+            except Exception as e:
+                self.stdout.write(self.style.WARNING(f'pg_trgm extension: {e}'))
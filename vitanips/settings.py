@@ -1,5 +1,6 @@
 # vitanips/settings.py
 import os
+import sys
 from pathlib import Path
 from datetime import timedelta
 from dotenv import load_dotenv
@@ -130,15 +131,35 @@ WSGI_APPLICATION = 'vitanips.wsgi.application'
 ASGI_APPLICATION = 'vitanips.asgi.application'
 
 # Channels / Redis Configuration
+REDIS_HOST = config('REDIS_HOST', default='localhost')
+REDIS_PORT = config('REDIS_PORT', default=6379, cast=int)
+
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
-            "hosts": [(config('REDIS_HOST', default='localhost'), config('REDIS_PORT', default=6379, cast=int))],
+            "hosts": [(REDIS_HOST, REDIS_PORT)],
         },
     },
 }
 
+# Shared across web and worker processes so cache invalidation is seen everywhere.
+# Test runs use a per-process in-memory cache so they do not need Redis.
+TESTING = 'test' in sys.argv or 'pytest' in sys.modules
+if TESTING:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": config('CACHE_URL', default=f"redis://{REDIS_HOST}:{REDIS_PORT}/1"),
+        },
+    }
+
 # Database
 database_url = config('DATABASE_URL', default=None)
 is_production_db = database_url and 'localhost' not in database_url.lower() and '127.0.0.1' not in database_url.lower()
@@ -365,31 +386,7 @@ CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 300
 CELERY_CACHE_BACKEND = 'default'
 
-# Celery Beat Schedule
-from celery.schedules import crontab
-
-CELERY_BEAT_SCHEDULE = {
-    'check-appointment-reminders': {
-        'task': 'notifications.tasks.check_appointment_reminders',
-        'schedule': crontab(minute='*/15'),  # Every 15 minutes
-    },
-    'check-medication-refill-reminders': {
-        'task': 'notifications.tasks.check_medication_refill_reminders',
-        'schedule': crontab(hour='9', minute='0'),  # Daily at 9 AM
-    },
-    'process-scheduled-notifications': {
-        'task': 'notifications.tasks.process_scheduled_notifications',
-        'schedule': crontab(minute='*/10'),  # Every 10 minutes
-    },
-    'retry-failed-deliveries': {
-        'task': 'notifications.tasks.retry_failed_deliveries',
-        'schedule': crontab(minute='*/30'),  # Every 30 minutes
-    },
-    'cleanup-old-notifications': {
-        'task': 'notifications.tasks.cleanup_old_notifications',
-        'schedule': crontab(hour='2', minute='0'),  # Daily at 2 AM
-    },
-}
+# Periodic jobs live in app.conf.beat_schedule (vitanips/celery.py).
 
 # --- Email Configuration ---
 # Intelligently select email backend based on environment and available credentials
@@ -405,6 +402,7 @@ if EMAIL_BACKEND == 'django.core.mail.backends.smtp.EmailBackend':
     EMAIL_USE_SSL = config('EMAIL_USE_SSL', default=False, cast=bool)
     EMAIL_HOST_USER = config('EMAIL_HOST_USER', default='noreply@vitanips.com')
     EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD', default='')
+    EMAIL_TIMEOUT = config('EMAIL_TIMEOUT', default=15, cast=int)  # seconds
 
 # Django Anymail (SendGrid, AWS SES, Mailgun, etc.)
 # Install with: pip install django-anymail[sendgrid] or django-anymail[amazon-ses]
@@ -435,6 +433,12 @@ if EMAIL_BACKEND in ['anymail.backends.sendgrid.EmailBackend',
             "MAILGUN_SENDER_DOMAIN": config('MAILGUN_SENDER_DOMAIN', default=''),
         }
 
+# --- Geocoding Configuration ---
+GOOGLE_MAPS_API_KEY = config('GOOGLE_MAPS_API_KEY', default='')
+GEOCODING_PROVIDER = config('GEOCODING_PROVIDER', default='pharmacy.geocoding.GoogleGeocodingProvider')
+GEOCODING_RATE_LIMIT = config('GEOCODING_RATE_LIMIT', default=10, cast=float)  # provider requests per second
+GEOCODING_TIMEOUT = config('GEOCODING_TIMEOUT', default=5, cast=int)  # seconds
+
 # --- Twilio Configuration ---
 TWILIO_ACCOUNT_SID = config('TWILIO_ACCOUNT_SID', default='')
 TWILIO_AUTH_TOKEN = config('TWILIO_AUTH_TOKEN', default='')
@@ -442,6 +446,26 @@ TWILIO_PHONE_NUMBER = config('TWILIO_PHONE_NUMBER', default='')
 TWILIO_API_KEY_SID = config('TWILIO_API_KEY_SID', default='')
 TWILIO_API_KEY_SECRET = config('TWILIO_API_KEY_SECRET', default='')
 
+# --- Provider Clients (Twilio, SMTP, Flutterwave) ---
+PROVIDER_CLIENT_TIMEOUT = config('PROVIDER_CLIENT_TIMEOUT', default=15, cast=int)  # seconds
+PROVIDER_CLIENT_MAX_RETRIES = config('PROVIDER_CLIENT_MAX_RETRIES', default=2, cast=int)
+PROVIDER_CIRCUIT_FAILURE_THRESHOLD = config('PROVIDER_CIRCUIT_FAILURE_THRESHOLD', default=5, cast=int)
+PROVIDER_CIRCUIT_RESET_TIMEOUT = config('PROVIDER_CIRCUIT_RESET_TIMEOUT', default=30, cast=int)  # seconds
+
+# Batched notification delivery
+NOTIFICATION_DELIVERY_BATCH_SIZE = config('NOTIFICATION_DELIVERY_BATCH_SIZE', default=500, cast=int)
+FCM_MAX_RECIPIENTS = config('FCM_MAX_RECIPIENTS', default=500, cast=int)  # FCM batch send limit
+# Daily email/SMS limits per user; counters fall back to the database when unset or unreachable
+NOTIFICATION_RATE_LIMIT_REDIS_URL = config('NOTIFICATION_RATE_LIMIT_REDIS_URL', default='')
+# Retention of read notifications, deleted in resumable chunks
+NOTIFICATION_RETENTION_DAYS = config('NOTIFICATION_RETENTION_DAYS', default=90, cast=int)
+NOTIFICATION_RETENTION_CHUNK_SIZE = config('NOTIFICATION_RETENTION_CHUNK_SIZE', default=1000, cast=int)
+NOTIFICATION_RETENTION_MAX_CHUNKS = config('NOTIFICATION_RETENTION_MAX_CHUNKS', default=500, cast=int)  # per run
+# Provider delivery-status callbacks: Twilio's StatusCallback URL for notification SMS (also
+# used to validate its signature) and the HMAC secret of the email event webhook
+NOTIFICATION_SMS_STATUS_CALLBACK_URL = config('NOTIFICATION_SMS_STATUS_CALLBACK_URL', default='')
+NOTIFICATION_EMAIL_WEBHOOK_SECRET = config('NOTIFICATION_EMAIL_WEBHOOK_SECRET', default='')
+
 # --- Push Notifications Configuration ---
 # FCM HTTP v1 API (Modern, Recommended)
 # Support both file path and base64-encoded JSON content from secrets